@@ -0,0 +1,423 @@
+import asyncio
+import logging
+import math
+import os
+import select
+import socket
+import sqlite3
+import stat
+import struct
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import stats, TICKS, DB_WRITE, ROWS_WRITTEN, DROPPED_RECORDS, QUEUE_DEPTH
+from tick_log import (TickEncoder, TickLog, tick_columns, TICK_LOG_HEADER, TICK_LOG_MAGIC, TICK_LOG_VERSION,
+                      TICK_LOG_FRAME, TICK_LOG_TICK, NAME_FRAME, TICK_FRAME)
+
+logger = logging.getLogger(__name__)
+
+# Stream of an agent to the aggregator: the header of a tick log, a HOST frame with the name of the agent host,
+# then the NAME and TICK frames of a tick log, the names numbered from 0 on every connection, see tick_log
+# The aggregator answers with ACK frames: number of ticks of the connection written to the store, uint64
+HOST_FRAME = 3
+ACK_FRAME = 4
+ACK = struct.Struct("<Q")
+# Largest frame accepted, a tick of 100,000 processes with all metrics takes about 6 MB
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+DEFAULT_PORT = 7070
+UNIX_PREFIX = "unix:"
+# Agent: ticks kept while the aggregator can't take them, beyond that the oldest ticks not sent yet are dropped
+MAX_BUFFERED_TICKS = 3600
+# Agent: seconds between connection attempts, doubled after every failure up to the maximum
+RECONNECT_INTERVAL = 1.0
+MAX_RECONNECT_INTERVAL = 30.0
+CONNECT_TIMEOUT = 2.0
+# Aggregator: ticks received and not written yet, the agents are not read beyond that
+MAX_QUEUED_TICKS = 10000
+# Aggregator: seconds between write transactions, and ticks per transaction at most
+BATCH_INTERVAL = 1.0
+MAX_BATCH_TICKS = 1000
+
+
+def parse_address(text, default_host="127.0.0.1"):
+    """
+    :param text: unix:PATH for a Unix socket, HOST:PORT, :PORT or PORT for TCP, e.g. [::1]:7070 for IPv6
+    :param default_host: host when the text has a port only
+    :return: (family, address) to connect or bind to, family is socket.AF_UNIX or socket.AF_INET
+    :raise ValueError: if the text is not an address
+    """
+    if text.startswith(UNIX_PREFIX):
+        return socket.AF_UNIX, text[len(UNIX_PREFIX):]
+    host, _, port = text.rpartition(":")
+    return socket.AF_INET, (host.strip("[]") or default_host, int(port))
+
+
+def format_address(address):
+    family, target = address
+    return f"{UNIX_PREFIX}{target}" if family == socket.AF_UNIX else f"{target[0]}:{target[1]}"
+
+
+class AgentSender:
+    """
+    Streams the records of every tick to an aggregator, called from the sampling loop without blocking it:
+    frames are written to a non-blocking socket as far as it takes them
+    Ticks are kept until the aggregator acknowledges they were written to the store, and sent again
+    after a reconnection; while the aggregator is unreachable or falls behind, up to max_buffered ticks are kept,
+    beyond that the oldest ticks not sent yet are dropped and counted as DROPPED_RECORDS
+    """
+
+    def __init__(self, address, host=None, max_buffered=MAX_BUFFERED_TICKS):
+        """
+        :param address: (family, address) of the aggregator, see parse_address()
+        :param host: name the records are stored with, the host name by default, must be unique among the agents
+        :param max_buffered: ticks kept at most
+        """
+        self.address = address
+        self.host = host or socket.gethostname()
+        self.max_buffered = max_buffered
+        self.socket = None
+        self.encoder = None
+        self.outgoing = bytearray()  # Frames not written to the socket yet
+        self.incoming = bytearray()  # Frames received from the aggregator, not complete yet
+        self.pending = deque()  # Ticks not sent yet: (timestamp, records)
+        self.unacknowledged = deque()  # Ticks sent on the connection and not written by the aggregator yet
+        self.acknowledged = 0  # Ticks of the connection written by the aggregator
+        self.retry_interval = RECONNECT_INTERVAL
+        self.retry_at = 0.0
+
+    @property
+    def buffered(self):
+        return len(self.pending) + len(self.unacknowledged)
+
+    def send(self, timestamp, records):
+        """
+        :param timestamp: time of the tick
+        :param records: list of dicts returned by CPUSampler.make_records()
+        """
+        self.pending.append((timestamp, records))
+        while self.buffered > self.max_buffered and self.pending:
+            _, dropped = self.pending.popleft()
+            stats.count(DROPPED_RECORDS, len(dropped))
+        self.flush()
+
+    def flush(self):
+        """
+        Connect if needed, read the acknowledgements and write the frames as far as the socket takes them
+        :return: True if connected
+        """
+        if self.socket is None and not self.connect():
+            return False
+        try:
+            self.receive()
+            while True:
+                if not self.outgoing:
+                    if not self.pending:
+                        break
+                    tick = self.pending.popleft()
+                    self.outgoing += self.encoder.encode(*tick)
+                    self.unacknowledged.append(tick)
+                written = self.socket.send(self.outgoing)
+                del self.outgoing[:written]
+                if self.outgoing:
+                    # The socket is full, the aggregator is behind
+                    break
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self.disconnect(e)
+            return False
+        return True
+
+    def receive(self):
+        """
+        Read the acknowledgements, the acknowledged ticks are forgotten
+        :raise ConnectionError: if the aggregator closed the connection
+        """
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except BlockingIOError:
+                break
+            if not data:
+                raise ConnectionResetError("closed by the aggregator")
+            self.incoming += data
+        offset = 0
+        while len(self.incoming) - offset >= TICK_LOG_FRAME.size:
+            kind, size = TICK_LOG_FRAME.unpack_from(self.incoming, offset)
+            if len(self.incoming) - offset < TICK_LOG_FRAME.size + size:
+                break
+            if kind == ACK_FRAME:
+                written, = ACK.unpack_from(self.incoming, offset + TICK_LOG_FRAME.size)
+                for _ in range(min(written - self.acknowledged, len(self.unacknowledged))):
+                    self.unacknowledged.popleft()
+                self.acknowledged = max(self.acknowledged, written)
+            offset += TICK_LOG_FRAME.size + size
+        del self.incoming[:offset]
+
+    def connect(self):
+        """
+        :return: True if connected, False if the aggregator can't be reached, tried again after the retry interval
+        """
+        now = time.monotonic()
+        if now < self.retry_at:
+            return False
+        family, target = self.address
+        try:
+            if family == socket.AF_UNIX:
+                connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                connection.settimeout(CONNECT_TIMEOUT)
+                try:
+                    connection.connect(target)
+                except OSError:
+                    connection.close()
+                    raise
+            else:
+                connection = socket.create_connection(target, timeout=CONNECT_TIMEOUT)
+        except OSError as e:
+            logger.warning("Can't connect to the aggregator at %s: %s, %d ticks buffered, retrying in %.0fs",
+                           format_address(self.address), e, self.buffered, self.retry_interval)
+            self.retry_at = now + self.retry_interval
+            self.retry_interval = min(self.retry_interval * 2, MAX_RECONNECT_INTERVAL)
+            return False
+        connection.setblocking(False)
+        self.socket = connection
+        self.retry_interval = RECONNECT_INTERVAL
+        # Names are numbered again on every connection
+        self.encoder = TickEncoder()
+        self.acknowledged = 0
+        encoded = self.host.encode('utf-8')
+        self.outgoing = bytearray(TICK_LOG_HEADER.pack(TICK_LOG_MAGIC, TICK_LOG_VERSION) +
+                                  TICK_LOG_FRAME.pack(HOST_FRAME, len(encoded)) + encoded)
+        logger.info("Connected to the aggregator at %s as %s, %d ticks buffered",
+                    format_address(self.address), self.host, self.buffered)
+        return True
+
+    def disconnect(self, error):
+        """
+        Close the connection, the ticks not acknowledged are sent again on the next one
+        """
+        logger.warning("Lost the connection to the aggregator at %s: %s", format_address(self.address), error)
+        self.socket.close()
+        self.socket = None
+        self.outgoing = bytearray()
+        self.incoming = bytearray()
+        self.pending.extendleft(reversed(self.unacknowledged))
+        self.unacknowledged.clear()
+        self.retry_at = time.monotonic() + self.retry_interval
+
+    def close(self, timeout=CONNECT_TIMEOUT):
+        """
+        Send the ticks left and wait for their acknowledgement, at most timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        while self.buffered and time.monotonic() < deadline:
+            if self.flush():
+                writing = [self.socket] if self.outgoing else []
+                select.select([self.socket], writing, [], max(0.0, deadline - time.monotonic()))
+            else:
+                time.sleep(min(0.1, max(0.0, deadline - time.monotonic())))
+        if self.buffered:
+            logger.warning("%d ticks were not delivered to the aggregator", self.buffered)
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+class AgentConnection:
+    """
+    State of the stream of one agent in the aggregator
+    """
+
+    def __init__(self, host, writer):
+        self.host = host
+        self.writer = writer
+        self.names = []  # Process names numbered by the NAME frames of the connection
+        self.written = 0  # Ticks written to the store, acknowledged to the agent
+
+
+class Aggregator:
+    """
+    Receives the ticks of many agents and writes them into one store, every record tagged with its agent host
+    The agents are served concurrently by an asyncio event loop; their ticks are decoded and written by one thread,
+    in one transaction per batch_interval, then every agent is acknowledged the ticks written
+    When the store falls behind, max_queued ticks are queued at most, then the agents are not read
+    until it catches up: their sockets fill up and they buffer the ticks themselves, see AgentSender
+    Ticks sent again by an agent after a reconnection are recognized by their timestamps and not written twice,
+    also after a restart of the aggregator: the timestamp of the newest tick of every host is kept in the store
+    """
+
+    def __init__(self, store, batch_interval=BATCH_INTERVAL, max_queued=MAX_QUEUED_TICKS, stats_interval=0):
+        """
+        :param store: SQLiteStore, not opened yet: it is opened and only used by the writing thread
+        :param batch_interval: seconds between write transactions
+        :param max_queued: ticks received and not written yet at most
+        :param stats_interval: seconds between logs of the statistics of the aggregator, 0 for none
+        """
+        self.store = store
+        self.batch_interval = batch_interval
+        self.max_queued = max_queued
+        self.stats_interval = stats_interval
+        self.queue = None  # asyncio.Queue of (connection, timestamp, payload of the TICK frame or None), see serve()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latest = {}  # {host: timestamp of the newest tick received}, loaded from the store by serve()
+        self.agents = set()  # Connected AgentConnections
+
+    async def serve(self, address, started=None):
+        """
+        Accept agents until cancelled, the ticks queued are written before returning
+        :param address: (family, address) to listen on, see parse_address()
+        :param started: asyncio.Event set once listening
+        """
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.max_queued)
+        await loop.run_in_executor(self.executor, self.store.open)
+        self.latest = await loop.run_in_executor(self.executor, self.store.query_hosts)
+        family, target = address
+        if family == socket.AF_UNIX:
+            # A socket left by an aggregator which did not exit cleanly
+            if os.path.exists(target) and stat.S_ISSOCK(os.stat(target).st_mode):
+                os.unlink(target)
+            server = await asyncio.start_unix_server(self.handle, target)
+        else:
+            server = await asyncio.start_server(self.handle, *target)
+        tasks = [asyncio.ensure_future(self.write_loop())]
+        if self.stats_interval:
+            tasks.append(asyncio.ensure_future(self.report_loop()))
+        logger.info("Aggregating into %s, listening on %s", self.store.database_name, format_address(address))
+        if started is not None:
+            started.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            while not self.queue.empty():
+                await self.write(self.take(MAX_BATCH_TICKS))
+            # The acknowledgements are sent before the connections are closed
+            for connection in list(self.agents):
+                connection.writer.close()
+            await asyncio.gather(*(connection.writer.wait_closed() for connection in list(self.agents)),
+                                 return_exceptions=True)
+            await loop.run_in_executor(self.executor, self.store.close)
+            self.executor.shutdown()
+            if family == socket.AF_UNIX and os.path.exists(target):
+                os.unlink(target)
+
+    @staticmethod
+    async def read_frame(reader):
+        """
+        :return: (kind, payload) of the next frame of a stream
+        :raise asyncio.IncompleteReadError: at the end of the stream
+        :raise ValueError: if the frame is too large
+        """
+        kind, size = TICK_LOG_FRAME.unpack(await reader.readexactly(TICK_LOG_FRAME.size))
+        if size > MAX_FRAME_SIZE:
+            raise ValueError(f"frame of {size} bytes")
+        return kind, await reader.readexactly(size)
+
+    async def handle(self, reader, writer):
+        """
+        Read the stream of one agent and queue its ticks, waiting while the queue is full
+        """
+        peer = writer.get_extra_info('peername') or "local socket"
+        connection = None
+        try:
+            magic, version = TICK_LOG_HEADER.unpack(await reader.readexactly(TICK_LOG_HEADER.size))
+            if magic != TICK_LOG_MAGIC or version != TICK_LOG_VERSION:
+                raise ValueError("not an agent stream")
+            kind, payload = await self.read_frame(reader)
+            if kind != HOST_FRAME:
+                raise ValueError("the agent did not send its host")
+            connection = AgentConnection(payload.decode('utf-8'), writer)
+            self.agents.add(connection)
+            logger.info("Agent %s connected from %s, %d agents", connection.host, peer, len(self.agents))
+            while True:
+                kind, payload = await self.read_frame(reader)
+                if kind == NAME_FRAME:
+                    connection.names.append(payload.decode('utf-8'))
+                elif kind == TICK_FRAME:
+                    timestamp = TICK_LOG_TICK.unpack_from(payload)[0]
+                    if timestamp <= self.latest.get(connection.host, -math.inf):
+                        # Sent again after a reconnection, it was received before, only acknowledged
+                        payload = None
+                    else:
+                        self.latest[connection.host] = timestamp
+                    await self.queue.put((connection, timestamp, payload))
+                    stats.count(TICKS)
+        except asyncio.IncompleteReadError:
+            pass
+        except (ValueError, struct.error, ConnectionError) as e:
+            logger.warning("Dropping the connection of %s: %s", peer, e)
+        finally:
+            if connection is not None:
+                self.agents.discard(connection)
+                logger.info("Agent %s disconnected, %d agents", connection.host, len(self.agents))
+            writer.close()
+
+    def take(self, count):
+        """
+        :return: list of up to count ticks taken from the queue without waiting
+        """
+        batch = []
+        while len(batch) < count and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def write_loop(self):
+        while True:
+            batch = [await self.queue.get()]
+            # Unless the store is behind, the ticks of one interval are gathered into one transaction
+            if self.queue.qsize() < MAX_BATCH_TICKS:
+                await asyncio.sleep(self.batch_interval)
+            batch.extend(self.take(MAX_BATCH_TICKS - 1))
+            stats.gauge(QUEUE_DEPTH, self.queue.qsize())
+            await self.write(batch)
+
+    async def report_loop(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            stats.log_report()
+
+    async def write(self, batch):
+        """
+        Write a batch of ticks and acknowledge them to their agents
+        If the write fails, the agents of the batch are disconnected and send the ticks again when they reconnect
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self.write_batch, batch)
+        except sqlite3.Error as e:
+            logger.error("Failed to write %d ticks: %s", len(batch), e)
+            for connection, timestamp, _ in batch:
+                self.latest[connection.host] = min(self.latest.get(connection.host, timestamp), timestamp - 1e-6)
+                connection.writer.close()
+            return
+        written = {}
+        for connection, _, _ in batch:
+            written[connection] = written.get(connection, 0) + 1
+        for connection, count in written.items():
+            connection.written += count
+            if not connection.writer.is_closing():
+                connection.writer.write(TICK_LOG_FRAME.pack(ACK_FRAME, ACK.size) + ACK.pack(connection.written))
+
+    def write_batch(self, batch):
+        """
+        Decode the ticks and write them in one transaction, runs in the writing thread
+        """
+        records, hosts = [], {}
+        for connection, timestamp, payload in batch:
+            if payload is None:
+                continue
+            hosts[connection.host] = max(hosts.get(connection.host, timestamp), timestamp)
+            timestamp, columns = tick_columns(payload)
+            tick_records = TickLog.records(timestamp, columns, connection.names)
+            for record in tick_records:
+                record['host'] = connection.host
+            records.extend(tick_records)
+        write_start = time.perf_counter()
+        self.store.write_batch(records, hosts=hosts)
+        stats.record(DB_WRITE, time.perf_counter() - write_start)
+        stats.count(ROWS_WRITTEN, len(records))
@@ -0,0 +1,195 @@
+import logging
+import sqlite3
+import time
+
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QComboBox, QDoubleSpinBox, QCheckBox, QLineEdit,
+                             QPushButton, QTableWidget, QTableWidgetItem, QLabel)
+
+from sqlite_store import DATABASE_NAME
+
+logger = logging.getLogger(__name__)
+
+# Windows offered, ending now: label: seconds
+WINDOWS = {
+    "Last 15 minutes": 900,
+    "Last hour": 3600,
+    "Last 6 hours": 6 * 3600,
+    "Last 24 hours": 86400,
+    "Last 7 days": 7 * 86400,
+    "Last 30 days": 30 * 86400,
+}
+DEFAULT_WINDOW = "Last 24 hours"
+# Column titles of the statistics, see analytics.STATISTICS
+COLUMN_TITLES = {
+    'samples': "Samples",
+    'mean': "Mean %",
+    'max': "Max %",
+    'p50': "p50 %",
+    'p95': "p95 %",
+    'p99': "p99 %",
+    'time_above': "Above (s)",
+}
+# Processes shown, worst first
+MAX_ROWS = 200
+
+
+# noinspection PyUnresolvedReferences
+class AnalysisWidget(QWidget):
+    """
+    Analysis tab: statistics of CPU usage per process over a window ending now, worst processes first
+    Answered by analytics.WindowAnalytics from the rollups on a read-only connection,
+    the memoized segments are invalidated as the database writer writes new samples
+    The table is refreshed periodically while it can be seen
+    The controls are built and analytics, with NumPy, is imported when the tab is first shown
+    """
+
+    def __init__(self, refresh_interval=10.0, database_name=DATABASE_NAME, parent=None):
+        """
+        :param refresh_interval: seconds between refreshes while the tab is visible
+        :param database_name: path to the SQLite database file
+        :param parent: parent widget
+        """
+        super().__init__(parent)
+        self.database_name = database_name
+        self.refresh_interval = refresh_interval
+        self.engine = None
+        self.table = None
+
+    def init_ui(self):
+        import analytics
+
+        layout = QVBoxLayout(self)
+        controls_layout = QHBoxLayout()
+        self.window_combo = QComboBox()
+        self.window_combo.addItems(list(WINDOWS))
+        self.window_combo.setCurrentText(DEFAULT_WINDOW)
+        controls_layout.addWidget(self.window_combo)
+        controls_layout.addWidget(QLabel("Threshold"))
+        self.threshold_spinbox = QDoubleSpinBox()
+        self.threshold_spinbox.setRange(0, 100)
+        self.threshold_spinbox.setSingleStep(5)
+        self.threshold_spinbox.setSuffix(" %")
+        self.threshold_spinbox.setValue(analytics.DEFAULT_THRESHOLD)
+        controls_layout.addWidget(self.threshold_spinbox)
+        controls_layout.addWidget(QLabel("Rank by"))
+        self.sort_combo = QComboBox()
+        for column in analytics.STATISTICS:
+            self.sort_combo.addItem(COLUMN_TITLES[column], column)
+        self.sort_combo.setCurrentIndex(analytics.STATISTICS.index('p95'))
+        controls_layout.addWidget(self.sort_combo)
+        self.by_host_checkbox = QCheckBox("Per Host")
+        controls_layout.addWidget(self.by_host_checkbox)
+        self.by_pid_checkbox = QCheckBox("Per PID")
+        controls_layout.addWidget(self.by_pid_checkbox)
+        self.filter_edit = QLineEdit()
+        self.filter_edit.setPlaceholderText("Filter by process name")
+        controls_layout.addWidget(self.filter_edit)
+        refresh_button = QPushButton("Refresh")
+        refresh_button.clicked.connect(self.refresh)
+        controls_layout.addWidget(refresh_button)
+        layout.addLayout(controls_layout)
+
+        self.table = QTableWidget()
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.verticalHeader().setDefaultSectionSize(10)
+        layout.addWidget(self.table)
+        self.status_label = QLabel()
+        layout.addWidget(self.status_label)
+
+        for combo in (self.window_combo, self.sort_combo):
+            combo.currentIndexChanged.connect(self.refresh)
+        self.threshold_spinbox.editingFinished.connect(self.refresh)
+        self.by_host_checkbox.toggled.connect(self.refresh)
+        self.by_pid_checkbox.toggled.connect(self.refresh)
+        self.filter_edit.editingFinished.connect(self.refresh)
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh_visible)
+        self.refresh_timer.start(int(self.refresh_interval * 1000))
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.table is None:
+            self.init_ui()
+        self.refresh()
+
+    def samples_written(self, oldest):
+        """
+        New samples were written, the segments they belong to are computed again
+        :param oldest: oldest timestamp of the samples
+        """
+        if self.engine is not None:
+            self.engine.invalidate(oldest)
+
+    def invalidate(self, _result=None):
+        """
+        The database was changed by a task, e.g. an import or a cleanup
+        """
+        if self.engine is not None:
+            self.engine.invalidate()
+
+    def open_engine(self):
+        """
+        :return: False if the database can't be read yet, e.g. before it is created
+        """
+        if self.engine is None:
+            import analytics
+            try:
+                self.engine = analytics.WindowAnalytics(analytics.connect(self.database_name))
+            except (sqlite3.Error, ValueError) as e:
+                self.status_label.setText(f"Database can't be analyzed: {e}")
+                return False
+        return True
+
+    def refresh_visible(self):
+        if self.isVisible():
+            self.refresh()
+
+    def refresh(self):
+        if not self.open_engine():
+            return
+        end = time.time()
+        window = WINDOWS[self.window_combo.currentText()]
+        by = 'pid' if self.by_pid_checkbox.isChecked() else 'host' if self.by_host_checkbox.isChecked() else 'name'
+        sort = self.sort_combo.currentData()
+        started = time.perf_counter()
+        try:
+            results = self.engine.statistics(end - window, end, threshold=self.threshold_spinbox.value(), by=by)
+        except sqlite3.Error as e:
+            logger.error("Failed to analyze the database: %s", e)
+            self.status_label.setText(f"Failed to analyze the database: {e}")
+            return
+        elapsed = time.perf_counter() - started
+        prefix = self.filter_edit.text()
+        shown = [result for result in results if result['name'].startswith(prefix)]
+        shown.sort(key=lambda result: -1.0 if result[sort] is None else result[sort], reverse=True)
+        self.show_results(shown[:MAX_ROWS], by, sort)
+        self.status_label.setText(
+            f"{len(shown)} of {len(results)} processes, worst {min(len(shown), MAX_ROWS)} shown, "
+            f"computed in {elapsed * 1000:.0f} ms"
+        )
+
+    def show_results(self, results, by, sort):
+        import analytics
+
+        identity = {'name': ['name'], 'host': ['name', 'host'], 'pid': ['name', 'host', 'pid']}[by]
+        columns = [{'name': "Process", 'host': "Host", 'pid': "PID"}[key] for key in identity] + \
+            [COLUMN_TITLES[key] for key in analytics.STATISTICS]
+        keys = identity + list(analytics.STATISTICS)
+        self.table.setSortingEnabled(False)
+        self.table.clear()
+        self.table.setColumnCount(len(columns))
+        self.table.setHorizontalHeaderLabels(columns)
+        self.table.setRowCount(len(results))
+        for row, result in enumerate(results):
+            for column, key in enumerate(keys):
+                value = result[key]
+                item = QTableWidgetItem()
+                # Numbers are set as data, so the columns sort numerically
+                if isinstance(value, float):
+                    value = round(value, 1)
+                item.setData(Qt.DisplayRole, "-" if value is None else value)
+                self.table.setItem(row, column, item)
+        self.table.setSortingEnabled(True)
+        self.table.sortByColumn(keys.index(sort), Qt.DescendingOrder)
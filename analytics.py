@@ -0,0 +1,378 @@
+import math
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+import columnar_store
+from sqlite_store import SQLiteStore, SCHEMA_VERSION, HISTOGRAM_BIN_WIDTH, HISTOGRAM_BINS, overlapping_partitions
+
+# Statistics of a window per process, in the order of the columns of the Analysis tab and of the CLI
+STATISTICS = ('samples', 'mean', 'max', 'p50', 'p95', 'p99', 'time_above')
+PERCENTILES = {'p50': 0.50, 'p95': 0.95, 'p99': 0.99}
+# CPU usage in percent, the time above it is counted
+DEFAULT_THRESHOLD = 50.0
+# Segments of windows kept by the memo cache
+DEFAULT_CACHE_SIZE = 64
+# Counts of the histogram BLOBs of the rollups, after the first bin, see sqlite_store.pack_histogram()
+HISTOGRAM_COUNT = np.dtype('<u4')
+# Seconds of the time histogram BLOBs of the rollups, the bins are the same as of the histogram
+HISTOGRAM_SECONDS = np.dtype('<f4')
+# PIDs per query of the raw samples, below the limit of SQLite on the number of parameters
+MAX_QUERY_PIDS = 500
+# Rollup levels, coarsest first: (table, bucket width in seconds)
+LEVELS = sorted(((table, width) for table, width, _ in SQLiteStore.ROLLUPS), key=lambda level: -level[1])
+# Key of the statistics of a sample from its host, PID and process name, for each grouping of statistics()
+GROUPINGS = {
+    'name': lambda host, pid, name: name,
+    'host': lambda host, pid, name: (host, name),
+    'pid': lambda host, pid, name: (host, pid),
+}
+
+
+def connect(database_name):
+    """
+    :param database_name: path to the SQLite database file
+    :return: read-only sqlite3 connection to the metrics database
+    :raise ValueError: if the database does not have the rollup histograms yet, SQLiteStore.open() migrates it
+    """
+    connection = sqlite3.connect(f"file:{database_name}?mode=ro", uri=True)
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        connection.close()
+        raise ValueError(f"{database_name} has schema version {version}, {SCHEMA_VERSION} is needed")
+    return connection
+
+
+class Aggregate:
+    """
+    Statistics of the samples of one segment of a window, per process
+    Sums, maxima and histograms can be merged across segments, percentiles are read from the merged histograms
+    """
+
+    def __init__(self, keys, names, samples, totals, maxima, histograms, seconds):
+        """
+        :param keys: list of keys, see GROUPINGS
+        :param names: list of process names of the keys
+        :param samples: array of numbers of samples per key
+        :param totals: array of sums of the CPU usage per key
+        :param maxima: array of maxima of the CPU usage per key
+        :param histograms: 2-D array of counts per key and bin, see sqlite_store.HISTOGRAM_BINS
+        :param seconds: 2-D array of the seconds the samples stand for per key and bin
+        """
+        self.keys = keys
+        self.names = names
+        self.samples = samples
+        self.totals = totals
+        self.maxima = maxima
+        self.histograms = histograms
+        self.seconds = seconds
+
+    @staticmethod
+    def from_rows(keys, names, samples, totals, maxima, rows, bins, counts, seconds):
+        """
+        Sum rows, e.g. rollup buckets or raw samples, per key
+        :param keys: key of every row
+        :param names: process name of every row
+        :param samples: array of samples of every row
+        :param totals: array of sums of the CPU usage of every row
+        :param maxima: array of maxima of the CPU usage of every row
+        :param rows: array of the row number of every histogram entry
+        :param bins: array of the bin of every histogram entry
+        :param counts: array of the count of every histogram entry
+        :param seconds: array of the seconds of every histogram entry
+        :return: Aggregate
+        """
+        numbers = {}
+        for key, name in zip(keys, names):
+            numbers.setdefault(key, (len(numbers), name))
+        index = np.fromiter((numbers[key][0] for key in keys), np.intp, len(keys))
+        size = len(numbers)
+        aggregate_maxima = np.zeros(size)
+        np.maximum.at(aggregate_maxima, index, maxima)
+        entries = index[rows] * HISTOGRAM_BINS + bins
+        histograms = np.bincount(entries, weights=counts, minlength=size * HISTOGRAM_BINS).reshape(size, HISTOGRAM_BINS)
+        histogram_seconds = np.bincount(
+            entries, weights=seconds, minlength=size * HISTOGRAM_BINS
+        ).reshape(size, HISTOGRAM_BINS)
+        return Aggregate(
+            list(numbers), [name for _, name in numbers.values()],
+            np.bincount(index, weights=samples, minlength=size),
+            np.bincount(index, weights=totals, minlength=size),
+            aggregate_maxima, histograms, histogram_seconds
+        )
+
+    @staticmethod
+    def empty():
+        return Aggregate([], [], np.zeros(0), np.zeros(0), np.zeros(0), np.zeros((0, HISTOGRAM_BINS)),
+                         np.zeros((0, HISTOGRAM_BINS)))
+
+    @staticmethod
+    def merge(aggregates):
+        """
+        :param aggregates: Aggregates of disjoint segments
+        :return: Aggregate of all the segments
+        """
+        numbers = {}
+        for aggregate in aggregates:
+            for key, name in zip(aggregate.keys, aggregate.names):
+                numbers.setdefault(key, (len(numbers), name))
+        size = len(numbers)
+        merged = Aggregate(list(numbers), [name for _, name in numbers.values()], np.zeros(size), np.zeros(size),
+                           np.zeros(size), np.zeros((size, HISTOGRAM_BINS)), np.zeros((size, HISTOGRAM_BINS)))
+        for aggregate in aggregates:
+            # Keys are unique within an aggregate, so fancy indexing adds every row once
+            index = np.fromiter((numbers[key][0] for key in aggregate.keys), np.intp, len(aggregate.keys))
+            merged.samples[index] += aggregate.samples
+            merged.totals[index] += aggregate.totals
+            merged.maxima[index] = np.maximum(merged.maxima[index], aggregate.maxima)
+            merged.histograms[index] += aggregate.histograms
+            merged.seconds[index] += aggregate.seconds
+        return merged
+
+
+class WindowAnalytics:
+    """
+    Per-process statistics of CPU usage over arbitrary time windows: mean, max, p50/p95/p99 and time above a threshold
+    A window is split into segments answered by the coarsest data covering them:
+    whole hours from the 1 hour rollups, whole minutes from the 1 minute rollups and the partial minutes
+    at both ends from the raw samples, so the cost depends on the length of the window, not on the number of rows
+    Mean and max are exact, percentiles and time above the threshold are read from the merged histograms
+    of the rollups and are exact to a bin, see sqlite_store.HISTOGRAM_BIN_WIDTH;
+    the time counts the seconds every sample stands for, so it holds for any, even adaptive, sampling interval
+    Segments are memoized, invalidate() drops the ones new samples were written into
+    """
+
+    def __init__(self, connection, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        :param connection: sqlite3 connection to the metrics database, see SQLiteStore
+        :param cache_size: number of segments memoized
+        """
+        self.connection = connection
+        # Segments of the columnar backend are kept next to the database file
+        self.database_name = connection.execute("PRAGMA database_list").fetchone()[2]
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # {(table or None, start, end, by, process): Aggregate}
+
+    @staticmethod
+    def plan(start, end, levels=None):
+        """
+        Split a window into segments, whole buckets of the coarsest level possible and raw samples at the ends
+        Segments of a level are also split at the buckets of the coarser level,
+        so the segments inside a window moving with time stay the same and are found in the cache
+        :param start: window start timestamp
+        :param end: window end timestamp
+        :param levels: rollup levels left, coarsest first
+        :return: list of (table, segment start, segment end), table None for raw samples
+        """
+        levels = LEVELS if levels is None else levels
+        if start >= end:
+            return []
+        if not levels:
+            return [(None, start, end)]
+        (table, width), finer = levels[0], levels[1:]
+        first, last = math.ceil(start / width) * width, math.floor(end / width) * width
+        if first >= last:
+            return WindowAnalytics.plan(start, end, finer)
+        segments = WindowAnalytics.plan(start, first, finer)
+        # Hours split at days, minutes at hours
+        block = width * (24 if width >= 3600 else 60)
+        segment_start = first
+        while segment_start < last:
+            segment_end = min(last, (segment_start // block + 1) * block)
+            segments.append((table, segment_start, segment_end))
+            segment_start = segment_end
+        return segments + WindowAnalytics.plan(last, end, finer)
+
+    def invalidate(self, since=None):
+        """
+        Drop the memoized segments which samples from a timestamp on belong to
+        :param since: oldest timestamp of the new samples, None drops all segments
+        """
+        for key in [key for key in self.cache if since is None or key[2] > since]:
+            del self.cache[key]
+
+    def segment(self, table, start, end, by, process):
+        """
+        :return: memoized Aggregate of a segment
+        """
+        key = (table, start, end, by, process)
+        aggregate = self.cache.get(key)
+        if aggregate is not None:
+            self.cache.move_to_end(key)
+            return aggregate
+        if table is None:
+            aggregate = self.read_raw(start, end, by, process)
+        else:
+            aggregate = self.read_rollup(table, start, end, by, process)
+        self.cache[key] = aggregate
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return aggregate
+
+    def read_rollup(self, table, start, end, by, process):
+        query = f"SELECT Host, PID, ProcessName, Samples, AvgWorkload, MaxWorkload, Histogram, TimeHistogram " \
+                f"FROM {table} WHERE Bucket >= ? AND Bucket < ?"
+        parameters = [start, end]
+        if process is not None:
+            query += " AND ProcessName = ?"
+            parameters.append(process)
+        rows = self.connection.execute(query, parameters).fetchall()
+        if not rows:
+            return Aggregate.empty()
+        hosts, pids, names, samples, averages, maxima, blobs, time_blobs = zip(*rows)
+        grouping = GROUPINGS[by]
+        keys = [grouping(*row) for row in zip(hosts, pids, names)]
+        samples = np.array(samples, dtype=float)
+        # Rollup rows written before the histograms were added have none, they count as empty histograms
+        blobs = [blob or b"\0" for blob in blobs]
+        counts = np.frombuffer(b"".join(blob[1:] for blob in blobs), HISTOGRAM_COUNT)
+        # The counts of a row are consecutive bins from its first one
+        lengths = np.array([(len(blob) - 1) // HISTOGRAM_COUNT.itemsize for blob in blobs], dtype=np.intp)
+        rows = np.repeat(np.arange(len(blobs)), lengths)
+        offsets = np.arange(len(counts)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        bins = np.repeat(np.array([blob[0] for blob in blobs], dtype=np.intp), lengths) + offsets
+        # The seconds have the bins of the counts, the samples of rows written before them are spread over the bucket
+        width = dict(LEVELS)[table]
+        seconds = np.concatenate([
+            np.frombuffer(time_blob[1:], HISTOGRAM_SECONDS) if time_blob is not None else
+            np.frombuffer(blob[1:], HISTOGRAM_COUNT) * (width / max(count, 1))
+            for blob, time_blob, count in zip(blobs, time_blobs, samples)
+        ])
+        return Aggregate.from_rows(keys, names, samples, samples * np.array(averages, dtype=float),
+                                   np.array(maxima, dtype=float), rows, bins, counts, seconds)
+
+    def read_raw(self, start, end, by, process):
+        """
+        Read the raw samples of a partial minute, from the partitions and the segments of the columnar backend
+        A raw sample stands for the mean seconds of the samples of its process in the 1 minute rollup
+        """
+        rows = self.read_partitions(start, end, process)
+        for columns in columnar_store.scan(self.database_name, start, end, process):
+            rows.extend(zip(columns['host'].tolist(), columns['pid'].tolist(), columns['name'].tolist(),
+                            columns['usage'].tolist()))
+        if not rows:
+            return Aggregate.empty()
+        hosts, pids, process_names, workloads = zip(*rows)
+        grouping = GROUPINGS[by]
+        keys = [grouping(*row) for row in zip(hosts, pids, process_names)]
+        durations = self.sample_seconds(start)
+        seconds = np.fromiter((durations.get(key, 0.0) for key in zip(hosts, pids)), float, len(rows))
+        workloads = np.array(workloads, dtype=float)
+        bins = np.clip((workloads / HISTOGRAM_BIN_WIDTH).astype(np.intp), 0, HISTOGRAM_BINS - 1)
+        return Aggregate.from_rows(keys, process_names, np.ones(len(workloads)), workloads, workloads,
+                                   np.arange(len(workloads)), bins, np.ones(len(workloads)), seconds)
+
+    def sample_seconds(self, start):
+        """
+        :param start: timestamp in the minute
+        :return: dict {(host, pid): mean seconds of its samples} from the 1 minute rollup bucket of a timestamp
+        """
+        table, width = LEVELS[-1]
+        bucket = math.floor(start / width) * width
+        durations = {}
+        for host, pid, samples, time_blob in self.connection.execute(
+            f"SELECT Host, PID, Samples, TimeHistogram FROM {table} WHERE Bucket = ?", (bucket,)
+        ):
+            # Rows written before the seconds were added spread their samples over the bucket
+            total = np.frombuffer(time_blob[1:], HISTOGRAM_SECONDS).sum() if time_blob is not None else width
+            durations[host, pid] = float(total) / max(samples, 1)
+        return durations
+
+    def read_partitions(self, start, end, process):
+        """
+        Without a process name, the PIDs are taken from the 1 minute rollup, so the samples are read from the index
+        on (PID, Timestamp) instead of scanning the partition
+        :return: list of (host, pid, name, workload) of the raw samples in the partitions
+        """
+        names = overlapping_partitions(self.connection, start, end)
+        if not names:
+            return []
+        if process is not None:
+            conditions = [("ProcessName = ?", [process])]
+        else:
+            table, width = LEVELS[-1]
+            bucket = math.floor(start / width) * width
+            pids = [pid for pid, in self.connection.execute(
+                f"SELECT DISTINCT PID FROM {table} WHERE Bucket = ?", (bucket,)
+            )]
+            conditions = [
+                (f"PID IN ({', '.join('?' * len(chunk))})", chunk)
+                for chunk in (pids[i:i + MAX_QUERY_PIDS] for i in range(0, len(pids), MAX_QUERY_PIDS))
+            ]
+        rows = []
+        for name in names:
+            for condition, parameters in conditions:
+                rows.extend(self.connection.execute(
+                    f"SELECT Host, PID, ProcessName, Workload FROM {name} "
+                    f"WHERE {condition} AND Timestamp >= ? AND Timestamp < ?", (*parameters, start, end)
+                ))
+        return rows
+
+    def aggregate(self, start, end, by='name', process=None):
+        """
+        :return: Aggregate of a window, see statistics()
+        """
+        return Aggregate.merge([self.segment(table, segment_start, segment_end, by, process)
+                                for table, segment_start, segment_end in self.plan(start, end)])
+
+    def statistics(self, start, end, threshold=DEFAULT_THRESHOLD, by='name', process=None):
+        """
+        :param start: window start timestamp
+        :param end: window end timestamp
+        :param threshold: CPU usage in percent, the time above it is counted
+        :param by: 'name' for statistics per process name, 'host' per host and process name, 'pid' per process,
+                   see GROUPINGS
+        :param process: statistics of this process name only, None for all
+        :return: list of dicts, one per process, with the keys 'name', 'host' unless by is 'name',
+                 'pid' if by is 'pid', and STATISTICS;
+                 time_above in seconds, percentiles are None without histograms
+        """
+        aggregate = self.aggregate(start, end, by, process)
+        if not aggregate.keys:
+            return []
+        histograms = aggregate.histograms
+        counted = histograms.sum(axis=1)
+        cumulative = np.cumsum(histograms, axis=1)
+        columns = {
+            'samples': aggregate.samples.astype(int),
+            'mean': aggregate.totals / np.maximum(aggregate.samples, 1),
+            'max': aggregate.maxima,
+        }
+        for column, fraction in PERCENTILES.items():
+            # Nearest rank, like the p95 of the rollups, the value is the middle of its bin, at most the max
+            rank = np.maximum(np.ceil(fraction * counted), 1)
+            bins = (cumulative < rank[:, None]).sum(axis=1)
+            columns[column] = np.minimum((bins + 0.5) * HISTOGRAM_BIN_WIDTH, aggregate.maxima)
+        # Samples are spread evenly in the bin of the threshold
+        position = min(max(threshold / HISTOGRAM_BIN_WIDTH, 0.0), HISTOGRAM_BINS - 1.0)
+        threshold_bin = int(position)
+        seconds = aggregate.seconds
+        above = seconds[:, threshold_bin + 1:].sum(axis=1) + \
+            seconds[:, threshold_bin] * (1.0 - (position - threshold_bin))
+        # Rows without histograms count in the same proportion as the others
+        columns['time_above'] = above * aggregate.samples / np.maximum(counted, 1)
+        results = []
+        for row, (key, name) in enumerate(zip(aggregate.keys, aggregate.names)):
+            result = {'name': name}
+            if by != 'name':
+                result['host'] = key[0]
+            if by == 'pid':
+                result['pid'] = key[1]
+            for column in STATISTICS:
+                result[column] = columns[column][row].item()
+            if not counted[row]:
+                for column in PERCENTILES:
+                    result[column] = None
+            results.append(result)
+        return results
+
+    def worst(self, start, end, key='p95', limit=10, threshold=DEFAULT_THRESHOLD, by='name'):
+        """
+        :param key: statistic the processes are ranked by, one of STATISTICS
+        :param limit: number of processes returned
+        :return: the processes with the highest statistic over the window, see statistics()
+        """
+        results = self.statistics(start, end, threshold=threshold, by=by)
+        results.sort(key=lambda result: -1.0 if result[key] is None else result[key], reverse=True)
+        return results[:limit]
@@ -0,0 +1,45 @@
+import logging
+import sqlite3
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+import db_backup
+
+logger = logging.getLogger(__name__)
+
+
+# noinspection PyUnresolvedReferences
+class BackupWorker(QThread):
+    """
+    Backs up the database on a worker thread, see db_backup
+    Neither the GUI nor the collection of samples is paused meanwhile
+    """
+
+    # Percent of the backup done
+    progress = pyqtSignal(int)
+    # Archive name, empty if the backup failed
+    finished_backup = pyqtSignal(str)
+
+    def __init__(self, database_name, incremental=False, parent=None):
+        """
+        :param database_name: path to the database
+        :param incremental: archive only the data added since the last backup
+        :param parent: parent object
+        """
+        super().__init__(parent)
+        self.database_name = database_name
+        self.incremental = incremental
+
+    def run(self):
+        backup_file = db_backup.backup_file_name(self.database_name, incremental=self.incremental)
+        backup = db_backup.incremental_backup if self.incremental else db_backup.full_backup
+        try:
+            backup(self.database_name, backup_file, progress=self.report_progress)
+        except (sqlite3.Error, OSError) as e:
+            logger.error("Failed to back up database: %s", e)
+            self.finished_backup.emit("")
+        else:
+            self.finished_backup.emit(backup_file)
+
+    def report_progress(self, done, total):
+        self.progress.emit(int(done * 100 / total) if total else 100)
@@ -0,0 +1,542 @@
+import calendar
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where the segments are locked with msvcrt
+    fcntl = None
+    import msvcrt
+
+from sqlite_store import SQLiteStore, LOCAL_HOST
+
+# Segment format, one append-only file per UTC day in the directory <database>-columns:
+#   header: magic, format version
+#   chunks: chunk header, then the payload, all little-endian:
+#     strings first used in the chunk, process names and hosts, uint16 length + UTF-8,
+#     numbered in the order of the file
+#     series first seen in the chunk, numbered in the order of the file:
+#     PIDs int32, process name numbers uint32, host numbers uint32
+#     timestamps of the ticks in milliseconds, delta-of-delta encoded after the first one, kept in the header
+#     rows per tick
+#     series number of every row
+#     usage of every row in hundredths of a percent
+#   The integer columns after the series have the narrowest type holding their values, see DTYPES
+# A chunk cut short by a crash is ignored by the readers, and overwritten by the next write
+SEGMENT_MAGIC = b"CPUSEG"
+SEGMENT_VERSION = 1
+SEGMENT_HEADER = struct.Struct("<6sH")
+# First and last tick in milliseconds, counts of ticks, rows, new strings and new series,
+# type codes of the delta-of-deltas, rows per tick, series numbers and usages, payload size
+SEGMENT_CHUNK = struct.Struct("<qqIIIIBBBBI")
+SEGMENT_STRING = struct.Struct("<H")
+SEGMENT_EXTENSION = ".cpus"
+# Segments are kept in a directory named after the SQLite database
+SEGMENT_DIRECTORY_SUFFIX = "-columns"
+SEGMENT_PREFIX = "CpuWorkload_"
+# Integer types of the encoded columns, the code in the chunk header is the index, narrowest first
+DTYPES = tuple(np.dtype(code) for code in ('<u1', '<i1', '<u2', '<i2', '<u4', '<i4', '<i8'))
+# Usage is stored in hundredths of a percent
+USAGE_SCALE = 100
+# Locks of Windows are mandatory: the byte locked is far beyond the end of the segment, so readers are not blocked
+WINDOWS_LOCK_OFFSET = 1 << 40
+
+
+def segment_directory(database_name):
+    """
+    :param database_name: path to the SQLite database
+    :return: directory of the segments of the database
+    """
+    return database_name + SEGMENT_DIRECTORY_SUFFIX
+
+
+def segment_files(directory, start=None, end=None):
+    """
+    :param directory: directory of the segments
+    :param start: range start timestamp, None for unbounded
+    :param end: range end timestamp, None for unbounded
+    :return: dict {day start: path} of the segments overlapping the time range, oldest first
+    """
+    if not os.path.isdir(directory):
+        return {}
+    segments = {}
+    for filename in os.listdir(directory):
+        if not filename.startswith(SEGMENT_PREFIX) or not filename.endswith(SEGMENT_EXTENSION):
+            continue
+        try:
+            day = time.strptime(filename[len(SEGMENT_PREFIX):-len(SEGMENT_EXTENSION)], '%Y%m%d')
+        except ValueError:
+            continue
+        day_start = calendar.timegm(day)
+        if (start is None or day_start + SQLiteStore.PARTITION_SECONDS > start) and \
+                (end is None or day_start < end):
+            segments[day_start] = os.path.join(directory, filename)
+    return dict(sorted(segments.items()))
+
+
+def scan(database_name, start=None, end=None, process_name=None):
+    """
+    Read the samples kept in the segments of a database, e.g. to export them
+    :param database_name: path to the SQLite database
+    :param start: range start timestamp, None for unbounded
+    :param end: range end timestamp, None for unbounded
+    :param process_name: samples of this process name only, None for all
+    :return: generator of dicts of columns, see Segment.scan()
+    """
+    for path in segment_files(segment_directory(database_name), start, end).values():
+        segment = Segment(path)
+        try:
+            yield from segment.scan(start, end, process_name)
+        finally:
+            segment.close()
+
+
+def count(database_name, start=None, end=None, process_name=None):
+    """
+    Count the samples kept in the segments of a database, mostly from the chunk headers, see Segment.count()
+    :return: number of samples scan() would return
+    """
+    total = 0
+    for path in segment_files(segment_directory(database_name), start, end).values():
+        segment = Segment(path)
+        try:
+            total += segment.count(start, end, process_name)
+        finally:
+            segment.close()
+    return total
+
+
+def narrowest(values):
+    """
+    :param values: NumPy array of integers
+    :return: code of the narrowest type of DTYPES holding the values
+    """
+    low, high = (int(values.min()), int(values.max())) if len(values) else (0, 0)
+    for code, dtype in enumerate(DTYPES):
+        limits = np.iinfo(dtype)
+        if limits.min <= low and high <= limits.max:
+            return code
+    raise ValueError(f"Values out of the range of the segment columns: {low}..{high}")
+
+
+@contextmanager
+def locked(file):
+    """
+    Exclusive lock of a segment file, writers of other processes wait until it is released
+    :param file: segment file opened for writing
+    """
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+        return
+    file.seek(WINDOWS_LOCK_OFFSET)
+    # Retried for 10 seconds, then OSError is raised
+    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+    try:
+        yield
+    finally:
+        file.seek(WINDOWS_LOCK_OFFSET)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class Segment:
+    """
+    Samples of one UTC day, appended in chunks to one file
+    The strings, the series and the time index of the chunks are parsed once, then as chunks are appended,
+    by this process or another one; the columns are decoded from a memory map of the file
+    Several processes may append to the same segment, e.g. the GUI, a collector and an import:
+    each chunk is appended under an exclusive lock of the file, after the chunks of the others were parsed,
+    so the numbers of the strings and the series stay those of the file
+    """
+
+    def __init__(self, path):
+        """
+        :param path: segment file, created by the first append() if it does not exist
+        """
+        self.path = path
+        self.strings = []
+        self.string_numbers = {}  # {string: number}
+        self.series = {}  # {(host, pid, process name): series number}
+        self.series_columns = ([], [], [])  # PIDs, name numbers and host numbers of the series
+        self.series_arrays = None  # NumPy arrays of the series columns and the strings, see arrays()
+        self.chunks = []  # (first tick, last tick, tick count, row count, type codes, offset of the columns)
+        self.end = 0  # Offset after the last complete chunk
+        self.map = None
+        self.file = None  # Opened by the first append()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.map = None
+
+    def refresh(self):
+        """
+        Parse the chunks appended since the last refresh, a chunk not written completely yet is left for later
+        :raise ValueError: if the file is not a segment
+        """
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size < SEGMENT_HEADER.size:
+            return
+        if self.map is None or len(self.map) != size:
+            # The file grew, or a chunk cut short by a crash was truncated by a writer
+            # Views of the previous map keep it alive until they are released
+            with open(self.path, 'rb') as file:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = self.map
+        size = len(buffer)
+        if size <= self.end:
+            return
+        if self.end == 0:
+            magic, version = SEGMENT_HEADER.unpack_from(buffer, 0)
+            if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+                raise ValueError(f"Not a CPU workload segment: {self.path}")
+            self.end = SEGMENT_HEADER.size
+        offset = self.end
+        while offset + SEGMENT_CHUNK.size <= size:
+            first, last, ticks, rows, string_count, series_count, *codes, payload = \
+                SEGMENT_CHUNK.unpack_from(buffer, offset)
+            position = offset + SEGMENT_CHUNK.size
+            if position + payload > size:
+                break
+            for _ in range(string_count):
+                length, = SEGMENT_STRING.unpack_from(buffer, position)
+                position += SEGMENT_STRING.size
+                self.add_string(buffer[position:position + length].decode('utf-8'))
+                position += length
+            series = []
+            for dtype in ('<i4', '<u4', '<u4'):
+                series.append(np.frombuffer(buffer, dtype=dtype, count=series_count, offset=position).tolist())
+                position += 4 * series_count
+            for pid, name, host in zip(*series):
+                self.add_series(self.strings[host], pid, self.strings[name], name, host)
+            self.chunks.append((first, last, ticks, rows, codes, position))
+            offset += SEGMENT_CHUNK.size + payload
+        self.end = offset
+
+    def add_string(self, string):
+        self.string_numbers[string] = len(self.strings)
+        self.strings.append(string)
+
+    def add_series(self, host, pid, name, name_number, host_number):
+        self.series[(host, pid, name)] = len(self.series)
+        for column, value in zip(self.series_columns, (pid, name_number, host_number)):
+            column.append(value)
+
+    def arrays(self):
+        """
+        :return: PIDs, name numbers and host numbers of the series and the strings, as NumPy arrays
+        """
+        if self.series_arrays is None or len(self.series_arrays[0]) != len(self.series):
+            pids, names, hosts = self.series_columns
+            strings = np.empty(len(self.strings), dtype=object)
+            strings[:] = self.strings
+            self.series_arrays = (np.array(pids, dtype=np.int64), np.array(names, dtype=np.intp),
+                                  np.array(hosts, dtype=np.intp), strings)
+        return self.series_arrays
+
+    def append(self, records):
+        """
+        Append records as one chunk, the rows are ordered by timestamp
+        :param records: CPU usage records of the day of the segment
+        """
+        if self.file is None:
+            # In append mode every write goes to the end of the file, wherever other writers left it
+            self.file = open(self.path, 'ab')
+        with locked(self.file):
+            self.refresh()
+            if not self.end:
+                self.file.truncate(0)
+                self.file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION))
+                self.end = SEGMENT_HEADER.size
+            else:
+                # A chunk cut short by a crash is overwritten
+                self.file.truncate(self.end)
+            self.write_records(records)
+
+    def write_records(self, records):
+        """
+        Encode records and write them as one chunk at the end of the file, the file must be locked
+        :param records: CPU usage records of the day of the segment
+        """
+        payload = []
+        first_string, first_series = len(self.strings), len(self.series)
+        series = self.series
+        numbers = []
+        for record in records:
+            key = (record.get('host', LOCAL_HOST), record['pid'], record['name'])
+            number = series.get(key)
+            if number is None:
+                number = len(series)
+                host, pid, name = key
+                for string in (name, host):
+                    if string not in self.string_numbers:
+                        self.add_string(string)
+                        encoded = string.encode('utf-8')
+                        payload.append(SEGMENT_STRING.pack(len(encoded)) + encoded)
+                self.add_series(host, pid, name, self.string_numbers[name], self.string_numbers[host])
+            numbers.append(number)
+        for column, dtype in zip(self.series_columns, ('<i4', '<u4', '<u4')):
+            payload.append(np.array(column[first_series:], dtype=dtype).tobytes())
+        position = self.end + SEGMENT_CHUNK.size + sum(len(part) for part in payload)
+
+        count = len(records)
+        milliseconds = np.rint(np.fromiter((record['timestamp'] for record in records), float, count) * 1000)
+        usages = np.rint(np.fromiter((record['usage'] for record in records), float, count) * USAGE_SCALE)
+        order = np.argsort(milliseconds, kind='stable')
+        ticks, counts = np.unique(milliseconds[order].astype(np.int64), return_counts=True)
+        columns = (
+            np.diff(np.diff(ticks), prepend=0),
+            counts,
+            np.array(numbers, dtype=np.int64)[order],
+            usages[order].astype(np.int64),
+        )
+        codes = [narrowest(column) for column in columns]
+        for column, code in zip(columns, codes):
+            payload.append(column.astype(DTYPES[code]).tobytes())
+        payload = b"".join(payload)
+        header = SEGMENT_CHUNK.pack(int(ticks[0]), int(ticks[-1]), len(ticks), count,
+                                    len(self.strings) - first_string, len(self.series) - first_series,
+                                    *codes, len(payload))
+        self.file.write(header + payload)
+        self.file.flush()
+        self.chunks.append((int(ticks[0]), int(ticks[-1]), len(ticks), count, codes, position))
+        self.end += len(header) + len(payload)
+
+    def scan(self, start=None, end=None, process_name=None):
+        """
+        Decode the chunks overlapping a time range, the chunks outside are skipped by their first and last tick
+        :param start: range start timestamp, None for unbounded
+        :param end: range end timestamp, None for unbounded
+        :param process_name: samples of this process name only, None for all
+        :return: generator of dicts of NumPy columns, one per chunk with samples in the range:
+                 'timestamp', 'pid', 'name', 'host' (arrays of strings) and 'usage', ordered by timestamp
+        """
+        self.refresh()
+        if process_name is not None and process_name not in self.string_numbers:
+            return
+        pids, names, hosts, strings = self.arrays()
+        wanted = names == self.string_numbers[process_name] if process_name is not None else None
+        for first, last, ticks, rows, codes, position in self.chunks:
+            if (start is not None and last < start * 1000) or (end is not None and first >= end * 1000):
+                continue
+            timestamps, series, usages = self.decode(first, ticks, rows, codes, position)
+            mask = wanted[series] if wanted is not None else None
+            if start is not None and first < start * 1000:
+                mask = timestamps >= start if mask is None else mask & (timestamps >= start)
+            if end is not None and last >= end * 1000:
+                mask = timestamps < end if mask is None else mask & (timestamps < end)
+            if mask is not None:
+                timestamps, series, usages = timestamps[mask], series[mask], usages[mask]
+            if len(series):
+                yield {'timestamp': timestamps, 'pid': pids[series], 'name': strings[names[series]],
+                       'host': strings[hosts[series]], 'usage': usages}
+
+    def count(self, start=None, end=None, process_name=None):
+        """
+        Count the samples in a time range from the row counts of the chunk headers,
+        only the chunks crossing the range bounds are decoded, and the series numbers when filtered by process name
+        :param start: range start timestamp, None for unbounded
+        :param end: range end timestamp, None for unbounded
+        :param process_name: samples of this process name only, None for all
+        :return: number of samples scan() would return
+        """
+        self.refresh()
+        if process_name is not None and process_name not in self.string_numbers:
+            return 0
+        _, names, _, _ = self.arrays()
+        wanted = names == self.string_numbers[process_name] if process_name is not None else None
+        total = 0
+        for first, last, ticks, rows, codes, position in self.chunks:
+            if (start is not None and last < start * 1000) or (end is not None and first >= end * 1000):
+                continue
+            if (start is not None and first < start * 1000) or (end is not None and last >= end * 1000):
+                timestamps, series, _ = self.decode(first, ticks, rows, codes, position)
+                mask = wanted[series] if wanted is not None else np.ones(rows, dtype=bool)
+                if start is not None:
+                    mask &= timestamps >= start
+                if end is not None:
+                    mask &= timestamps < end
+                total += int(np.count_nonzero(mask))
+            elif wanted is not None:
+                # The series numbers follow the delta-of-deltas and the rows per tick
+                position += (ticks - 1) * DTYPES[codes[0]].itemsize + ticks * DTYPES[codes[1]].itemsize
+                series = np.frombuffer(self.map, dtype=DTYPES[codes[2]], count=rows, offset=position)
+                total += int(np.count_nonzero(wanted[series]))
+            else:
+                total += rows
+        return total
+
+    def decode(self, first, ticks, rows, codes, position):
+        """
+        :return: timestamps, series numbers and usages of the rows of a chunk
+        """
+        columns = []
+        for count, code in zip((ticks - 1, ticks, rows, rows), codes):
+            columns.append(np.frombuffer(self.map, dtype=DTYPES[code], count=count, offset=position))
+            position += columns[-1].nbytes
+        deltas_of_deltas, counts, series, usages = columns
+        milliseconds = np.empty(ticks, dtype=np.int64)
+        milliseconds[0] = first
+        np.cumsum(np.cumsum(deltas_of_deltas, dtype=np.int64), out=milliseconds[1:])
+        milliseconds[1:] += first
+        timestamps = np.repeat(milliseconds, counts) / 1000.0
+        return timestamps, series.astype(np.intp), usages / USAGE_SCALE
+
+
+class ColumnarStore(SQLiteStore):
+    """
+    Metrics database keeping the raw CPU usage samples in columnar segments instead of the CpuWorkload partitions,
+    a few bytes per sample instead of a row repeating the process name, see the segment format above
+    The rollups, the other metrics, the family totals, the system tables and the hosts stay in the SQLite database,
+    so the analytics and the history beyond the raw range work the same with both backends
+    Samples are buffered per day until the buffer spans CHUNK_SECONDS or holds CHUNK_ROWS, then appended as one chunk,
+    the rollups are updated by every batch: at most CHUNK_SECONDS of raw samples are lost if the process crashes,
+    and other processes, e.g. the export, see the raw samples once their chunk is written
+    The CpuWorkload partitions written by the SQLite backend before are still read and expired
+    """
+
+    CHUNK_SECONDS = 60
+    CHUNK_ROWS = 65536
+
+    def __init__(self, database_name, retention=SQLiteStore.DEFAULT_RETENTION):
+        """
+        :param database_name: path to the SQLite database file, the segments are kept next to it
+        :param retention: seconds the raw samples are kept
+        """
+        super().__init__(database_name, retention=retention)
+        self.directory = segment_directory(database_name)
+        self.segments = {}  # {day start: Segment}
+        self.pending = {}  # {day start: records not written to the segment yet}
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        super().open()
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
+        super().close()
+
+    def flush(self):
+        """
+        Append the buffered samples to the segments
+        """
+        for start in list(self.pending):
+            self.write_chunk(start)
+
+    def insert_samples(self, records):
+        """
+        Buffer the raw CPU usage samples, the buffers due are appended to the segments
+        :param records: CPU usage records, without the family totals
+        :return: True if a segment was created, the retention is applied then
+        """
+        for record in records:
+            self.pending.setdefault(self.partition_start(record['timestamp']), []).append(record)
+        latest = max(record['timestamp'] for record in records)
+        created = False
+        for start, pending in list(self.pending.items()):
+            if len(pending) >= self.CHUNK_ROWS or latest - pending[0]['timestamp'] >= self.CHUNK_SECONDS:
+                created |= self.write_chunk(start)
+        return created
+
+    def write_chunk(self, start):
+        """
+        Append the buffered samples of a day to its segment
+        :param start: day start timestamp
+        :return: True if the segment was created
+        """
+        records = self.pending.pop(start)
+        segment = self.segment(start)
+        created = not os.path.exists(segment.path)
+        segment.append(records)
+        return created
+
+    def read_workloads(self, connection, host, pid, start, end):
+        """
+        Read the raw CPU usage samples of a process from the partitions, the segments and the buffered samples,
+        see RollupAccumulator.load()
+        :return: list of workloads in the time range
+        """
+        workloads = list(super().read_workloads(connection, host, pid, start, end))
+        for day_start in segment_files(self.directory, start, end):
+            for columns in self.segment(day_start).scan(start, end):
+                mask = (columns['pid'] == pid) & (columns['host'] == host)
+                workloads.extend(columns['usage'][mask].tolist())
+        workloads.extend(
+            record['usage'] for records in self.pending.values() for record in records
+            if record['pid'] == pid and record.get('host', LOCAL_HOST) == host and start <= record['timestamp'] < end
+        )
+        return workloads
+
+    def segment(self, start):
+        """
+        :param start: day start timestamp
+        :return: Segment of the day, its file is created by the first append
+        """
+        segment = self.segments.get(start)
+        if segment is None:
+            path = os.path.join(self.directory, SEGMENT_PREFIX + time.strftime('%Y%m%d', time.gmtime(start)) +
+                                SEGMENT_EXTENSION)
+            segment = self.segments[start] = Segment(path)
+        return segment
+
+    def apply_retention(self, now):
+        """
+        Delete the segments older than the retention as well
+        :param now: current timestamp
+        """
+        super().apply_retention(now)
+        for start, path in segment_files(self.directory).items():
+            if start + self.PARTITION_SECONDS <= now - self.retention:
+                self.delete_segment(start, path)
+
+    def delete_segment(self, start, path):
+        self.pending.pop(start, None)
+        segment = self.segments.pop(start, None)
+        if segment is not None:
+            segment.close()
+        os.remove(path)
+
+    def cleanup(self):
+        """
+        Delete all data from the database and the segments
+        """
+        super().cleanup()
+        for start, path in segment_files(self.directory).items():
+            self.delete_segment(start, path)
+        self.pending = {}
+
+    def query_history(self, process_name, start, end):
+        """
+        Read the history of a process, see SQLiteStore.query_history()
+        Raw samples are read from the segments overlapping the range, the samples still buffered
+        and the partitions written by the SQLite backend
+        """
+        if end - start > 2 * 3600:
+            return super().query_history(process_name, start, end)
+        rows = super().query_history(process_name, start, end)
+        for day_start in segment_files(self.directory, start, end):
+            for columns in self.segment(day_start).scan(start, end, process_name):
+                usages = columns['usage'].tolist()
+                rows.extend(zip(columns['timestamp'].tolist(), columns['pid'].tolist(), usages, usages, usages,
+                                usages))
+        rows.extend(
+            (record['timestamp'], record['pid'], record['usage'], record['usage'], record['usage'], record['usage'])
+            for records in self.pending.values() for record in records
+            if record['name'] == process_name and start <= record['timestamp'] < end
+        )
+        rows.sort(key=lambda row: row[0])
+        return rows
@@ -1,43 +1,633 @@
-from PyQt5.QtWidgets import QWidget, QVBoxLayout
-import matplotlib.pyplot as plt
+import heapq
+import time
 
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QComboBox, QLabel
 
+from cpu_sampler import PROCESS_METRICS, CPU_METRIC
+from instrumentation import stats, RENDER, DRAW
+
+# Views of the tree mode, other views drill down to the processes of one family, identified by its root PID
+ALL_PROCESSES = 'processes'
+ALL_FAMILIES = 'families'
+# Modes of the chart: one line per process, lines of the heaviest processes only, or one heatmap row per process
+LINES_MODE = 'lines'
+TOP_MODE = 'top'
+HEATMAP_MODE = 'heatmap'
+# Lines of the top mode, ranked by their mean over the last TOP_SECONDS and ranked again as often
+TOP_LINES = 10
+TOP_SECONDS = 10
+# Rows of the heatmap labelled with their process at most, the labels of more rows would overlap
+HEATMAP_LABELS = 30
+
+
+# noinspection PyUnresolvedReferences
 class CPUChartWidget(QWidget):
     """
     Widget to display the CPU usage chart
-    Legend: x-axis: time (ticks), y-axis: CPU usage (%)
-    Automatically scales charts and provide legend
+    Legend: x-axis: time of day, y-axis: CPU usage (%) or another per-process metric chosen in the combo box
+    Shows a sliding time window with one persistent line per process
+    In tree mode, one line per family of a watched process is shown instead,
+    and the view combo box drills down to the processes of one family
+    Keeps its own bounded history of every metric, fed one tick at a time
+    Between full redraws only the lines are redrawn over a cached background (blitting),
+    so the frame time does not depend on how long the monitor has been running
+    With hundreds of processes, the top mode shows the lines of the heaviest ones only,
+    and the heatmap mode one row per process in a single image, whose columns are shifted in place as ticks arrive,
+    so the frame time depends on the pixels, not on the number of processes
+    The figure is a bare matplotlib Figure on its own canvas, without pyplot and its global figures;
+    matplotlib is imported and the figure created once the widget was first painted, see create_figure(),
+    NumPy with the histories, on the first tick
     """
 
-    def __init__(self, parent=None):
+    # Fraction of the window left empty on the right, the axes are shifted when it fills up
+    HEADROOM = 0.1
+    # Share of the time spent in full redraws at most, full redraws are spaced by their own duration accordingly:
+    # ticks replayed faster than real time shift the axes many times per second
+    MAX_DRAW_SHARE = 0.2
+
+    def __init__(self, parent=None, window=300, interval=1, max_fps=10):
         """
-        The construction subplot(111) is a shorthand notation
-        for creating a subplot on a 1x1 grid at the 1st position.
-        This notation is equivalent to specifying add_subplot(nrows=1, ncols=1, index=1)
         :param parent: parent widget
+        :param window: seconds of history displayed
+        :param interval: expected interval between ticks in seconds
+        :param max_fps: maximal number of redraws per second, ticks arriving faster are coalesced
         """
         super().__init__(parent)
-        self.cpu_chart = plt.figure()
-        self.cpu_ax = self.cpu_chart.add_subplot(111)
+        self.window = window
+        self.interval = interval
+        self.histories = {}  # {metric: store}, created by the first tick, see history_of()
+        self.metric = CPU_METRIC
+        self.family_histories = {}  # {metric: store of the family totals by root PID}
+        self.families = {}  # {root: (name, member PIDs)} of the last tick in tree mode
+        self.family_names = {}  # {root: name}, kept for the families which exited
+        self.view = ALL_PROCESSES
+        self.mode = LINES_MODE
+        self.lines = {}  # {pid or family root: Line2D}
+        self.top_keys = None  # Keys of the lines of the top mode, see heaviest()
+        self.top_ranked_at = None
+        self.heatmap = None  # One row per process or family and one column per interval, see reset_heatmap()
+        self.heatmap_rows = {}  # {pid or family root: row}
+        self.heatmap_end = None  # Timestamp of the last column
+        self.heatmap_changed = False  # Rows were added since the last frame
+        self.latest = None  # Newest timestamp received
+        self.background = None  # Cached axes without the lines
+        self.min_frame_interval = 1.0 / max_fps
+        self.last_frame = 0.0
+        self.draw_pending = False
+        self.last_draw = 0.0  # Time and duration of the last full redraw
+        self.draw_duration = 0.0
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.render_frame)
+        # Created by create_figure(), ticks received before are kept in the histories
+        self.cpu_chart = None
+        self.cpu_ax = None
+        self.canvas = None
+        # Created on the first switch to the heatmap mode
+        self.heatmap_ax = None
+        self.image = None
+        self.colorbar = None
+
+        # Metric shown in the chart
+        self.metric_combo = QComboBox()
+        self.metric_combo.addItem("CPU Usage (%)", CPU_METRIC)
+        for metric, (label, _, _, _) in PROCESS_METRICS.items():
+            self.metric_combo.addItem(label, metric)
+        self.metric_combo.currentIndexChanged.connect(self.select_metric)
+
+        # Lines or heatmap
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItem("All Lines", LINES_MODE)
+        self.mode_combo.addItem(f"Top {TOP_LINES} Lines", TOP_MODE)
+        self.mode_combo.addItem("Heatmap", HEATMAP_MODE)
+        self.mode_combo.currentIndexChanged.connect(self.select_mode)
+
+        # Families or processes shown in tree mode
+        self.view_combo = QComboBox()
+        self.view_combo.setHidden(True)
+        self.view_combo.currentIndexChanged.connect(self.select_view)
+
+        # Takes the place of the canvas until the figure is created
+        self.placeholder = QLabel("Loading chart...")
+        self.placeholder.setAlignment(Qt.AlignCenter)
+
         self.setLayout(QVBoxLayout())
-        self.layout().addWidget(self.cpu_chart.canvas)
-
-    def update_chart(self, cpu_usage_history: list):
-        """
-        Accepts a list of dictionaries containing CPU usage of each process
-        Usually updates with single point
-        :param cpu_usage_history: list of PID and payload, e.g. [{1: 10, 2: 20}, {1: 20, 2: 30}]
-        """
-        self.cpu_ax.clear()
-        for pid, usage_tuple in cpu_usage_history[-1].items():
-            # Unpack the tuple
-            usage, _ = usage_tuple
-            self.cpu_ax.plot(
-                range(len(cpu_usage_history)), [
-                    process_usage.get(pid, 0)[0] for process_usage in cpu_usage_history
-                ], label=f"Process {pid}"
-            )
-        self.cpu_ax.set_xlabel('Time (ticks)')
-        self.cpu_ax.set_ylabel('CPU Usage (%)')
-        self.cpu_ax.legend()
-        self.cpu_chart.canvas.draw()
+        self.layout().addWidget(self.metric_combo)
+        self.layout().addWidget(self.mode_combo)
+        self.layout().addWidget(self.view_combo)
+        self.layout().addWidget(self.placeholder, 1)
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.canvas is None:
+            # Once the window is painted: importing matplotlib takes about half a second
+            QTimer.singleShot(0, self.create_figure)
+
+    def create_figure(self):
+        """
+        Import matplotlib, create the figure and draw the history received so far
+        """
+        if self.canvas is not None:
+            return
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+        from matplotlib.figure import Figure
+        from matplotlib.ticker import FuncFormatter
+
+        self.cpu_chart = Figure()
+        self.canvas = FigureCanvasQTAgg(self.cpu_chart)
+        self.cpu_ax = self.cpu_chart.add_subplot()
+        self.cpu_ax.set_xlabel('Time')
+        self.cpu_ax.xaxis.set_major_formatter(FuncFormatter(format_timestamp))
+        self.set_y_axis()
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.layout().replaceWidget(self.placeholder, self.canvas)
+        self.placeholder.deleteLater()
+        self.placeholder = None
+        self.reset_lines()
+
+    @property
+    def history(self):
+        """
+        History of the metric shown
+        """
+        return self.history_of(self.metric)
+
+    def history_of(self, metric):
+        history = self.histories.get(metric)
+        if history is None:
+            from time_series import TimeSeriesStore
+
+            history = self.histories[metric] = TimeSeriesStore(retention=self.window, interval=self.interval)
+        return history
+
+    def family_history_of(self, metric):
+        history = self.family_histories.get(metric)
+        if history is None:
+            from time_series import TimeSeriesStore
+
+            history = self.family_histories[metric] = TimeSeriesStore(retention=self.window, interval=self.interval)
+        return history
+
+    def set_interval(self, interval):
+        """
+        Size the histories for ticks coming every interval seconds, the histories are started again if it changed
+        :param interval: expected interval between ticks in seconds
+        """
+        if interval == self.interval:
+            return
+        self.interval = interval
+        self.histories = {}
+        self.family_histories = {}
+        self.reset_lines()
+
+    def update_chart(self, cpu_usage: dict):
+        """
+        Accepts CPU usage of each process for a single tick
+        The chart is redrawn at most max_fps times per second
+        :param cpu_usage: PID and payload, e.g. {1: (10.0, 1700000000.0), 2: (20.0, 1700000000.0)}
+        """
+        stats.delivered('new_data')
+        if not cpu_usage:
+            return
+        self.history_of(CPU_METRIC).append_tick(cpu_usage)
+        self.latest = max(timestamp for _, timestamp in cpu_usage.values())
+        if self.metric == CPU_METRIC and self.view != ALL_FAMILIES:
+            self.heatmap_tick(cpu_usage)
+        self.schedule_frame()
+
+    def update_metrics(self, series: dict):
+        """
+        Accepts the other per-process metrics for a single tick
+        :param series: metric, PID and payload, e.g. {'threads': {1: (4, 1700000000.0)}}
+        """
+        for metric, values in series.items():
+            self.history_of(metric).append_tick(values)
+            if metric == self.metric and self.view != ALL_FAMILIES:
+                self.heatmap_tick(values)
+        if self.metric in series:
+            self.schedule_frame()
+
+    def update_families(self, families: dict, series: dict):
+        """
+        Accepts the families of the tree mode and their totals for a single tick
+        The first families received switch the chart to one line per family
+        :param families: root PID and (name, member PIDs), e.g. {1: ('nginx', (1, 2, 3))}
+        :param series: metric, root PID and payload, e.g. {'cpu': {1: (30.0, 1700000000.0)}}
+        """
+        for metric, values in series.items():
+            self.family_history_of(metric).append_tick(values)
+            if metric == self.metric and self.view == ALL_FAMILIES:
+                self.heatmap_tick(values)
+        changed = families.keys() != self.families.keys()
+        self.families = families
+        for root, (name, _) in families.items():
+            self.family_names[root] = name
+        if changed:
+            self.update_view_combo()
+        if self.view != ALL_PROCESSES and self.metric in series and self.latest is not None:
+            self.schedule_frame()
+
+    def update_view_combo(self):
+        """
+        List the families in the view combo box, the family drilled down to is kept while it exists
+        """
+        view = self.view
+        if self.view_combo.isHidden() or view not in (ALL_PROCESSES, ALL_FAMILIES) and view not in self.families:
+            # The first families switch the chart to the family view, it is also shown when a family exits
+            view = ALL_FAMILIES
+        self.view_combo.blockSignals(True)
+        self.view_combo.clear()
+        self.view_combo.addItem("All Families", ALL_FAMILIES)
+        self.view_combo.addItem("All Processes", ALL_PROCESSES)
+        for root, (name, _) in sorted(self.families.items(), key=lambda family: (family[1][0], family[0])):
+            self.view_combo.addItem(f"Processes of {name} ({root})", root)
+        self.view_combo.setCurrentIndex(self.view_combo.findData(view))
+        self.view_combo.blockSignals(False)
+        self.view_combo.setHidden(False)
+        if view != self.view:
+            self.select_view(self.view_combo.currentIndex())
+
+    def select_metric(self, index):
+        """
+        Show another metric, the lines are recreated and the figure is redrawn
+        :param index: index of the metric in the combo box
+        """
+        self.metric = self.metric_combo.itemData(index)
+        if self.canvas is not None:
+            self.set_y_axis()
+            self.reset_lines()
+
+    def set_y_axis(self):
+        label, top = ('CPU Usage (%)', 100) if self.metric == CPU_METRIC else (PROCESS_METRICS[self.metric][0], 1)
+        self.cpu_ax.set_ylabel(label)
+        self.cpu_ax.set_ylim(0, top)
+        if self.image is not None:
+            # The heatmap shows the metric by the colors
+            self.colorbar.set_label(label)
+            self.image.set_clim(0, top)
+
+    def metric_scale(self):
+        """
+        :return: factor of the values of the metric shown, e.g. bytes to MB
+        """
+        return PROCESS_METRICS[self.metric][3] if self.metric != CPU_METRIC else 1
+
+    def select_view(self, index):
+        """
+        Show all processes, all families, or drill down to the processes of one family
+        :param index: index of the view in the combo box
+        """
+        self.view = self.view_combo.itemData(index)
+        self.reset_lines()
+
+    def select_mode(self, index):
+        """
+        Show all lines, the lines of the heaviest processes only, or the heatmap
+        :param index: index of the mode in the combo box
+        """
+        self.mode = self.mode_combo.itemData(index)
+        self.reset_lines()
+
+    def reset_lines(self):
+        """
+        Recreate the lines or the heatmap of the mode and redraw the figure
+        """
+        if self.canvas is None:
+            return
+        for line in self.lines.values():
+            line.remove()
+        self.lines = {}
+        self.top_keys = None
+        heatmap = self.mode == HEATMAP_MODE
+        if heatmap:
+            self.reset_heatmap()
+        else:
+            self.heatmap = None
+        self.cpu_ax.set_visible(not heatmap)
+        if self.heatmap_ax is not None:
+            self.heatmap_ax.set_visible(heatmap)
+            self.colorbar.ax.set_visible(heatmap)
+        if self.latest is not None:
+            self.render_frame()
+        else:
+            self.request_draw()
+
+    def visible_series(self):
+        """
+        :return: (history, keys) of the lines of the metric, view and mode shown, keys are PIDs or family roots
+        """
+        if self.view == ALL_PROCESSES:
+            history = self.history
+            keys = history.pids()
+        elif self.view == ALL_FAMILIES:
+            history = self.family_history_of(self.metric)
+            keys = history.pids()
+        else:
+            history = self.history
+            _, members = self.families.get(self.view, (None, ()))
+            keys = [pid for pid in members if pid in history.buffers]
+        if self.mode == TOP_MODE:
+            keys = self.heaviest(history, keys)
+        return history, keys
+
+    def heaviest(self, history, keys):
+        """
+        :return: the TOP_LINES keys with the highest mean over the last TOP_SECONDS,
+                 ranked again every TOP_SECONDS, so the lines do not change on every tick
+        """
+        if self.top_keys is None or self.latest - self.top_ranked_at >= TOP_SECONDS:
+            means = {}
+            for key in keys:
+                timestamps, values = history.view(key)
+                recent = values[timestamps.searchsorted(self.latest - TOP_SECONDS):]
+                means[key] = float(recent.mean()) if len(recent) else 0.0
+            self.top_keys = heapq.nlargest(TOP_LINES, keys, key=means.get)
+            self.top_ranked_at = self.latest
+        present = set(keys)
+        return [key for key in self.top_keys if key in present]
+
+    def line_label(self, key):
+        if self.view == ALL_FAMILIES:
+            return f"{self.family_names.get(key, 'Family')} ({key}) and children"
+        return f"Process {key}"
+
+    def schedule_frame(self):
+        if self.canvas is None:
+            return
+        elapsed = time.monotonic() - self.last_frame
+        if elapsed >= self.min_frame_interval:
+            self.render_frame()
+        elif not self.frame_timer.isActive():
+            self.frame_timer.start(int((self.min_frame_interval - elapsed) * 1000))
+
+    def render_frame(self):
+        """
+        Update the lines or the heatmap with the current history
+        The whole figure is redrawn only when lines or rows were added or removed, or the time window shifts,
+        otherwise the lines or the image are blitted over the cached background
+        Timed as the RENDER stage, the deferred full redraw is timed as the DRAW stage
+        """
+        start = time.perf_counter()
+        self.last_frame = time.monotonic()
+        full_redraw = self.update_heatmap() if self.mode == HEATMAP_MODE else self.update_lines()
+        if full_redraw or self.background is None:
+            # The cached background is stale until the deferred redraw captures a new one
+            self.background = None
+            self.request_draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_artists()
+            self.canvas.blit(self.active_axes().bbox)
+        stats.record(RENDER, time.perf_counter() - start)
+
+    def update_lines(self):
+        """
+        :return: True if the figure must be redrawn: lines were added or removed, or an axis changed
+        """
+        history, keys = self.visible_series()
+        full_redraw = self.sync_lines(keys)
+        full_redraw |= self.shift_time_axis(self.cpu_ax)
+
+        scale = self.metric_scale()
+        top = 0.0
+        for key, line in self.lines.items():
+            timestamps, values = history.view(key)
+            if scale != 1:
+                values = values * scale
+            line.set_data(timestamps, values)
+            if len(values):
+                top = max(top, float(values.max()))
+        if self.metric != CPU_METRIC:
+            full_redraw |= self.fit_y_axis(top)
+        return full_redraw
+
+    def shift_time_axis(self, axes):
+        """
+        Shift the time axis once the newest sample left it, HEADROOM of the window is left empty on the right
+        :return: True if the axis was shifted
+        """
+        left, right = axes.get_xlim()
+        if left <= self.latest <= right:
+            return False
+        right = self.latest + self.window * self.HEADROOM
+        axes.set_xlim(right - self.window, right)
+        return True
+
+    def create_heatmap(self):
+        """
+        Create the axes of the heatmap, with its image and colorbar, hidden in the other modes
+        """
+        import numpy as np
+        from matplotlib.ticker import FuncFormatter
+
+        self.heatmap_ax = self.cpu_chart.add_subplot(label='heatmap')
+        self.heatmap_ax.set_xlabel('Time')
+        self.heatmap_ax.xaxis.set_major_formatter(FuncFormatter(format_timestamp))
+        # Animated like the lines: excluded from the cached background and blitted on every frame
+        self.image = self.heatmap_ax.imshow(np.full((1, 1), np.nan, dtype=np.float32), aspect='auto',
+                                            interpolation='nearest', animated=True)
+        self.colorbar = self.cpu_chart.colorbar(self.image, ax=self.heatmap_ax)
+        self.set_y_axis()
+
+    def reset_heatmap(self):
+        """
+        Fill the heatmap from the history of the metric and view shown, it is shifted by the ticks from then on
+        """
+        import numpy as np
+
+        if self.heatmap_ax is None:
+            self.create_heatmap()
+        history, keys = self.visible_series()
+        width = history.capacity
+        self.heatmap = np.full((max(len(keys), 1), width), np.nan, dtype=np.float32)
+        self.heatmap_rows = {key: row for row, key in enumerate(keys)}
+        self.heatmap_end = self.latest
+        self.heatmap_changed = True
+        if self.latest is None:
+            return
+        scale = self.metric_scale()
+        for key, row in self.heatmap_rows.items():
+            timestamps, values = history.view(key)
+            columns = width - 1 - np.rint((self.latest - timestamps) / self.interval).astype(np.intp)
+            kept = columns >= 0
+            self.heatmap[row, columns[kept]] = values[kept] * scale
+
+    def heatmap_tick(self, values):
+        """
+        Shift the heatmap by the intervals elapsed since its last column and write a tick into the last column
+        :param values: key and payload of the metric shown, e.g. {1: (10.0, 1700000000.0)}
+        """
+        import numpy as np
+
+        if self.heatmap is None:
+            return
+        if self.view not in (ALL_PROCESSES, ALL_FAMILIES):
+            _, members = self.families.get(self.view, (None, ()))
+            members = set(members)
+            values = {key: value for key, value in values.items() if key in members}
+        if not values:
+            return
+        timestamp = max(timestamp for _, timestamp in values.values())
+        if self.heatmap_end is None:
+            self.heatmap_end = timestamp
+        shift = round((timestamp - self.heatmap_end) / self.interval)
+        if shift > 0:
+            heatmap = self.heatmap
+            if shift < heatmap.shape[1]:
+                # NumPy copies overlapping slices as if through a buffer
+                heatmap[:, :-shift] = heatmap[:, shift:]
+                heatmap[:, -shift:] = np.nan
+            else:
+                heatmap.fill(np.nan)
+            self.heatmap_end = timestamp
+        scale = self.metric_scale()
+        rows = [self.heatmap_row(key) for key in values]
+        self.heatmap[rows, -1] = [value * scale for value, _ in values.values()]
+
+    def heatmap_row(self, key):
+        """
+        :return: row of a process or family in the heatmap, added at the bottom if it is new
+        """
+        import numpy as np
+
+        row = self.heatmap_rows.get(key)
+        if row is None:
+            row = self.heatmap_rows[key] = len(self.heatmap_rows)
+            if row == len(self.heatmap):
+                grown = np.full((2 * row, self.heatmap.shape[1]), np.nan, dtype=np.float32)
+                grown[:row] = self.heatmap
+                self.heatmap = grown
+            self.heatmap_changed = True
+        return row
+
+    def update_heatmap(self):
+        """
+        Show the heatmap, the rows without samples in the window are dropped
+        :return: True if the figure must be redrawn: rows were added or dropped, the time axis or the colors changed
+        """
+        import numpy as np
+
+        full_redraw = self.heatmap_changed
+        self.heatmap_changed = False
+        count = len(self.heatmap_rows)
+        rows = self.heatmap[:count]
+        empty = np.isnan(rows).all(axis=1)
+        if empty.any():
+            keys = [key for key, row in self.heatmap_rows.items() if not empty[row]]
+            rows[:len(keys)] = rows[~empty]
+            rows[len(keys):] = np.nan
+            self.heatmap_rows = {key: row for row, key in enumerate(keys)}
+            count = len(keys)
+            full_redraw = True
+        full_redraw |= self.shift_time_axis(self.heatmap_ax)
+
+        shown = max(count, 1)
+        end = self.heatmap_end if self.heatmap_end is not None else self.latest
+        width = self.heatmap.shape[1]
+        self.image.set_data(self.heatmap[:shown])
+        self.image.set_extent((end - (width - 0.5) * self.interval, end + 0.5 * self.interval, shown - 0.5, -0.5))
+        if full_redraw:
+            self.heatmap_ax.set_ylim(shown - 0.5, -0.5)
+            if count <= HEATMAP_LABELS:
+                self.heatmap_ax.set_yticks(range(count), [self.line_label(key) for key in self.heatmap_rows])
+            else:
+                self.heatmap_ax.set_yticks([])
+        if self.metric != CPU_METRIC and count:
+            top = self.fitted_limit(float(np.nanmax(self.heatmap[:count])), self.image.norm.vmax)
+            if top is not None:
+                self.image.set_clim(0, top)
+                full_redraw = True
+        return full_redraw
+
+    def request_draw(self):
+        """
+        Redraw the whole figure once control returns to the event loop, but no sooner than MAX_DRAW_SHARE allows
+        after the previous full redraw, requests until then are coalesced
+        """
+        if not self.draw_pending:
+            self.draw_pending = True
+            delay = self.last_draw + self.draw_duration / self.MAX_DRAW_SHARE - time.monotonic()
+            QTimer.singleShot(max(0, int(delay * 1000)), self.draw_figure)
+
+    def draw_figure(self):
+        self.draw_pending = False
+        self.last_draw = time.monotonic()
+        start = time.perf_counter()
+        self.canvas.draw()
+        self.draw_duration = time.perf_counter() - start
+        stats.record(DRAW, self.draw_duration)
+
+    def fit_y_axis(self, top):
+        """
+        Fit the y-axis of metrics without a fixed range to the highest visible value
+        The axis grows with headroom and shrinks only when the values fall well below it,
+        so the figure is not redrawn on every tick
+        :param top: highest visible value
+        :return: True if the axis changed
+        """
+        _, current = self.cpu_ax.get_ylim()
+        top = self.fitted_limit(top, current)
+        if top is None:
+            return False
+        self.cpu_ax.set_ylim(0, top)
+        return True
+
+    @classmethod
+    def fitted_limit(cls, top, current):
+        """
+        :param top: highest visible value
+        :param current: current upper limit
+        :return: new upper limit, with headroom, or None if the current one still fits
+        """
+        if top <= current and (top >= current / 4 or current <= 1):
+            return None
+        return max(top * (1 + 2 * cls.HEADROOM), 1)
+
+    def sync_lines(self, keys):
+        """
+        Create lines for new processes or families and remove lines of those whose history expired
+        :param keys: PIDs or family roots shown
+        :return: True if the set of lines changed
+        """
+        keys = set(keys)
+        added = [key for key in keys if key not in self.lines]
+        removed = [key for key in self.lines if key not in keys]
+        for key in removed:
+            self.lines.pop(key).remove()
+        for key in added:
+            # Animated lines are excluded from the cached background and drawn on every frame
+            self.lines[key], = self.cpu_ax.plot([], [], label=self.line_label(key), animated=True)
+        if added or removed:
+            if self.lines:
+                self.cpu_ax.legend(loc='upper left')
+            elif self.cpu_ax.get_legend() is not None:
+                self.cpu_ax.get_legend().remove()
+        return bool(added or removed)
+
+    def on_draw(self, _event):
+        """
+        Cache the background after every full redraw (including resizes) and draw the lines over it
+        """
+        self.background = self.canvas.copy_from_bbox(self.active_axes().bbox)
+        self.draw_artists()
+
+    def active_axes(self):
+        return self.heatmap_ax if self.mode == HEATMAP_MODE else self.cpu_ax
+
+    def draw_artists(self):
+        if self.mode == HEATMAP_MODE:
+            self.heatmap_ax.draw_artist(self.image)
+            return
+        for line in self.lines.values():
+            self.cpu_ax.draw_artist(line)
+
+
+def format_timestamp(timestamp, _position=None):
+    """
+    Format the x-axis tick label
+    :param timestamp: seconds since the epoch
+    :param _position: tick position, unused
+    :return: str, local time of day
+    """
+    return time.strftime('%H:%M:%S', time.localtime(timestamp))
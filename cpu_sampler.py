@@ -0,0 +1,262 @@
+import time
+import psutil
+
+from proc_stat_registry import ProcStatRegistry
+from process_registry import ProcessRegistry
+from process_tree import ProcessTree
+
+# CPU usage in percent, the metric sampled in any case
+CPU_METRIC = 'cpu'
+
+# Per-process metrics which can be sampled along with CPU usage
+# name: (chart label, ProcessMetrics column, cumulative counter sampled as a rate per second, chart scale)
+PROCESS_METRICS = {
+    'rss': ("Resident Memory (MB)", "Rss", False, 1 / (1 << 20)),
+    'threads': ("Threads", "Threads", False, 1),
+    'fds': ("Open Files and Handles", "Fds", False, 1),
+    'read_bytes': ("Disk Read (KB/s)", "ReadBytes", True, 1 / 1024),
+    'write_bytes': ("Disk Write (KB/s)", "WriteBytes", True, 1 / 1024),
+    'ctx_switches': ("Context Switches (1/s)", "ContextSwitches", True, 1),
+}
+
+# Sampler backends: name: registry class
+# A registry keeps track of the process table and reads CPU time and metrics of the processes in one sweep
+SAMPLER_BACKENDS = {
+    'psutil': ProcessRegistry,
+    'proc': ProcStatRegistry,
+}
+DEFAULT_BACKEND = 'psutil'
+
+
+def available_backends():
+    """
+    :return: names of the sampler backends usable on this platform, see SAMPLER_BACKENDS
+    """
+    return [name for name, registry in SAMPLER_BACKENDS.items() if registry.available()]
+
+
+class CPUSampler:
+    """
+    Samples CPU usage of the watched processes, independent of Qt
+    Shared by CPUWatcher and the headless collector
+    """
+
+    def __init__(self, watched_processes, refresh_every=1, metrics=(), backend=DEFAULT_BACKEND, tree=False):
+        """
+        :param watched_processes: Processes whose CPU load we monitor
+        :param refresh_every: refresh the process table every N ticks
+        :param metrics: names of the other metrics sampled along with CPU usage, see PROCESS_METRICS
+        :param backend: name of the sampler backend, see SAMPLER_BACKENDS
+        :param tree: sample the descendants of the watched processes as well and sum usage per family
+        """
+        self.watched_processes = watched_processes
+        self.refresh_every = refresh_every
+        self.metrics = []
+        self.set_metrics(metrics)
+        self.tree = None  # Families of the watched processes in tree mode
+        self.family_usage = {}  # {root: (usage, timestamp, members)} of the last tick in tree mode
+        self.backend = None
+        self.registry = None  # Process table of the backend, kept between ticks
+        self.set_backend(backend)
+        self.num_cores = psutil.cpu_count()
+        self.cpu_snapshot = {}  # {pid: (key, cpu_time, metrics)} taken on the previous tick
+        self.process_metrics = {}  # {pid: {metric: value}} of the last tick
+        self.last_clock = None  # Clock of the sampler backend at the previous tick
+        self.ticks = 0
+        self.set_tree_mode(tree)
+
+    def set_metrics(self, metrics):
+        """
+        :param metrics: names of the other metrics sampled along with CPU usage, see PROCESS_METRICS
+        """
+        unknown = set(metrics) - set(PROCESS_METRICS)
+        if unknown:
+            raise ValueError(f"Unknown process metrics: {', '.join(sorted(unknown))}")
+        self.metrics = [metric for metric in PROCESS_METRICS if metric in metrics]
+
+    def set_backend(self, backend):
+        """
+        Switch to another sampler backend, its process table is read on the next refresh
+        Snapshots taken by the previous backend are never matched, since the backends identify processes
+        by different keys
+        :param backend: name of the backend, see SAMPLER_BACKENDS
+        :return: True if the backend changed
+        """
+        registry = SAMPLER_BACKENDS.get(backend)
+        if registry is None or not registry.available():
+            raise ValueError(f"Sampler backend {backend} is not available, use one of: "
+                             f"{', '.join(available_backends())}")
+        if backend == self.backend:
+            return False
+        self.backend, self.registry = backend, registry()
+        if self.tree is not None:
+            # Built again from the process table of the new backend
+            self.tree = ProcessTree()
+        return True
+
+    def set_tree_mode(self, enabled):
+        """
+        In tree mode, the descendants of the watched processes are sampled as well whatever their names,
+        e.g. forked workers, and usage is summed per family, see ProcessTree
+        The families are built on the next tick
+        """
+        if enabled and self.tree is None:
+            self.tree = ProcessTree()
+        elif not enabled:
+            self.tree = None
+            self.family_usage = {}
+
+    def refresh_processes(self):
+        """
+        Diff the process table against the known processes
+        Identity of the sampled processes is verified to detect PID reuse
+        In tree mode the families are updated with the diff
+        :return: tuple (added, exited), lists of (pid, name)
+        """
+        registry, tree = self.registry, self.tree
+        added, exited = registry.refresh(verify=self.cpu_snapshot)
+        if tree is not None:
+            tree.update(self.watched_processes, registry.names, registry.parents, added, exited)
+        return added, exited
+
+    def watched_pids(self, registry, tree):
+        """
+        :param registry: registry of the sampler backend
+        :param tree: ProcessTree in tree mode, None otherwise
+        :return: list of pids of the processes with a watched name, or of all family members in tree mode
+        """
+        if tree is None:
+            watched_names = set(self.watched_processes)
+            return [pid for pid, name in registry.names.items() if name in watched_names]
+        if frozenset(self.watched_processes) != tree.watched:
+            tree.rebuild(self.watched_processes, registry.names, registry.parents)
+        return tree.pids()
+
+    def refresh_due(self):
+        """
+        Count the tick and tell whether the process table should be refreshed before sampling it
+        :return: bool
+        """
+        due = self.ticks % self.refresh_every == 0
+        self.ticks += 1
+        return due
+
+    def get_cpu_usage(self):
+        """
+        Get CPU usage for watched processes in a single non-blocking pass
+        Every process is read once per tick, its usage is the delta of consumed CPU time
+        against the previous tick divided by the time elapsed between the ticks on the clock of the backend,
+        so the tick latency does not depend on the number of watched processes.
+        All samples of one tick share one timestamp
+        Real usage may exceed 100% if there are more than one core,
+        we normalize it to 100% by dividing by the number of cores
+        Processes seen for the first time have no previous snapshot, they are reported from the next tick
+        The other metrics are read in the same pass by the sampler backend,
+        and kept in process_metrics for the processes reported
+        In tree mode, usage summed per family is kept in family_usage
+        :return: dictionary {pid: (usage, timestamp)}
+        """
+        cpu_usage = {}
+        process_metrics = {}
+        snapshot = {}
+        registry, tree = self.registry, self.tree
+        watched_processes = self.watched_pids(registry, tree)
+        timestamp = time.time()
+        clock = registry.clock()
+        elapsed = clock - self.last_clock if self.last_clock is not None else 0
+        keys = registry.keys
+        for pid, (cpu_time, values) in registry.read(watched_processes, self.metrics).items():
+            key = keys[pid]
+            snapshot[pid] = (key, cpu_time, values)
+            # A previous snapshot taken from a different process with a recycled PID is ignored
+            previous = self.cpu_snapshot.get(pid)
+            if previous and previous[0] == key and elapsed > 0:
+                usage_percent = max(cpu_time - previous[1], 0.0) / elapsed * 100
+                cpu_usage[pid] = (usage_percent / self.num_cores, timestamp)
+                if values is not None:
+                    process_metrics[pid] = self.metric_rates(values, previous[2], elapsed)
+        self.cpu_snapshot = snapshot
+        self.process_metrics = process_metrics
+        self.family_usage = tree.totals(cpu_usage) if tree is not None else {}
+        self.last_clock = clock
+        return cpu_usage
+
+    @staticmethod
+    def metric_rates(values, previous, elapsed):
+        """
+        :param values: metrics of this tick, counters are cumulative
+        :param previous: metrics of the previous tick, or None
+        :param elapsed: seconds since the previous tick
+        :return: dict {metric: value} with the counters turned into rates per second
+        """
+        metrics = {}
+        for metric, value in values.items():
+            if not PROCESS_METRICS[metric][2]:
+                metrics[metric] = value
+            elif previous and metric in previous:
+                metrics[metric] = max(value - previous[metric], 0) / elapsed
+        return metrics
+
+    def make_records(self, cpu_usage):
+        """
+        Repack CPU usage data to be inserted into the database as one batch per tick:
+        {pid: (usage, timestamp)} -> [{pid, usage, timestamp, name}]
+        Records of processes with other metrics sampled also have the key 'metrics', {metric: value}
+        In tree mode, the totals of the families are appended with the pid and name of the family root,
+        and the key 'members', the number of processes summed
+        :param cpu_usage: dictionary returned by get_cpu_usage()
+        :return: list of dicts
+        """
+        process_names = self.registry.names
+        records = [
+            {'pid': pid, 'usage': usage, 'timestamp': timestamp, 'name': process_names[pid]}
+            for pid, (usage, timestamp) in cpu_usage.items() if pid in process_names
+        ]
+        for record in records:
+            metrics = self.process_metrics.get(record['pid'])
+            if metrics:
+                record['metrics'] = metrics
+        records.extend(
+            {'pid': root, 'usage': usage, 'timestamp': timestamp, 'name': process_names.get(root, ""),
+             'members': members}
+            for root, (usage, timestamp, members) in self.family_usage.items()
+        )
+        return records
+
+    def metric_series(self, cpu_usage):
+        """
+        Repack the other metrics of the last tick per metric, the way CPU usage is passed to the chart:
+        {pid: {metric: value}} -> {metric: {pid: (value, timestamp)}}
+        :param cpu_usage: dictionary returned by get_cpu_usage()
+        :return: dict
+        """
+        series = {}
+        for pid, metrics in self.process_metrics.items():
+            timestamp = cpu_usage[pid][1]
+            for metric, value in metrics.items():
+                series.setdefault(metric, {})[pid] = (value, timestamp)
+        return series
+
+    def families(self):
+        """
+        :return: dict {root: (name, tuple of member pids)} of the families in tree mode
+        """
+        tree = self.tree
+        if tree is None:
+            return {}
+        names = self.registry.names
+        return {root: (names.get(root, ""), members) for root, members in tree.members().items()}
+
+    def family_series(self, metric_series):
+        """
+        Sum every metric of the last tick per family in tree mode
+        :param metric_series: dict returned by metric_series()
+        :return: dict {metric: {root: (total, timestamp)}}, CPU usage under CPU_METRIC
+        """
+        tree = self.tree
+        if tree is None:
+            return {}
+        series = {CPU_METRIC: {root: (usage, timestamp) for root, (usage, timestamp, _) in self.family_usage.items()}}
+        for metric, values in metric_series.items():
+            series[metric] = {root: (total, timestamp) for root, (total, timestamp, _) in tree.totals(values).items()}
+        return series
@@ -1,8 +1,15 @@
-
+import logging
+import threading
 import time
-import psutil
 
-from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+
+from cpu_sampler import CPUSampler, DEFAULT_BACKEND
+from instrumentation import stats, SAMPLE, TICKS, DROPPED_TICKS
+from system_sampler import SystemSampler, SystemEventDetector
+from tick_scheduler import TickScheduler
+
+logger = logging.getLogger(__name__)
 
 
 # noinspection PyUnresolvedReferences
@@ -10,39 +17,187 @@ class CPUWatcher(QThread):
     """
     The class collects real-time data on CPU performance for certain processes
     Allows passing the data to consumers using Qt signals and slots
+    Sampling itself is done by CPUSampler
+    Optionally, system-wide resources are sampled on the same tick by SystemSampler,
+    and their notable transitions are reported as system events
+    The records of every tick can be recorded to a tick log, and a tick log can be replayed instead of sampling,
+    through the same signals, see tick_log
+    Ticks are fired at absolute deadlines by TickScheduler, pause, resume and stop take effect immediately
+    Optionally every tick, sampled or replayed, is evaluated by a RulesEngine and the events raised are emitted
     """
 
+    # Ticks of a replay emitted but not yet received by the GUI thread, the replay waits beyond that
+    MAX_PENDING_TICKS = 64
+
     # Signals are used to communicate between threads
     stopped = pyqtSignal()
-    new_data = pyqtSignal(list)
-    insert_record = pyqtSignal(dict)
+    new_data = pyqtSignal(dict)
+    # Other metrics of one tick, {metric: {pid: (value, timestamp)}}
+    new_metrics = pyqtSignal(dict)
+    insert_record = pyqtSignal(list)
+    processes_added = pyqtSignal(list)
+    processes_exited = pyqtSignal(list)
+    # Families of the tree mode {root: (name, members)}
+    # and their totals of one tick {metric: {root: (value, timestamp)}}
+    new_families = pyqtSignal(dict, dict)
+    # System sample of one tick and the list of (timestamp, event) detected in it
+    system_sample = pyqtSignal(object, list)
+    # List of (timestamp, event) raised by the rules in one tick
+    rule_events = pyqtSignal(list)
+    # Number of ticks replayed, when a replay ends
+    replay_finished = pyqtSignal(int)
 
-    def __init__(self, watched_processes, interval=1, parent=None):
+    def __init__(self, watched_processes, interval=1, refresh_every=1, system_metrics=False,
+                 metrics=(), backend=DEFAULT_BACKEND, tree=False, adaptive=False, rules=None, parent=None):
         """
         :param watched_processes: Processes whose CPU load we monitor
-        :param interval: ticks in seconds
+        :param interval: ticks in seconds, at least tick_scheduler.MIN_INTERVAL
+        :param refresh_every: refresh the process table every N ticks
+        :param system_metrics: sample system-wide resources as well
+        :param metrics: names of the other per-process metrics sampled along with CPU usage, see PROCESS_METRICS
+        :param backend: name of the sampler backend, see SAMPLER_BACKENDS
+        :param tree: sample the descendants of the watched processes as well and sum usage per family
+        :param adaptive: adapt the interval to the load, see TickScheduler.adapt()
+        :param rules: list of rules evaluated on every tick, see rules_engine.RULE_KINDS, None to evaluate none
         :param parent: parent object
         """
         super().__init__(parent)
         self.is_running = True
-        self.is_paused = False  # Flag to indicate if the thread is paused
-        self.watched_processes = watched_processes
         self.interval = interval
-        self.process_dict = {}  # Dictionary to store process information
-        self.cpu_usage_history = []
+        self.scheduler = TickScheduler(interval, adaptive)
+        self.sampler = CPUSampler(watched_processes, refresh_every=refresh_every, metrics=metrics, backend=backend,
+                                  tree=tree)
+        self.system_sampler = None
+        self.system_event_detector = None
+        self.set_system_metrics(system_metrics)
+        self.rules = None
+        self.rules_engine = None
+        self.set_rules(rules)
+        self.recording = None  # Path of the tick log recorded to, opened and closed by the thread
+        self.recorder = None
+        self.replay_source = None  # (path, speed) of the tick log to replay on the next start
+        self.pending_ticks = None  # Semaphore of the ticks of the replay not yet received
+        self.replay_backlog = None  # Callable returning the number of items queued by consumers, e.g. a writer
+
+    @property
+    def is_paused(self):
+        return self.scheduler.paused
+
+    @property
+    def watched_processes(self):
+        return self.sampler.watched_processes
+
+    @watched_processes.setter
+    def watched_processes(self, watched_processes):
+        self.sampler.watched_processes = watched_processes
+
+    @property
+    def registry(self):
+        return self.sampler.registry
+
+    def set_metrics(self, metrics):
+        """
+        Choose the other per-process metrics, takes effect on the next tick
+        :param metrics: names of the metrics, see PROCESS_METRICS
+        """
+        self.sampler.set_metrics(metrics)
+
+    def set_backend(self, backend):
+        """
+        Switch to another sampler backend, takes effect on the next tick
+        Consumers are notified that the processes known to the previous backend exited,
+        they are added again by the next refresh of the process table
+        :param backend: name of the backend, see SAMPLER_BACKENDS
+        """
+        processes = sorted(self.registry.names.items())
+        if self.sampler.set_backend(backend) and processes:
+            self.processes_exited.emit(processes)
+
+    def set_tree_mode(self, enabled):
+        """
+        Turn the tree mode on or off, takes effect on the next tick, see CPUSampler.set_tree_mode()
+        """
+        self.sampler.set_tree_mode(enabled)
+
+    def set_system_metrics(self, enabled):
+        """
+        Turn sampling of system-wide resources on or off, takes effect on the next tick
+        """
+        if enabled and self.system_sampler is None:
+            self.system_event_detector = SystemEventDetector()
+            self.system_sampler = SystemSampler()
+        elif not enabled:
+            self.system_sampler = None
+
+    def set_rules(self, rules):
+        """
+        Choose the rules evaluated on every tick, takes effect on the next tick
+        If the rules changed, their state starts over
+        :param rules: list of rules, see rules_engine.RULE_KINDS, None or empty to evaluate none
+        :raise ValueError: if a rule is invalid, the rules evaluated are kept
+        """
+        if rules == self.rules:
+            return
+        # NumPy is imported with the first rules
+        from rules_engine import RulesEngine
+
+        self.rules_engine = RulesEngine(rules) if rules else None
+        self.rules = rules
+
+    def set_interval(self, interval, adaptive=False):
+        """
+        Change the interval between ticks, also while running
+        :param interval: seconds between ticks
+        :param adaptive: adapt the interval to the load, see TickScheduler.adapt()
+        :raise ValueError: if the interval is shorter than tick_scheduler.MIN_INTERVAL
+        """
+        self.scheduler.configure(interval, adaptive)
+        self.interval = interval
+
+    def set_recording(self, path):
+        """
+        Record the records of every tick to a tick log, from the next tick on
+        :param path: tick log, continued if it exists, None to stop recording
+        """
+        self.recording = path
+
+    def replay(self, path, speed=1.0):
+        """
+        Start the thread replaying a tick log instead of sampling, the watcher must not be running
+        Ticks are emitted through the same signals as sampled ones, except new_families since the members
+        of the families are not recorded; family totals are still passed to insert_record
+        Once the replay ends, replay_finished is emitted and the watcher can be started again
+        :param path: tick log
+        :param speed: 1.0 for real time, N for N times faster, None or 0 for as fast as possible
+        :return: False if the watcher is running
+        """
+        if self.isRunning():
+            return False
         self.is_running = True
+        self.replay_source = (path, speed)
+        self.start()
+        return True
 
     def get_processes(self):
         """
         We call this method every time we need an up-to-date list of processes
         Either for filtering or for monitoring
-        :return: list of dicts with process id and name
+        While the thread is running, the process table is refreshed by the thread itself
+        :return: dict {pid: name}
+        """
+        if not self.isRunning():
+            self.refresh_processes()
+        return self.registry.names
+
+    def refresh_processes(self):
+        """
+        Diff the process table and notify consumers about started and exited processes
         """
-        if not self.process_dict:
-            self.process_dict = {
-                proc.info['pid']: proc.info['name'] for proc in psutil.process_iter(['pid', 'name'])
-            }
-        return self.process_dict
+        added, exited = self.sampler.refresh_processes()
+        if exited:
+            self.processes_exited.emit(exited)
+        if added:
+            self.processes_added.emit(added)
 
     def filter_processes(self, filter_str):
         """
@@ -60,54 +215,183 @@ class CPUWatcher(QThread):
         """
         Main method of the Qt thread
         For Qt widgets prefer it over Python's built-in threading module
+        Every tick is timed, the deadlines passed while a tick was running are skipped and counted as dropped ticks
         """
+        self.scheduler.start()
+        if self.replay_source is not None:
+            self.run_replay()
+            return
         while self.is_running:
-            while self.is_paused:  # Check if the thread is paused
-                time.sleep(1)
+            missed = self.scheduler.wait()
+            if missed is None:
+                break
+            if missed:
+                stats.count(DROPPED_TICKS, missed)
+            tick_start = time.perf_counter()
+            if self.sampler.refresh_due():
+                self.refresh_processes()
             cpu_usage = self.get_cpu_usage()
-            self.cpu_usage_history.append(cpu_usage)
-            self.new_data.emit(self.cpu_usage_history)
-
-            # repack CPU usage data to be inserted into the database:
-            # {pid: (usage, timestamp)} -> {pid: (usage, timestamp, name)}
-            for pid, (usage, timestamp) in cpu_usage.items():
-                process_name = self.process_dict[pid]
-                self.insert_record.emit(
-                    {'pid': pid, 'usage': usage, 'timestamp': timestamp, 'name': process_name}
-                )
-
-            time.sleep(self.interval)
+            metric_series = self.sampler.metric_series(cpu_usage) if self.sampler.metrics else {}
+            families = None
+            if self.sampler.tree is not None:
+                families = (self.sampler.families(), self.sampler.family_series(metric_series))
+            records = self.sampler.make_records(cpu_usage)
+            stats.record(SAMPLE, time.perf_counter() - tick_start)
+
+            # Consumers receive only the new tick and keep their own history if they need one
+            stats.emitting('new_data')
+            self.new_data.emit(cpu_usage)
+            if self.sampler.metrics:
+                self.new_metrics.emit(metric_series)
+            if families is not None:
+                self.new_families.emit(*families)
+            if records:
+                stats.emitting('insert_record')
+                self.insert_record.emit(records)
+            self.sample_system()
+            self.evaluate_rules(cpu_usage, metric_series, self.registry.names)
+            self.record_tick(cpu_usage, records)
+
+            stats.count(TICKS)
+            self.scheduler.adapt(cpu_usage)
+        self.close_recorder()
         self.stopped.emit()
 
-    def get_cpu_usage(self):
+    def record_tick(self, cpu_usage, records):
         """
-        Get CPU usage for watched processes
-        Real usage may exceed 100% if there are more than one core,
-        we normalize it to 100% by dividing by the number of cores
-        :return: dictionary
+        Write the records of the tick to the tick log if recording, the log is switched when the path changes
         """
-        cpu_usage = {}
-        num_cores = psutil.cpu_count()
-        watched_processes = [
-            pid for pid, name in self.get_processes().items() if name in self.watched_processes
-        ]
-        timestamp = time.time()
-        for pid in watched_processes:
+        recording = self.recording
+        if self.recorder is not None and self.recorder.path != recording:
+            self.close_recorder()
+        if recording is None or not records:
+            return
+        if self.recorder is None:
+            from tick_log import TickRecorder
+
             try:
-                process = psutil.Process(pid)
-                usage_percent = process.cpu_percent(interval=self.interval)
-                usage_normalized = usage_percent / num_cores
-                cpu_usage[pid] = (usage_normalized, timestamp)
-            except psutil.NoSuchProcess:
-                cpu_usage[pid] = None
-        print(f'cpu_usage={cpu_usage}')
+                self.recorder = TickRecorder(recording)
+            except (OSError, ValueError) as error:
+                logger.error("Failed to record ticks to %s: %s", recording, error)
+                self.recording = None
+                return
+        timestamp = next(iter(cpu_usage.values()))[1] if cpu_usage else records[0]['timestamp']
+        try:
+            self.recorder.write(timestamp, records)
+        except OSError as error:
+            logger.error("Failed to record ticks to %s: %s", recording, error)
+            self.recording = None
+            self.close_recorder()
+
+    def close_recorder(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def run_replay(self):
+        """
+        Emit the ticks of the tick log at the pace chosen, see replay()
+        As fast as possible, the replay waits for the GUI thread when MAX_PENDING_TICKS ticks are queued,
+        or for the consumer whose backlog is given by replay_backlog, so the ticks do not pile up in memory
+        """
+        from tick_log import TickLog, paced
+
+        path, speed = self.replay_source
+        self.replay_source = None
+        replayed = 0
+        self.pending_ticks = threading.Semaphore(self.MAX_PENDING_TICKS)
+        self.new_data.connect(self.tick_received, Qt.QueuedConnection)
+        try:
+            with TickLog(path) as log:
+                for timestamp, records in paced(log.ticks(), speed, wait=self.scheduler.sleep):
+                    if not self.scheduler.wait_resumed():
+                        break
+                    while self.is_running and not self.pending_ticks.acquire(timeout=0.1):
+                        pass
+                    backlog = self.replay_backlog
+                    while self.is_running and backlog is not None and backlog() > self.MAX_PENDING_TICKS:
+                        time.sleep(0.01)
+                    if not self.is_running:
+                        break
+                    self.emit_replayed_tick(timestamp, records)
+                    replayed += 1
+        except (OSError, ValueError) as error:
+            logger.error("Failed to replay %s: %s", path, error)
+        finally:
+            self.new_data.disconnect(self.tick_received)
+        logger.info("Replayed %d ticks from %s", replayed, path)
+        self.replay_finished.emit(replayed)
+
+    def emit_replayed_tick(self, timestamp, records):
+        tick_start = time.perf_counter()
+        cpu_usage = {}
+        metric_series = {}
+        for record in records:
+            if 'members' in record:
+                continue
+            cpu_usage[record['pid']] = (record['usage'], timestamp)
+            for metric, value in record.get('metrics', {}).items():
+                metric_series.setdefault(metric, {})[record['pid']] = (value, timestamp)
+        stats.record(SAMPLE, time.perf_counter() - tick_start)
+        stats.emitting('new_data')
+        self.new_data.emit(cpu_usage)
+        if metric_series:
+            self.new_metrics.emit(metric_series)
+        if records:
+            stats.emitting('insert_record')
+            self.insert_record.emit(records)
+        self.evaluate_rules(cpu_usage, metric_series, {record['pid']: record['name'] for record in records})
+        stats.count(TICKS)
+
+    def tick_received(self, _cpu_usage):
+        """
+        Runs in the GUI thread, after the consumers of new_data connected before
+        """
+        self.pending_ticks.release()
+
+    def get_cpu_usage(self):
+        """
+        Get CPU usage for watched processes, see CPUSampler.get_cpu_usage()
+        :return: dictionary {pid: (usage, timestamp)}
+        """
+        cpu_usage = self.sampler.get_cpu_usage()
+        logger.debug("cpu_usage=%s", cpu_usage)
         return cpu_usage
 
+    def sample_system(self):
+        """
+        Sample system-wide resources if enabled and emit the sample with the events detected in it
+        """
+        system_sampler, detector = self.system_sampler, self.system_event_detector
+        if system_sampler is None:
+            return
+        sample = system_sampler.sample()
+        if sample is not None:
+            self.system_sample.emit(sample, detector.detect(sample))
+
+    def evaluate_rules(self, cpu_usage, metric_series, names):
+        """
+        Evaluate the rules on the tick if any are chosen and emit the events raised
+        :param cpu_usage: dictionary {pid: (usage, timestamp)}
+        :param metric_series: dictionary {metric: {pid: (value, timestamp)}}
+        :param names: dictionary {pid: name}
+        """
+        engine = self.rules_engine
+        if engine is None:
+            return
+        events = engine.evaluate({'cpu': cpu_usage, **metric_series}, names)
+        if events:
+            self.rule_events.emit(events)
+
     def stop(self):
         self.is_running = False
+        self.scheduler.stop()
+        # A replay waiting for the GUI thread stops at once
+        if self.pending_ticks is not None:
+            self.pending_ticks.release()
 
     def pause(self):
-        self.is_paused = True
+        self.scheduler.pause()
 
     def resume(self):
-        self.is_paused = False
+        self.scheduler.resume()
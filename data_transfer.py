@@ -0,0 +1,254 @@
+import csv
+import io
+import itertools
+import os
+import sqlite3
+import struct
+import sys
+from array import array
+
+from sqlite_store import overlapping_partitions, LOCAL_HOST
+
+# Rows read from the database or the file at once, memory use does not depend on the table size
+CHUNK_SIZE = 50000
+
+CSV_COLUMNS = ["Timestamp", "PID", "ProcessName", "Workload", "Host"]
+# Files exported before the Host column was added hold samples collected locally
+LEGACY_CSV_COLUMNS = CSV_COLUMNS[:-1]
+
+# Columnar format:
+#   header: magic, format version
+#   chunks: row count, count of strings first used in the chunk, process names and hosts,
+#           the strings (uint16 length + UTF-8), then the columns, all little-endian:
+#           timestamps float64, PIDs int32, name indexes uint32, workloads float32, host indexes uint32
+#   Version 1 has no hosts, its samples were collected locally
+COLUMNAR_MAGIC = b"CPUCOL"
+COLUMNAR_VERSION = 2
+COLUMNAR_HEADER = struct.Struct("<6sH")
+COLUMNAR_CHUNK = struct.Struct("<II")
+COLUMNAR_NAME = struct.Struct("<H")
+COLUMNAR_EXTENSION = ".cpuc"
+
+
+def export_file(database_name, path, start=None, end=None, process=None, progress=None):
+    """
+    Export CpuWorkload to CSV, or to the columnar format if the file has the .cpuc extension
+    Rows are read in fixed-size chunks from one read transaction, so the export is consistent
+    and collection continues meanwhile
+    The samples kept in the segments of the columnar backend are exported after the partitions, chunk by chunk
+    :param database_name: path to the database
+    :param path: output file
+    :param start: export samples from this timestamp on, None for unbounded
+    :param end: export samples before this timestamp, None for unbounded
+    :param process: export only the process with this name, None for all
+    :param progress: callable(done, total) called after every chunk
+    :return: number of exported rows
+    """
+    import columnar_store
+
+    connection = sqlite3.connect(database_name, isolation_level=None)
+    try:
+        connection.execute("BEGIN")
+        names = overlapping_partitions(connection, start, end)
+        where, parameters = export_filter(start, end, process)
+        total = sum(
+            connection.execute(f"SELECT count(*) FROM {name}{where}", parameters).fetchone()[0] for name in names
+        )
+        total += columnar_store.count(database_name, start, end, process)
+        chunks = itertools.chain(read_chunks(connection, names, where, parameters),
+                                 read_segment_chunks(database_name, start, end, process))
+        if path.endswith(COLUMNAR_EXTENSION):
+            done = write_columnar(path, chunks, total, progress)
+        else:
+            done = write_csv(path, chunks, total, progress)
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+    return done
+
+
+def export_filter(start, end, process):
+    clauses, parameters = [], {}
+    if start is not None:
+        clauses.append("Timestamp >= :start")
+        parameters['start'] = start
+    if end is not None:
+        clauses.append("Timestamp < :end")
+        parameters['end'] = end
+    if process is not None:
+        clauses.append("ProcessName = :process")
+        parameters['process'] = process
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), parameters
+
+
+def read_chunks(connection, names, where, parameters):
+    """
+    :return: generator of lists of (timestamp, pid, name, workload, host), in chronological order of the partitions
+    """
+    for name in names:
+        cursor = connection.execute(
+            f"SELECT Timestamp, PID, ProcessName, Workload, Host FROM {name}{where} ORDER BY ID", parameters
+        )
+        while True:
+            rows = cursor.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+            yield rows
+
+
+def read_segment_chunks(database_name, start, end, process):
+    """
+    :return: generator of lists of (timestamp, pid, name, workload, host), one per chunk of the segments
+    """
+    import columnar_store
+
+    for columns in columnar_store.scan(database_name, start, end, process):
+        yield list(zip(columns['timestamp'].tolist(), columns['pid'].tolist(), columns['name'].tolist(),
+                       columns['usage'].tolist(), columns['host'].tolist()))
+
+
+def write_csv(path, chunks, total, progress):
+    done = 0
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(CSV_COLUMNS)
+        for rows in chunks:
+            writer.writerows(rows)
+            done += len(rows)
+            if progress:
+                progress(done, total)
+    return done
+
+
+def write_columnar(path, chunks, total, progress):
+    done = 0
+    string_indexes = {}
+    with open(path, 'wb') as file:
+        file.write(COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION))
+        for rows in chunks:
+            new_strings = []
+            for _, _, name, _, host in rows:
+                for string in (name, host):
+                    if string not in string_indexes:
+                        string_indexes[string] = len(string_indexes)
+                        new_strings.append(string)
+            file.write(COLUMNAR_CHUNK.pack(len(rows), len(new_strings)))
+            for string in new_strings:
+                encoded = string.encode('utf-8')
+                file.write(COLUMNAR_NAME.pack(len(encoded)))
+                file.write(encoded)
+            columns = (
+                array('d', (row[0] for row in rows)),
+                array('i', (row[1] for row in rows)),
+                array('I', (string_indexes[row[2]] for row in rows)),
+                array('f', (row[3] for row in rows)),
+                array('I', (string_indexes[row[4]] for row in rows)),
+            )
+            for column in columns:
+                write_little_endian(file, column)
+            done += len(rows)
+            if progress:
+                progress(done, total)
+    return done
+
+
+def write_little_endian(file, column):
+    if sys.byteorder != 'little':
+        column.byteswap()
+    file.write(column.tobytes())
+
+
+def read_little_endian(file, typecode, count):
+    column = array(typecode)
+    column.frombytes(file.read(column.itemsize * count))
+    if len(column) != count:
+        raise ValueError("Truncated columnar file")
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+
+def import_file(store, path, progress=None):
+    """
+    Import a file written by export_file() into the database
+    Every chunk is written in one transaction, partitions and rollups are maintained by the store
+    The durations of the imported samples follow the times of the samples of the file, not those collected meanwhile
+    The page cache is enlarged for the import, so the indexes being updated stay in memory
+    :param store: open SQLiteStore
+    :param path: CSV or columnar (.cpuc) file
+    :param progress: callable(done, total) called after every chunk, in bytes of the file
+    :return: number of imported rows
+    """
+    cache_size = store.connection.execute("PRAGMA cache_size").fetchone()[0]
+    store.connection.execute("PRAGMA cache_size = -65536")
+    try:
+        total = os.path.getsize(path)
+        chunks = read_columnar(path) if path.endswith(COLUMNAR_EXTENSION) else read_csv(path)
+        done = 0
+        last_sampled = {}
+        for records, position in chunks:
+            # The hosts of samples exported from an aggregator database are registered as if received by it
+            hosts = {}
+            for record in records:
+                host = record['host']
+                if host != LOCAL_HOST and record['timestamp'] > hosts.get(host, float('-inf')):
+                    hosts[host] = record['timestamp']
+            store.write_batch(records, hosts=hosts, last_sampled=last_sampled)
+            done += len(records)
+            if progress:
+                progress(position, total)
+    finally:
+        store.connection.execute(f"PRAGMA cache_size = {cache_size}")
+    return done
+
+
+def read_csv(path):
+    """
+    :return: generator of (list of records, bytes read so far)
+    """
+    with open(path, 'rb') as raw:
+        reader = csv.reader(io.TextIOWrapper(raw, newline=''))
+        header = next(reader, None)
+        if header not in (CSV_COLUMNS, LEGACY_CSV_COLUMNS):
+            raise ValueError(f"Unexpected CSV header: {header}")
+        records = []
+        for timestamp, pid, name, workload, *host in reader:
+            records.append({'timestamp': float(timestamp), 'pid': int(pid), 'name': name, 'usage': float(workload),
+                            'host': host[0] if host else LOCAL_HOST})
+            if len(records) == CHUNK_SIZE:
+                yield records, raw.tell()
+                records = []
+        if records:
+            yield records, raw.tell()
+
+
+def read_columnar(path):
+    """
+    :return: generator of (list of records, bytes read so far)
+    """
+    strings = []
+    with open(path, 'rb') as file:
+        magic, version = COLUMNAR_HEADER.unpack(file.read(COLUMNAR_HEADER.size))
+        if magic != COLUMNAR_MAGIC or version not in (1, COLUMNAR_VERSION):
+            raise ValueError("Not a columnar CPU workload file")
+        while True:
+            header = file.read(COLUMNAR_CHUNK.size)
+            if not header:
+                break
+            count, string_count = COLUMNAR_CHUNK.unpack(header)
+            for _ in range(string_count):
+                length, = COLUMNAR_NAME.unpack(file.read(COLUMNAR_NAME.size))
+                strings.append(file.read(length).decode('utf-8'))
+            timestamps = read_little_endian(file, 'd', count)
+            pids = read_little_endian(file, 'i', count)
+            name_indexes = read_little_endian(file, 'I', count)
+            workloads = read_little_endian(file, 'f', count)
+            if version == 1:
+                hosts = [LOCAL_HOST] * count
+            else:
+                hosts = [strings[index] for index in read_little_endian(file, 'I', count)]
+            records = [
+                {'timestamp': timestamp, 'pid': pid, 'name': strings[index], 'usage': workload, 'host': host}
+                for timestamp, pid, index, workload, host in zip(timestamps, pids, name_indexes, workloads, hosts)
+            ]
+            yield records, file.tell()
@@ -1,37 +1,88 @@
+import functools
+import logging
+import operator
 import os
-import zipfile
-from datetime import datetime
+import shutil
 
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QTableView, QDialog
-from PyQt5.QtSql import QSqlDatabase, QSqlQuery, QSqlTableModel
+from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QTableView, QDialog, QLineEdit,
+                             QProgressDialog)
+from PyQt5.QtSql import QSqlDatabase
+
+import data_transfer
+from database_writer import DatabaseWriter
+from export_worker import ExportWorker
+from instrumentation import stats
+from paged_table_model import PagedSqlTableModel
+from sqlite_store import SQLiteStore, DATABASE_NAME
+from storage import DEFAULT_STORAGE
+
+logger = logging.getLogger(__name__)
 
 
 class DatabaseWidget(QWidget):
+    """
+    Database tab: creates, backs up and cleans up the database, and shows CpuWorkload and SystemEvents
+    Owns the writer thread, which opens the database in the background and writes the samples
+    The controls and the table models are built when the tab is first shown,
+    and bound to the database once the writer has opened it
+    With the columnar backend the raw samples are kept in segments, see columnar_store,
+    the CpuWorkload table shows the samples written by the SQLite backend only, all of them are exported
+    """
 
-    database_name = "CpuMetrics"
-    CREATE_CPU_WORKLOAD = "CREATE TABLE IF NOT EXISTS CpuWorkload " \
-                          "(ID INTEGER PRIMARY KEY AUTOINCREMENT, " \
-                          "Timestamp INTEGER, PID INTEGER, ProcessName TEXT, Workload REAL)"
-    CREATE_SYSTEM_EVENTS = "CREATE TABLE IF NOT EXISTS SystemEvents " \
-                           "(ID INTEGER PRIMARY KEY AUTOINCREMENT, Timestamp INTEGER, Event TEXT)"
-    INSERT_CPU_WORKLOAD = "INSERT INTO CpuWorkload (Timestamp, PID, ProcessName, Workload) " \
-                          "VALUES (:timestamp, :pid, :process_name, :workload)"
+    database_name = DATABASE_NAME
 
-    def __init__(self, rewrite_database):
+    def __init__(self, rewrite_database, flush_interval=1.0, refresh_interval=5.0,
+                 retention=SQLiteStore.DEFAULT_RETENTION, storage=DEFAULT_STORAGE):
+        """
+        :param rewrite_database: delete the existing database when creating a new one
+        :param flush_interval: seconds between batched writes of CPU usage records
+        :param refresh_interval: minimal seconds between reloads of the table views
+        :param retention: seconds the raw samples are kept
+        :param storage: storage backend of the raw samples, see storage.STORAGE_BACKENDS
+        """
         super().__init__()
         self.models_layout = None
+        self.cpu_workload_filter_edit = None
         self.cpu_workload_table = None
         self.system_events_table = None
         self.button_panel_layout = None
+        self.backup_buttons = []
+        self.backup_worker = None
+        self.export_worker = None
+        self.transfer_progress = None
         self.layout = None
         self.db = None
         self.rewrite_database = rewrite_database
-        self.cpu_workload_model = QSqlTableModel()
-        self.system_events_model = QSqlTableModel()
-        self.init_ui()
+        self.cpu_workload_model = None
+        self.system_events_model = None
+        self.store_open = False  # The writer has opened the database, see store_opened()
+
+        # Records are written on a dedicated thread, the view is reloaded on a timer
+        self.writer = DatabaseWriter(self.database_name, flush_interval=flush_interval, retention=retention,
+                                     storage=storage)
+        self.writer.opened.connect(self.store_opened)
+        self.writer.batch_written.connect(self.batch_written)
+        self.writer.events_written.connect(self.events_written)
+        self.writer.task_done.connect(self.reload_models)
+        self.writer.task_progress.connect(self.show_transfer_progress)
+        self.unseen_records = 0
+        self.unseen_events = 0
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh_view)
+        self.refresh_timer.start(int(refresh_interval * 1000))
+
         if os.path.isfile(self.database_name):
             self.open_db()
 
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.cpu_workload_table is None:
+            self.init_ui()
+            if self.store_open:
+                self.bind_models()
+
     def init_ui(self):
         self.layout = QVBoxLayout(self)
         self.models_layout = QHBoxLayout(self)
@@ -40,12 +91,27 @@ class DatabaseWidget(QWidget):
         self.button_panel_layout = QHBoxLayout()
         self.create_button("Create", self.create_db)
         self.create_button("Cleanup", self.cleanup_db)
-        self.create_button("Backup", self.backup_db)
+        self.backup_buttons = [
+            self.create_button("Backup", self.backup_db),
+            self.create_button("Incremental", self.incremental_backup_db),
+        ]
         self.layout.addLayout(self.button_panel_layout)
 
+        # Filter of the CpuWorkload table by the beginning of the process name
+        self.cpu_workload_filter_edit = QLineEdit()
+        self.cpu_workload_filter_edit.setPlaceholderText("Filter by process name")
+        # noinspection PyUnresolvedReferences
+        self.cpu_workload_filter_edit.editingFinished.connect(self.filter_cpu_workload)
+        self.layout.addWidget(self.cpu_workload_filter_edit)
+
         # Table views for CpuWorkload and SystemEvents
         self.cpu_workload_table = QTableView()
         self.system_events_table = QTableView()
+        for table in (self.cpu_workload_table, self.system_events_table):
+            table.setSortingEnabled(True)
+            table.horizontalHeader().setSortIndicator(0, Qt.AscendingOrder)
+            # noinspection PyUnresolvedReferences
+            table.horizontalHeader().sortIndicatorChanged.connect(functools.partial(self.show_model_sort, table))
         self.models_layout.addWidget(self.cpu_workload_table)
         self.models_layout.addWidget(self.system_events_table)
         self.layout.addLayout(self.models_layout)
@@ -56,64 +122,173 @@ class DatabaseWidget(QWidget):
 
     def create_db(self):
 
-        print("Creating database:", self.database_name)
+        logger.info("Creating database: %s", self.database_name)
         if os.path.exists(self.database_name) and self.rewrite_database is False:
-            print("Database file already exists, exiting")
+            logger.info("Database file already exists, exiting")
             return
         elif os.path.exists(self.database_name) and self.rewrite_database is True:
-            print("Database file already exists, delete")
-            os.remove(self.database_name)
+            logger.info("Database file already exists, delete")
+            self.close_db()
+            for filename in (self.database_name, f"{self.database_name}-wal", f"{self.database_name}-shm"):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            from columnar_store import segment_directory
 
-        self.db = QSqlDatabase.addDatabase("QSQLITE")
-        self.db.setDatabaseName(self.database_name)
-        if not self.db.open():
-            print("Failed to create database")
-        else:
-            print("Database created successfully")
-            self.create_tables()
-            self.setup_table_models()
+            shutil.rmtree(segment_directory(self.database_name), ignore_errors=True)
+
+        self.open_db()
 
     def cleanup_db(self):
         """
         Cleanup all data from the database
+        Runs on the writer thread, the views are reloaded when it is done
         """
-        query = QSqlQuery()
-        query.exec_("DELETE FROM CpuWorkload")
-        query.exec_("DELETE FROM SystemEvents")
-        if query.lastError().isValid():
-            print("Failed to cleanup database:", query.lastError().text())
-        else:
-            print("Database cleaned up successfully!")
+        if not self.writer.submit(operator.methodcaller('cleanup')):
+            logger.error("Failed to cleanup database: database is not open")
+
+    def reload_models(self, _result=None):
+        self.close_transfer_progress()
+        self.unseen_records = 0
+        self.unseen_events = 0
+        if self.db is not None:
             self.cpu_workload_model.select()
             self.system_events_model.select()
 
-    def backup_db(self):
+    def backup_db(self, incremental=False):
+        """
+        Archive a consistent copy of the database with name CpuMetrics-YYYYMMDD-HHMMSS.zip
+        Runs on a worker thread using the SQLite online backup API, see db_backup
+        :param incremental: archive only the data added since the last backup
+        """
+        if not os.path.isfile(self.database_name):
+            logger.error("Failed to back up database: database does not exist")
+            return
+        # Imported on first use, it is not needed to show the window
+        from backup_worker import BackupWorker
+        for button in self.backup_buttons:
+            button.setEnabled(False)
+        self.backup_worker = BackupWorker(self.database_name, incremental=incremental, parent=self)
+        self.backup_worker.progress.connect(self.backup_progress)
+        self.backup_worker.finished_backup.connect(self.backup_finished)
+        self.backup_worker.start()
+
+    def incremental_backup_db(self):
+        self.backup_db(incremental=True)
+
+    def backup_progress(self, percent):
+        self.backup_buttons[0].setText(f"Backup {percent}%")
+
+    def backup_finished(self, backup_file):
+        if backup_file:
+            logger.info("Database backed up to %s", backup_file)
+        self.backup_buttons[0].setText("Backup")
+        for button in self.backup_buttons:
+            button.setEnabled(True)
+
+    def export_data(self, path, start=None, end=None, process=None):
         """
-        Archive the database file with name CpuMetrics-YYYYMMDD-HHMMSS.zip
+        Export CpuWorkload to CSV or to the columnar format, chosen by the file extension
+        Runs on a worker thread reading the database in fixed-size chunks, see data_transfer
+        :param path: output file
+        :param start: export samples from this timestamp on, None for unbounded
+        :param end: export samples before this timestamp, None for unbounded
+        :param process: export only the process with this name, None for all
         """
-        backup_file = f"CpuMetrics-{datetime.now().strftime('%Y%m%d-%H%M%S')}.zip"
-        with zipfile.ZipFile(backup_file, "w") as backup:
-            backup.write(self.database_name)
-        print(f"Database backed up to {backup_file}")
+        if not os.path.isfile(self.database_name):
+            logger.error("Failed to export data: database does not exist")
+            return
+        if self.export_worker is not None and self.export_worker.isRunning():
+            logger.warning("Failed to export data: export is in progress")
+            return
+        self.open_transfer_progress("Exporting...")
+        self.export_worker = ExportWorker(self.database_name, path, start=start, end=end, process=process, parent=self)
+        self.export_worker.progress.connect(self.show_transfer_progress)
+        self.export_worker.finished_export.connect(self.export_finished)
+        self.export_worker.start()
+
+    def export_finished(self, count):
+        if count >= 0:
+            logger.info("Exported %d samples to %s", count, self.export_worker.path)
+        self.close_transfer_progress()
+
+    def import_data(self, path):
+        """
+        Import a file written by export_data() into the database
+        Runs on the writer thread, one transaction per chunk, the views are reloaded when it is done
+        :param path: CSV or columnar (.cpuc) file
+        """
+        task = functools.partial(data_transfer.import_file, path=path, progress=self.writer.report_progress)
+        if not self.writer.submit(task):
+            logger.error("Failed to import data: database is not open")
+            return
+        self.open_transfer_progress("Importing...")
+
+    def open_transfer_progress(self, label):
+        # Transfers can't be cancelled, they run on other threads
+        self.transfer_progress = QProgressDialog(label, None, 0, 100, self)
+        self.transfer_progress.setWindowTitle("Data transfer")
+        self.transfer_progress.setMinimumDuration(500)
+        self.transfer_progress.setValue(0)
+
+    def show_transfer_progress(self, percent):
+        if self.transfer_progress is not None:
+            self.transfer_progress.setValue(percent)
+
+    def close_transfer_progress(self):
+        if self.transfer_progress is not None:
+            self.transfer_progress.close()
+            self.transfer_progress = None
 
     def open_db(self):
         """
-        Open existing SQLite database
+        Open the SQLite database, created if it does not exist, on the writer thread:
+        the schema is created or migrated there, see store_opened()
+        """
+        self.writer.start()
+
+    def store_opened(self, success):
+        """
+        The writer opened the database, the views are bound to it if the tab was shown
+        :param success: False if the database can't be opened
+        """
+        self.store_open = success
+        if not success:
+            return
+        logger.info("Database opened successfully")
+        if self.cpu_workload_table is not None:
+            self.bind_models()
+
+    def bind_models(self):
+        """
+        Open the connection of the views, read-only, and set up the table models
         """
         self.db = QSqlDatabase.addDatabase("QSQLITE")
         self.db.setDatabaseName(self.database_name)
         if not self.db.open():
-            print("Failed to open database")
-        else:
-            print("Database opened successfully")
-            self.setup_table_models()
+            logger.error("Failed to open database")
+            self.db = None
+            return
+        self.setup_table_models()
+
+    def close_db(self):
+        """
+        Flush pending records and stop the writer thread, close the GUI connection
+        """
+        self.writer.stop()
+        self.store_open = False
+        if self.db is not None:
+            self.db.close()
+            self.db = None
 
     def setup_table_models(self):
+        if self.cpu_workload_model is None:
+            # Rows are fetched lazily as the views scroll, sorting and filtering are done in SQL
+            self.cpu_workload_model = PagedSqlTableModel(
+                "CpuWorkload", filter_column="ProcessName", partition_catalog="CpuWorkloadPartitions"
+            )
+            self.system_events_model = PagedSqlTableModel("SystemEvents", filter_column="Event")
+
         # Set up table models
-        self.cpu_workload_model = QSqlTableModel()
-        self.system_events_model = QSqlTableModel()
-        self.cpu_workload_model.setTable("CpuWorkload")
-        self.system_events_model.setTable("SystemEvents")
         self.cpu_workload_model.select()
         self.system_events_model.select()
 
@@ -125,12 +300,12 @@ class DatabaseWidget(QWidget):
         cpu_workload_width = self.cpu_workload_table.width()
         system_events_width = self.system_events_table.width()
 
-        cpu_workload_column_width = (cpu_workload_width / self.cpu_workload_model.columnCount()) * 0.8
+        cpu_workload_column_width = int(cpu_workload_width / self.cpu_workload_model.columnCount() * 0.8)
         for col in range(self.cpu_workload_model.columnCount()):
             self.cpu_workload_table.setColumnWidth(col, cpu_workload_column_width)
 
         # Calculate the column width for System Events Table
-        system_events_column_width = (system_events_width / self.system_events_model.columnCount()) * 0.8
+        system_events_column_width = int(system_events_width / self.system_events_model.columnCount() * 0.8)
         for col in range(self.system_events_model.columnCount()):
             self.system_events_table.setColumnWidth(col, system_events_column_width)
 
@@ -140,37 +315,60 @@ class DatabaseWidget(QWidget):
         # noinspection PyUnresolvedReferences
         button.clicked.connect(callback)
         self.button_panel_layout.addWidget(button)
+        return button
 
-    def create_tables(self):
-        query = QSqlQuery()
-        query.exec_(self.CREATE_CPU_WORKLOAD)
-        query.exec_(self.CREATE_SYSTEM_EVENTS)
-        if query.lastError().isValid():
-            print("Failed to create tables:", query.lastError().text())
-        else:
-            print("Tables created successfully!")
-
-    def insert_cpu_workload(self, cpu_usage):
-        """
-        Inserts a new metric record into the CpuWorkload table
-        :param cpu_usage: dictionary containing CPU usage data
-        """
-        # Prepare the query to insert the record
-        query = QSqlQuery()
-        query.prepare(
-            "INSERT INTO CpuWorkload (Timestamp, PID, ProcessName, Workload) "
-            "VALUES (:timestamp, :pid, :process_name, :workload)"
-        )
-        query.bindValue(":timestamp", cpu_usage['timestamp'])
-        query.bindValue(":pid", cpu_usage['pid'])
-        query.bindValue(":process_name", cpu_usage['name'])
-        query.bindValue(":workload", cpu_usage['usage'])
-
-        # Execute the query
-        if not query.exec_():
-            print("Failed to insert metric:", query.lastError().text())
-        else:
-            print("Metric inserted successfully!")
-
-            # Refresh the model to update the view with the new data
-            self.cpu_workload_model.select()
+    def insert_cpu_workload(self, records):
+        """
+        Queues new metric records for the CpuWorkload table
+        The records are written by the writer thread in one batch per flush interval
+        :param records: list of dicts containing CPU usage data of one tick
+        """
+        stats.delivered('insert_record')
+        self.writer.enqueue(records)
+
+    def insert_system_sample(self, sample, events):
+        """
+        Queues a system sample for the SystemMetrics table and its events for the SystemEvents table
+        :param sample: dict returned by SystemSampler.sample(), None for events only,
+                       e.g. raised by the rules
+        :param events: list of (timestamp, event text)
+        """
+        self.writer.enqueue_system(sample, events)
+
+    def batch_written(self, count):
+        self.unseen_records += count
+
+    def events_written(self, count):
+        self.unseen_events += count
+
+    def refresh_view(self):
+        """
+        Show new CpuWorkload records and system events if any were written and the view can be seen
+        New rows are added to the models without resetting them
+        """
+        if not self.isVisible() or self.db is None:
+            return
+        if self.unseen_records:
+            self.unseen_records = 0
+            self.cpu_workload_model.refresh()
+        if self.unseen_events:
+            self.unseen_events = 0
+            self.system_events_model.refresh()
+
+    def show_model_sort(self, table, *_):
+        """
+        Keep the sort indicator on the column the model is sorted by, the model ignores columns it can't sort by
+        """
+        model = table.model()
+        if model is None or model.sort_column not in model.columns:
+            return
+        header = table.horizontalHeader()
+        column = model.columns.index(model.sort_column)
+        if (header.sortIndicatorSection(), header.sortIndicatorOrder()) != (column, model.sort_order):
+            header.blockSignals(True)
+            header.setSortIndicator(column, model.sort_order)
+            header.blockSignals(False)
+
+    def filter_cpu_workload(self):
+        if self.cpu_workload_model is not None:
+            self.cpu_workload_model.set_filter(self.cpu_workload_filter_edit.text())
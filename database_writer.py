@@ -0,0 +1,188 @@
+import logging
+import queue
+import sqlite3
+import time
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from instrumentation import stats, DB_WRITE, DROPPED_RECORDS, ROWS_WRITTEN, QUEUE_DEPTH
+from sqlite_store import SQLiteStore
+from storage import make_store, DEFAULT_STORAGE
+
+logger = logging.getLogger(__name__)
+
+
+class Pending:
+    """
+    Rows waiting for the next flush
+    """
+
+    def __init__(self):
+        self.records = []
+        self.system_samples = []
+        self.events = []
+
+    def __bool__(self):
+        return bool(self.records or self.system_samples or self.events)
+
+
+# noinspection PyUnresolvedReferences
+class DatabaseWriter(QThread):
+    """
+    Writes CPU usage records to the database on a dedicated thread
+    Records are queued by the GUI thread and written in batches,
+    one transaction per flush interval instead of one per record
+    Other maintenance of the database is queued as tasks and runs on the same thread,
+    so the store is never accessed concurrently
+    The database is opened by the thread too, creating or migrating the schema does not block the GUI
+    """
+
+    # Emitted once the database is open and its schema up to date, False if it can't be opened
+    opened = pyqtSignal(bool)
+    # Number of records written by the last flush
+    batch_written = pyqtSignal(int)
+    # Oldest timestamp of the records written by the last flush
+    samples_written = pyqtSignal(float)
+    # Number of system events written by the last flush
+    events_written = pyqtSignal(int)
+    # Result of a task passed to submit()
+    task_done = pyqtSignal(object)
+    # Percent of a long task done, see report_progress()
+    task_progress = pyqtSignal(int)
+
+    def __init__(self, database_name, flush_interval=1.0, max_batch=10000,
+                 retention=SQLiteStore.DEFAULT_RETENTION, storage=DEFAULT_STORAGE, parent=None):
+        """
+        :param database_name: path to the SQLite database file
+        :param flush_interval: seconds between flushes
+        :param max_batch: flush earlier if that many records are pending
+        :param retention: seconds the raw samples are kept
+        :param storage: storage backend, see storage.STORAGE_BACKENDS
+        :param parent: parent object
+        """
+        super().__init__(parent)
+        self.database_name = database_name
+        self.retention = retention
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+
+    def enqueue(self, records):
+        """
+        Queue records to be written, safe to call from any thread
+        Records are dropped if the writer is not running, and counted as DROPPED_RECORDS
+        :param records: list of dicts with keys 'timestamp', 'pid', 'name', 'usage'
+        """
+        if not records:
+            return
+        if self.isRunning():
+            self.queue.put(records)
+        else:
+            stats.count(DROPPED_RECORDS, len(records))
+
+    def enqueue_system(self, sample, events):
+        """
+        Queue a system sample and the events detected in it, safe to call from any thread
+        They are written in the same transaction as the CPU usage records
+        :param sample: dict returned by SystemSampler.sample(), None if there is no sample
+        :param events: list of (timestamp, event text)
+        """
+        if self.isRunning() and (sample or events):
+            self.queue.put((sample, events))
+
+    def submit(self, task):
+        """
+        Run a task on the writer thread after the pending records are flushed
+        The result is delivered with the task_done signal, None if the task failed
+        :param task: callable accepting the store, see storage.STORAGE_BACKENDS
+        :return: False if the writer is not running
+        """
+        if not self.isRunning():
+            return False
+        self.queue.put(task)
+        return True
+
+    def stop(self):
+        """
+        Ask the thread to flush pending records and exit, then wait for it
+        """
+        if self.isRunning():
+            self.queue.put(None)
+            self.wait()
+
+    def run(self):
+        store = make_store(self.storage, self.database_name, retention=self.retention)
+        try:
+            store.open()
+        except (sqlite3.Error, OSError) as e:
+            logger.error("Failed to open database %s: %s", self.database_name, e)
+            store.close()
+            self.opened.emit(False)
+            return
+        self.opened.emit(True)
+        pending = Pending()
+        deadline = time.monotonic() + self.flush_interval
+        running = True
+        while running:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                if item is None:
+                    running = False
+                elif callable(item):
+                    if pending:
+                        self.flush(store, pending)
+                        pending = Pending()
+                    self.run_task(store, item)
+                elif isinstance(item, tuple):
+                    sample, events = item
+                    if sample:
+                        pending.system_samples.append(sample)
+                    pending.events.extend(events)
+                else:
+                    pending.records.extend(item)
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            if now >= deadline or len(pending.records) >= self.max_batch or not running:
+                if pending:
+                    self.flush(store, pending)
+                    pending = Pending()
+                deadline = now + self.flush_interval
+        store.close()
+
+    def flush(self, store, pending):
+        """
+        Write the pending rows in one transaction, timed as the DB_WRITE stage
+        The depth of the queue left behind is sampled at every flush
+        """
+        start = time.perf_counter()
+        try:
+            store.write_batch(pending.records, pending.system_samples, pending.events)
+        except (sqlite3.Error, OSError) as e:
+            logger.error("Failed to insert metrics: %s", e)
+            stats.count(DROPPED_RECORDS, len(pending.records))
+        else:
+            stats.record(DB_WRITE, time.perf_counter() - start)
+            stats.count(ROWS_WRITTEN, len(pending.records))
+            if pending.records:
+                self.batch_written.emit(len(pending.records))
+                self.samples_written.emit(min(record['timestamp'] for record in pending.records))
+            if pending.events:
+                self.events_written.emit(len(pending.events))
+        stats.gauge(QUEUE_DEPTH, self.queue.qsize())
+
+    def run_task(self, store, task):
+        try:
+            result = task(store)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logger.error("Failed to run database task: %s", e)
+            self.task_done.emit(None)
+        else:
+            self.task_done.emit(result)
+
+    def report_progress(self, done, total):
+        """
+        Progress callback for tasks, emits task_progress
+        """
+        self.task_progress.emit(int(done * 100 / total) if total else 100)
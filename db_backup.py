@@ -0,0 +1,377 @@
+import json
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import zipfile
+from datetime import datetime
+
+from columnar_store import Segment, segment_directory, segment_files, SEGMENT_DIRECTORY_SUFFIX
+from sqlite_store import SQLiteStore
+
+# Pages copied per step of the online backup
+BACKUP_PAGES = 1024
+# Chunk size used when streaming the snapshot into the archive
+CHUNK_SIZE = 1 << 20
+# Archive entry listing the segments of the columnar backend archived with the database,
+# {segment file name: offset in the segment of the archived bytes}, see archive_segments()
+SEGMENTS_MANIFEST = "segments.json"
+INCREMENTAL_SUFFIX = "-incremental"
+
+
+def backup_file_name(database_name, incremental=False):
+    """
+    :param database_name: path to the database
+    :param incremental: name of an incremental backup
+    :return: archive name like CpuMetrics-YYYYMMDD-HHMMSS.zip
+    """
+    suffix = INCREMENTAL_SUFFIX if incremental else ""
+    return f"{database_name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}{suffix}.zip"
+
+
+def state_file_name(database_name):
+    """
+    The state file keeps the last IDs archived per table, the last revision of the write log
+    and the size archived per segment,
+    it is the baseline of the next incremental backup
+    """
+    return f"{database_name}.backup.json"
+
+
+def load_state(database_name):
+    try:
+        with open(state_file_name(database_name), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(database_name, state):
+    with open(state_file_name(database_name), 'w') as file:
+        json.dump(state, file)
+
+
+def full_backup(database_name, backup_file, pages=BACKUP_PAGES, progress=None):
+    """
+    Copy the database with the SQLite online backup API and stream the copy into a zip archive
+    The copy is made in steps of `pages` pages from one read transaction:
+    the snapshot is consistent and, thanks to WAL journaling, writers are not blocked meanwhile
+    The complete chunks of the segments of the columnar backend are archived next to the database
+    :param database_name: path to the database
+    :param backup_file: path to the archive
+    :param pages: pages copied per step
+    :param progress: callable(done, total) called after every step
+    """
+    snapshot_file = temporary_file(backup_file)
+    try:
+        source = sqlite3.connect(database_name, isolation_level=None)
+        snapshot = sqlite3.connect(snapshot_file)
+        try:
+            # Without the read transaction every commit of a writer would restart the copy
+            source.execute("BEGIN")
+            source.execute("SELECT count(*) FROM sqlite_master")
+            source.backup(snapshot, pages=pages, progress=step_progress(progress))
+            source.execute("COMMIT")
+            state = {
+                'partitions': last_ids(snapshot), 'events': last_event_id(snapshot),
+                'revision': last_revision(snapshot), 'segments': segment_ends(database_name)
+            }
+        finally:
+            snapshot.close()
+            source.close()
+        compress(snapshot_file, backup_file, os.path.basename(database_name))
+        archive_segments(backup_file, database_name, state['segments'])
+    finally:
+        os.remove(snapshot_file)
+    save_state(database_name, state)
+
+
+def incremental_backup(database_name, backup_file, progress=None):
+    """
+    Archive only the rows added since the last backup: new partitions as a whole,
+    rows with a greater ID of the partitions archived before, new system events, and the system samples,
+    process metrics, family totals and rollup buckets from the oldest timestamp written since the last backup,
+    samples buffered by the agents commit late with old timestamps, see SQLiteStore.CREATE_WRITE_LOG
+    The increment is a SQLite database with the same table names, it can be merged with INSERT OR REPLACE,
+    segments of the columnar backend are append-only, only the chunks written since the last backup are archived
+    Falls back to a full backup if there was no backup before
+    :param database_name: path to the database
+    :param backup_file: path to the archive
+    :param progress: callable(done, total) called after every table
+    """
+    state = load_state(database_name)
+    if state is None:
+        full_backup(database_name, backup_file, progress=progress)
+        return
+    snapshot_file = temporary_file(backup_file)
+    try:
+        source = sqlite3.connect(database_name, isolation_level=None)
+        try:
+            source.execute("ATTACH DATABASE ? AS increment", (snapshot_file,))
+            source.execute("BEGIN")
+            partitions = source.execute(
+                "SELECT Name, Start, End FROM main.CpuWorkloadPartitions ORDER BY Start"
+            ).fetchall()
+            rollups = [name for name, in source.execute(
+                "SELECT name FROM main.sqlite_master WHERE type = 'table' AND name LIKE 'CpuWorkloadRollup%'"
+            )]
+            since = oldest_written(source, state.get('revision'))
+            # A rollup bucket starts up to one hour before the samples it holds
+            rollups_since = since - 3600
+            total = len(partitions) + len(rollups) + 1
+            source.execute(
+                "CREATE TABLE increment.CpuWorkloadPartitions AS SELECT * FROM main.CpuWorkloadPartitions"
+            )
+            for done, (name, _, _) in enumerate(partitions, start=1):
+                source.execute(
+                    f"CREATE TABLE increment.{name} AS SELECT * FROM main.{name} WHERE ID > ?",
+                    (state['partitions'].get(name, 0),)
+                )
+                if progress:
+                    progress(done, total)
+            for done, name in enumerate(rollups, start=len(partitions) + 1):
+                source.execute(
+                    f"CREATE TABLE increment.{name} AS SELECT * FROM main.{name} WHERE Bucket >= ?", (rollups_since,)
+                )
+                if progress:
+                    progress(done, total)
+            source.execute(
+                "CREATE TABLE increment.SystemEvents AS SELECT * FROM main.SystemEvents WHERE ID > ?",
+                (state['events'],)
+            )
+            if has_table(source, "main", "SystemMetrics"):
+                source.execute(
+                    "CREATE TABLE increment.SystemMetrics AS SELECT * FROM main.SystemMetrics WHERE Timestamp >= ?",
+                    (since,)
+                )
+            if has_table(source, "main", "ProcessMetrics"):
+                source.execute(
+                    "CREATE TABLE increment.ProcessMetrics AS SELECT * FROM main.ProcessMetrics WHERE Timestamp >= ?",
+                    (since,)
+                )
+            if has_table(source, "main", "FamilyWorkload"):
+                source.execute(
+                    "CREATE TABLE increment.FamilyWorkload AS SELECT * FROM main.FamilyWorkload WHERE Timestamp >= ?",
+                    (since,)
+                )
+            new_state = {
+                'partitions': last_ids(source, "main"), 'events': last_event_id(source, "main"),
+                'revision': last_revision(source, "main"), 'segments': segment_ends(database_name)
+            }
+            source.execute("COMMIT")
+            source.execute("DETACH DATABASE increment")
+            if progress:
+                progress(total, total)
+        finally:
+            source.close()
+        compress(snapshot_file, backup_file, os.path.basename(database_name) + INCREMENTAL_SUFFIX)
+        archive_segments(backup_file, database_name, new_state['segments'], state.get('segments', {}))
+    finally:
+        os.remove(snapshot_file)
+    save_state(database_name, new_state)
+
+
+def restore_backup(backup_file, database_name):
+    """
+    Restore a full backup, replacing the database, or merge an incremental backup into the database restored
+    from the backups made before it, in the order they were made
+    The segments archived with the database are written back into its segment directory
+    The database must not be open meanwhile
+    :param backup_file: path to the archive
+    :param database_name: path to the database
+    :raise ValueError: if an incremental backup does not continue the segments restored before
+    """
+    directory = segment_directory(database_name)
+    with zipfile.ZipFile(backup_file) as archive:
+        names = archive.namelist()
+        entry = next(name for name in names if "/" not in name and name != SEGMENTS_MANIFEST)
+        incremental = entry.endswith(INCREMENTAL_SUFFIX)
+        snapshot_file = temporary_file(database_name)
+        try:
+            with archive.open(entry) as source, open(snapshot_file, "wb") as target:
+                shutil.copyfileobj(source, target, CHUNK_SIZE)
+            if incremental:
+                merge_increment(snapshot_file, database_name)
+            else:
+                # The journal of the replaced database must not be applied to the restored one
+                for journal in (database_name + "-wal", database_name + "-shm"):
+                    if os.path.exists(journal):
+                        os.remove(journal)
+                shutil.rmtree(directory, ignore_errors=True)
+                os.replace(snapshot_file, database_name)
+        finally:
+            if os.path.exists(snapshot_file):
+                os.remove(snapshot_file)
+        if SEGMENTS_MANIFEST in names:
+            prefix = entry[:-len(INCREMENTAL_SUFFIX)] if incremental else entry
+            restore_segments(archive, prefix + SEGMENT_DIRECTORY_SUFFIX + "/", directory)
+
+
+def merge_increment(increment_file, database_name):
+    """
+    Insert or replace the rows of an incremental backup into the database, creating the partitions it adds
+    """
+    store = SQLiteStore(database_name)
+    # Connected without SQLiteStore.open(), which would apply the retention to the restored samples
+    store.connection = sqlite3.connect(database_name, isolation_level=None)
+    try:
+        store.connection.execute("ATTACH DATABASE ? AS increment", (increment_file,))
+        with store.transaction():
+            store.load_partitions()
+            for name, start in store.connection.execute(
+                "SELECT Name, Start FROM increment.CpuWorkloadPartitions"
+            ).fetchall():
+                store.ensure_partition(name, start)
+            tables = [name for name, in store.connection.execute(
+                "SELECT name FROM increment.sqlite_master WHERE type = 'table' AND name != 'CpuWorkloadPartitions'"
+            ).fetchall()]
+            for table in tables:
+                if has_table(store.connection, "main", table):
+                    store.connection.execute(f"INSERT OR REPLACE INTO main.{table} SELECT * FROM increment.{table}")
+    finally:
+        store.close()
+
+
+def segment_ends(database_name):
+    """
+    :param database_name: path to the database
+    :return: dict {segment file name: offset after its last complete chunk} of the columnar backend
+    """
+    ends = {}
+    for path in segment_files(segment_directory(database_name)).values():
+        segment = Segment(path)
+        try:
+            segment.refresh()
+        finally:
+            segment.close()
+        if segment.end:
+            ends[os.path.basename(path)] = segment.end
+    return ends
+
+
+def archive_segments(backup_file, database_name, ends, archived=None):
+    """
+    Add the segments to the archive, up to the end of their last complete chunk:
+    a chunk being written by a collector is left for the next backup
+    Segments are append-only, an incremental backup archives the bytes after the ends archived before
+    :param backup_file: path to the archive
+    :param database_name: path to the database
+    :param ends: {segment file name: end offset} to archive, see segment_ends()
+    :param archived: {segment file name: end offset} archived by the last backup, None for a full backup
+    """
+    offsets = {}
+    for filename, end in ends.items():
+        offset = (archived or {}).get(filename, 0)
+        # A segment shorter than archived before was deleted and written again
+        offsets[filename] = offset if offset <= end else 0
+    if not offsets and not archived:
+        return
+    directory = segment_directory(database_name)
+    prefix = os.path.basename(directory) + "/"
+    with zipfile.ZipFile(backup_file, "a", compression=zipfile.ZIP_DEFLATED) as archive:
+        for filename, offset in offsets.items():
+            with open(os.path.join(directory, filename), "rb") as source, \
+                    archive.open(prefix + filename, "w", force_zip64=True) as target:
+                source.seek(offset)
+                remaining = ends[filename] - offset
+                while remaining:
+                    data = source.read(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        raise ValueError(f"{filename} was truncated while it was archived")
+                    target.write(data)
+                    remaining -= len(data)
+        archive.writestr(SEGMENTS_MANIFEST, json.dumps(offsets))
+
+
+def restore_segments(archive, prefix, directory):
+    """
+    Write the segments of an archive into the segment directory, the bytes of an incremental backup are written
+    at the offset they were archived from
+    :param archive: open ZipFile
+    :param prefix: directory of the segments in the archive
+    :param directory: segment directory of the database
+    """
+    offsets = json.loads(archive.read(SEGMENTS_MANIFEST))
+    os.makedirs(directory, exist_ok=True)
+    for filename, offset in offsets.items():
+        path = os.path.join(directory, filename)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size < offset:
+            raise ValueError(f"{archive.filename} continues {filename} of a backup not restored yet")
+        with archive.open(prefix + filename) as source, open(path, "r+b" if size else "wb") as target:
+            target.truncate(offset)
+            target.seek(offset)
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+
+
+def compress(source_file, backup_file, name):
+    """
+    Stream a file into a deflate-compressed zip archive in fixed-size chunks
+    """
+    with zipfile.ZipFile(backup_file, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with open(source_file, "rb") as source, archive.open(name, "w", force_zip64=True) as target:
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+
+
+def temporary_file(backup_file):
+    """
+    Snapshots are created next to the archive, where there is enough space for it
+    """
+    handle, path = tempfile.mkstemp(suffix=".db", dir=os.path.dirname(os.path.abspath(backup_file)))
+    os.close(handle)
+    return path
+
+
+def step_progress(progress):
+    if progress is None:
+        return None
+    return lambda status, remaining, total: progress(total - remaining, total)
+
+
+def last_ids(connection, schema="main"):
+    """
+    :return: dict {partition name: maximal ID}
+    """
+    names = [name for name, in connection.execute(f"SELECT Name FROM {schema}.CpuWorkloadPartitions")]
+    return {
+        name: connection.execute(f"SELECT max(ID) FROM {schema}.{name}").fetchone()[0] or 0 for name in names
+    }
+
+
+def last_event_id(connection, schema="main"):
+    return connection.execute(f"SELECT max(ID) FROM {schema}.SystemEvents").fetchone()[0] or 0
+
+
+def has_table(connection, schema, table):
+    # Databases created by older versions may miss the tables added later
+    return connection.execute(
+        f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+
+def last_revision(connection, schema="main"):
+    """
+    :return: last revision of the write log, kept by AUTOINCREMENT when the log is pruned
+    """
+    if not has_table(connection, schema, "WriteLog"):
+        return 0
+    row = connection.execute(f"SELECT seq FROM {schema}.sqlite_sequence WHERE name = 'WriteLog'").fetchone()
+    return row[0] if row else 0
+
+
+def oldest_written(connection, revision, schema="main"):
+    """
+    :param connection: connection in the read transaction of the backup
+    :param revision: last revision of the write log archived, None for the backups made before the write log
+    :return: oldest timestamp written by the revisions after it, infinity if nothing was written,
+             minus infinity if the revisions right after it were pruned by the retention
+    """
+    if revision is None or not has_table(connection, schema, "WriteLog"):
+        return -math.inf
+    if revision == last_revision(connection, schema):
+        return math.inf
+    first, oldest = connection.execute(
+        f"SELECT min(Revision), min(Oldest) FROM {schema}.WriteLog WHERE Revision > ?", (revision,)
+    ).fetchone()
+    return oldest if first == revision + 1 else -math.inf
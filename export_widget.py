@@ -0,0 +1,74 @@
+from PyQt5.QtCore import QDateTime
+from PyQt5.QtWidgets import (QDialogButtonBox, QCheckBox, QDialog, QVBoxLayout, QFormLayout, QDateTimeEdit,
+                             QLineEdit, QFileDialog)
+
+import data_transfer
+
+FILE_FILTERS = f"CSV (*.csv);;Columnar (*{data_transfer.COLUMNAR_EXTENSION})"
+
+
+class ExportWidget(QDialog):
+    """
+    Widget representing modal window Export: time range, process and output file of the export
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Export")
+        self.path = None
+        layout = QVBoxLayout()
+        form_layout = QFormLayout()
+
+        # Time range, the last day by default
+        self.time_range_checkbox = QCheckBox("Export only a time range")
+        self.start_edit = QDateTimeEdit(QDateTime.currentDateTime().addDays(-1))
+        self.end_edit = QDateTimeEdit(QDateTime.currentDateTime())
+        for edit in (self.start_edit, self.end_edit):
+            edit.setCalendarPopup(True)
+            edit.setEnabled(False)
+            # noinspection PyUnresolvedReferences
+            self.time_range_checkbox.toggled.connect(edit.setEnabled)
+        layout.addWidget(self.time_range_checkbox)
+        form_layout.addRow("From:", self.start_edit)
+        form_layout.addRow("To:", self.end_edit)
+
+        # Process name, all processes if empty
+        self.process_edit = QLineEdit()
+        self.process_edit.setPlaceholderText("All processes")
+        form_layout.addRow("Process:", self.process_edit)
+        layout.addLayout(form_layout)
+
+        # Add buttons
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        # noinspection PyUnresolvedReferences
+        button_box.accepted.connect(self.choose_file)
+        # noinspection PyUnresolvedReferences
+        button_box.rejected.connect(self.reject)
+        layout.addWidget(button_box)
+        self.setLayout(layout)
+
+    def choose_file(self):
+        """
+        Ask for the output file, the format is chosen by the file type
+        """
+        path, file_filter = QFileDialog.getSaveFileName(self, "Export", "CpuWorkload.csv", FILE_FILTERS)
+        if not path:
+            return
+        if file_filter.startswith("Columnar") and not path.endswith(data_transfer.COLUMNAR_EXTENSION):
+            path += data_transfer.COLUMNAR_EXTENSION
+        self.path = path
+        self.accept()
+
+    def time_range(self):
+        """
+        :return: (start, end) timestamps, (None, None) if the time range is not limited
+        """
+        if not self.time_range_checkbox.isChecked():
+            return None, None
+        return self.start_edit.dateTime().toSecsSinceEpoch(), self.end_edit.dateTime().toSecsSinceEpoch()
+
+    def process(self):
+        """
+        :return: process name, None for all processes
+        """
+        return self.process_edit.text().strip() or None
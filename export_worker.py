@@ -0,0 +1,52 @@
+import logging
+import sqlite3
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+import data_transfer
+
+logger = logging.getLogger(__name__)
+
+
+# noinspection PyUnresolvedReferences
+class ExportWorker(QThread):
+    """
+    Exports CpuWorkload on a worker thread, see data_transfer
+    Neither the GUI nor the collection of samples is paused meanwhile
+    """
+
+    # Percent of the export done
+    progress = pyqtSignal(int)
+    # Number of exported samples, -1 if the export failed
+    finished_export = pyqtSignal(int)
+
+    def __init__(self, database_name, path, start=None, end=None, process=None, parent=None):
+        """
+        :param database_name: path to the database
+        :param path: output file, CSV or columnar (.cpuc)
+        :param start: export samples from this timestamp on, None for unbounded
+        :param end: export samples before this timestamp, None for unbounded
+        :param process: export only the process with this name, None for all
+        :param parent: parent object
+        """
+        super().__init__(parent)
+        self.database_name = database_name
+        self.path = path
+        self.start_time = start
+        self.end_time = end
+        self.process = process
+
+    def run(self):
+        try:
+            count = data_transfer.export_file(
+                self.database_name, self.path, start=self.start_time, end=self.end_time, process=self.process,
+                progress=self.report_progress
+            )
+        except (sqlite3.Error, OSError) as e:
+            logger.error("Failed to export data: %s", e)
+            self.finished_export.emit(-1)
+        else:
+            self.finished_export.emit(count)
+
+    def report_progress(self, done, total):
+        self.progress.emit(int(done * 100 / total) if total else 100)
@@ -0,0 +1,220 @@
+import json
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# Stages of the pipeline timed by the monitor
+SAMPLE = 'sample'  # One sampling tick on the worker thread: refresh, read the processes, build the records
+EMIT = 'emit'  # From the signal emitted by the worker thread to the slot running in the GUI thread
+DB_WRITE = 'db_write'  # One flush transaction of the database writer
+RENDER = 'render'  # One chart frame: lines blitted over the cached background
+DRAW = 'draw'  # One full redraw of the chart figure
+STAGES = (SAMPLE, EMIT, DB_WRITE, RENDER, DRAW)
+
+# Counters
+TICKS = 'ticks'
+DROPPED_TICKS = 'dropped_ticks'  # Ticks skipped because sampling took longer than the interval
+DROPPED_RECORDS = 'dropped_records'  # Records not queued because the database writer was not running
+ROWS_WRITTEN = 'rows_written'
+COUNTERS = (TICKS, DROPPED_TICKS, DROPPED_RECORDS, ROWS_WRITTEN)
+
+# Gauges
+QUEUE_DEPTH = 'queue_depth'  # Items waiting in the queue of the database writer
+
+# CPU used by the monitor itself, in percent of the machine like the usage of the watched processes
+CPU_BUDGET = 1.0
+# Startup of the GUI in seconds: importing monitor_ui, and from the start of the process to the first paint
+# of the main window, see MainWindow.paintEvent() and the startup benchmark of monitor_bench
+IMPORT_BUDGET = 0.3
+FIRST_PAINT_BUDGET = 1.0
+
+
+class Histogram:
+    """
+    Cumulative histogram of durations with logarithmic buckets, 4 per power of two from 1 us to about 18 minutes,
+    so percentiles are rounded up by at most 19%
+    Recording is a logarithm and two additions, nothing is allocated and no lock is taken:
+    every histogram is written by the one thread running its stage
+    Summaries of a period are differences of the counts against a baseline taken at the start of the period
+    """
+
+    MIN_DURATION = 1e-6
+    BUCKETS_PER_OCTAVE = 4
+    NUM_BUCKETS = 30 * BUCKETS_PER_OCTAVE
+
+    def __init__(self):
+        self.counts = [0] * self.NUM_BUCKETS
+        self.total = 0.0  # Seconds
+
+    def record(self, seconds):
+        if seconds > self.MIN_DURATION:
+            bucket = min(int(math.log2(seconds / self.MIN_DURATION) * self.BUCKETS_PER_OCTAVE), self.NUM_BUCKETS - 1)
+        else:
+            bucket = 0
+        self.counts[bucket] += 1
+        self.total += seconds
+
+    def baseline(self):
+        """
+        :return: (counts, total) to be passed to summary() at the end of the period
+        """
+        return list(self.counts), self.total
+
+    @classmethod
+    def upper_bound(cls, bucket):
+        return cls.MIN_DURATION * 2 ** ((bucket + 1) / cls.BUCKETS_PER_OCTAVE)
+
+    def summary(self, baseline=None):
+        """
+        :param baseline: value of baseline() at the start of the period, None for the whole run
+        :return: dict with the number of samples, and mean, p50, p95, p99 and max durations in milliseconds
+        """
+        counts, total = (self.counts, self.total) if baseline is None else (
+            [count - previous for count, previous in zip(self.counts, baseline[0])], self.total - baseline[1]
+        )
+        count = sum(counts)
+        summary = {'count': count, 'mean_ms': total / count * 1000 if count else 0.0}
+        percentiles = (('p50_ms', 50), ('p95_ms', 95), ('p99_ms', 99), ('max_ms', 100))
+        for key, _ in percentiles:
+            summary[key] = 0.0
+        if not count:
+            return summary
+        cumulative, rank = 0, 0
+        for bucket, bucket_count in enumerate(counts):
+            if not bucket_count:
+                continue
+            cumulative += bucket_count
+            while rank < len(percentiles) and cumulative >= count * percentiles[rank][1] / 100:
+                summary[percentiles[rank][0]] = self.upper_bound(bucket) * 1000
+                rank += 1
+        return summary
+
+
+class Instrumentation:
+    """
+    Self-observability of the monitor: durations of the pipeline stages, counters and gauges,
+    and the CPU time and memory used by the monitor process itself
+    Everything is cumulative since start; every reporter, e.g. the status panel and the periodic log,
+    gets the summary of the period since its own previous report
+    Histograms have one writer each, the counters are updated by several threads under a lock
+    """
+
+    # Emits waiting for their slot, older ones are forgotten if the GUI thread is stalled
+    MAX_IN_FLIGHT = 256
+
+    def __init__(self):
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.counters_lock = threading.Lock()
+        self.gauges = {}  # {name: current value}
+        self.peaks = {}  # {name: highest value}
+        self.emitted = {}  # {signal name: deque of perf_counter() at the emits not delivered yet}
+        self.process = psutil.Process()
+        self.num_cores = psutil.cpu_count() or 1
+        cpu_times = self.process.cpu_times()
+        self.started = (time.monotonic(), cpu_times.user + cpu_times.system)
+        self.baselines = {}  # {reporter: (clock, cpu time, histogram baselines, counters)}
+
+    def record(self, stage, seconds):
+        """
+        :param stage: one of STAGES
+        :param seconds: duration, measured with time.perf_counter()
+        """
+        self.histograms[stage].record(seconds)
+
+    def count(self, counter, increment=1):
+        """
+        :param counter: one of COUNTERS
+        :param increment: added to the counter, called from the GUI, writer and watcher threads
+        """
+        with self.counters_lock:
+            self.counters[counter] = self.counters.get(counter, 0) + increment
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+        if name not in self.peaks or value > self.peaks[name]:
+            self.peaks[name] = value
+
+    def emitting(self, signal):
+        """
+        Note the time a cross-thread signal is emitted, the slot calls delivered() with the same name
+        Queued signals are delivered in order, so the emits and the deliveries pair up
+        """
+        emitted = self.emitted.get(signal)
+        if emitted is None:
+            emitted = self.emitted[signal] = deque(maxlen=self.MAX_IN_FLIGHT)
+        emitted.append(time.perf_counter())
+
+    def delivered(self, signal):
+        """
+        Record the delay between the emit of a signal and its slot as the EMIT stage
+        """
+        emitted = self.emitted.get(signal)
+        if emitted:
+            self.histograms[EMIT].record(time.perf_counter() - emitted.popleft())
+
+    def report(self, reporter):
+        """
+        Summary of the period since the previous report of the same reporter
+        :param reporter: name of the reporter, e.g. 'panel' or 'log'
+        :return: dict with the keys 'time', 'period' (seconds), 'cpu_percent' (of the machine),
+                 'cpu_budget_exceeded', 'rss' (bytes), 'stages' ({stage: summary of its Histogram}),
+                 'counters' (increments in the period), 'gauges' and 'peaks'
+        """
+        clock = time.monotonic()
+        cpu_times = self.process.cpu_times()
+        cpu_time = cpu_times.user + cpu_times.system
+        previous = self.baselines.get(reporter)
+        if previous is None:
+            previous = (*self.started, {}, {})
+        previous_clock, previous_cpu_time, histograms, counters = previous
+        period = clock - previous_clock
+        cpu_percent = (cpu_time - previous_cpu_time) / period * 100 / self.num_cores if period > 0 else 0.0
+        with self.counters_lock:
+            current = dict(self.counters)
+        report = {
+            'time': time.time(),
+            'period': period,
+            'cpu_percent': cpu_percent,
+            'cpu_budget_exceeded': cpu_percent > CPU_BUDGET,
+            'rss': self.process.memory_info().rss,
+            'stages': {
+                stage: histogram.summary(histograms.get(stage)) for stage, histogram in self.histograms.items()
+            },
+            'counters': {name: value - counters.get(name, 0) for name, value in current.items()},
+            'gauges': dict(self.gauges),
+            'peaks': dict(self.peaks),
+        }
+        self.baselines[reporter] = (
+            clock, cpu_time, {stage: histogram.baseline() for stage, histogram in self.histograms.items()}, current
+        )
+        return report
+
+    def log_report(self, reporter='log'):
+        """
+        Write the report of the period as one structured log record, the JSON document is the message
+        and is also attached to the record as the attribute 'instrumentation'
+        """
+        report = self.report(reporter)
+        level = logging.WARNING if report['cpu_budget_exceeded'] else logging.INFO
+        logger.log(level, json.dumps(report, separators=(',', ':')), extra={'instrumentation': report})
+        return report
+
+
+# Shared by the threads of the monitor
+stats = Instrumentation()
+
+
+def configure_logging(level="INFO"):
+    """
+    Leveled logging to stderr for the GUI and the command line interface
+    :param level: name of the level, e.g. DEBUG to log every sample
+    """
+    logging.basicConfig(level=getattr(logging, level.upper(), logging.INFO),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
@@ -0,0 +1,888 @@
+import argparse
+import asyncio
+import ctypes
+import json
+import math
+import os
+import platform
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Qt is imported by the benchmarks of the widgets only, and always without a display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+import psutil
+
+from aggregator import Aggregator, AgentSender
+from analytics import WindowAnalytics
+from cpu_sampler import CPUSampler, PROCESS_METRICS, available_backends
+from instrumentation import IMPORT_BUDGET, FIRST_PAINT_BUDGET
+from rules_engine import RulesEngine, RULE_KINDS
+import columnar_store
+import data_transfer
+from sqlite_store import SQLiteStore, overlapping_partitions
+from storage import STORAGE_BACKENDS, make_store
+from time_series import TimeSeriesStore
+
+# Version of the layout of the results file
+RESULTS_VERSION = 1
+# Name of the sampler backend replaced by FakeProcessRegistry
+FAKE_BACKEND = 'fake'
+# Name given to the spawned busy-loop processes
+BUSY_NAME = 'bench-busy'
+# prctl() option renaming the calling thread, see prctl(2)
+PR_SET_NAME = 15
+# Direction of improvement of a result
+LOWER, HIGHER = 'lower', 'higher'
+# Names the fake processes are built from, suffixed with a number
+FAKE_NAMES = ('chrome', 'python', 'postgres', 'nginx', 'java', 'node', 'systemd', 'kworker', 'bash', 'sshd')
+# Start of the simulated timestamps, fixed so the partitions and buckets are the same on every run
+EPOCH = 1700000000.0
+# Run in a fresh interpreter by the startup benchmark, prints the seconds taken to import monitor_ui,
+# then the seconds from the start of the process to the first paint of the main window
+STARTUP_SCRIPT = """
+import sys
+import time
+start = time.perf_counter()
+import monitor_ui
+print(time.perf_counter() - start)
+from PyQt5.QtWidgets import QApplication
+app = QApplication(sys.argv[:1])
+window = monitor_ui.MainWindow(monitor_ui.CPUWatcher([], interval=1))
+window.first_painted.connect(lambda elapsed: (print(elapsed), app.quit()))
+window.show()
+app.exec_()
+window.database_widget.close_db()
+"""
+
+
+class FakeProcessRegistry:
+    """
+    Deterministic process source with the interface of the sampler backends, see ProcessRegistry
+    Nothing is read from the system: every process consumes CPU time at a constant rate on a simulated clock
+    advancing by one second per tick, so the benchmarks of the sampler measure its own bookkeeping only
+    A fraction of the processes is replaced by new ones on every refresh, with the same seeded choices on every run
+    """
+
+    def __init__(self, num_processes, churn=0.0, seed=0):
+        """
+        :param num_processes: number of processes, kept constant by the churn
+        :param churn: fraction of the processes exiting and replaced on every refresh
+        :param seed: seed of the choices of the churn
+        """
+        self.num_processes = num_processes
+        self.churn = churn
+        self.random = random.Random(seed)
+        self.now = 0.0
+        self.next_pid = 1000
+        self.keys = {}  # {pid: (pid, start)}
+        self.names = {}  # {pid: name}
+        self.parents = {}  # {pid: ppid}
+        self.rates = {}  # {pid: CPU seconds per second}
+        self.table = {}  # {pid: name} of the simulated process table, the registry lags it until refreshed
+        for _ in range(num_processes):
+            self.spawn()
+
+    @staticmethod
+    def available():
+        return True
+
+    @property
+    def watched(self):
+        """
+        :return: sorted distinct names of the processes, watching them all samples every process
+        """
+        return sorted(set(self.table.values()))
+
+    def spawn(self):
+        pid = self.next_pid
+        self.next_pid += 1
+        # New processes take the names of the exited ones, so the watched names do not change
+        index = (pid - 1000) % self.num_processes
+        self.table[pid] = f"{FAKE_NAMES[index % len(FAKE_NAMES)]}{index // len(FAKE_NAMES) % 100}"
+        # Up to one core, so that the usage stays realistic
+        self.rates[pid] = (pid * 7919 % 1000) / 1000
+
+    def refresh(self, verify=()):
+        """
+        Diff the simulated process table against the known processes, see ProcessRegistry.refresh()
+        :param verify: ignored, PIDs are never reused
+        :return: tuple (added, exited), lists of (pid, name)
+        """
+        if self.keys and self.churn:
+            for pid in self.random.sample(sorted(self.table), int(len(self.table) * self.churn)):
+                del self.table[pid]
+                self.spawn()
+        gone = self.keys.keys() - self.table.keys()
+        new = self.table.keys() - self.keys.keys()
+        keys, names, parents = dict(self.keys), dict(self.names), dict(self.parents)
+        exited = [(pid, names[pid]) for pid in sorted(gone)]
+        for pid in gone:
+            del keys[pid], names[pid], parents[pid]
+        added = []
+        for pid in sorted(new):
+            keys[pid] = (pid, self.now)
+            names[pid] = self.table[pid]
+            parents[pid] = 1
+            added.append((pid, names[pid]))
+        self.keys, self.names, self.parents = keys, names, parents
+        return added, exited
+
+    def read(self, pids, metrics=()):
+        """
+        :return: dict {pid: (cpu_time, values)}, see ProcessRegistry.read()
+        """
+        readings = {}
+        now = self.now
+        for pid in pids:
+            rate = self.rates.get(pid)
+            if rate is None:
+                continue
+            cpu_time = rate * (now - self.keys[pid][1])
+            values = {metric: int(cpu_time * 1000) for metric in metrics} if metrics else None
+            readings[pid] = (cpu_time, values)
+        return readings
+
+    def clock(self):
+        """
+        :return: seconds of the simulated clock, one more on every call, the sampler reads it once per tick
+        """
+        self.now += 1.0
+        return self.now
+
+    def key(self, pid):
+        return self.keys.get(pid)
+
+    def name(self, pid):
+        return self.names.get(pid)
+
+    def clear(self):
+        self.keys, self.names, self.parents = {}, {}, {}
+
+
+def result(value, unit, better=LOWER, budget=None):
+    """
+    :param value: measured value
+    :param unit: unit of the value, e.g. ms
+    :param better: LOWER or HIGHER, direction of improvement used by the comparison with a baseline
+    :param budget: highest acceptable value, the run fails above it whatever the baseline, None for no budget
+    :return: dict, one entry of the results file
+    """
+    entry = {'value': value, 'unit': unit, 'better': better}
+    if budget is not None:
+        entry['budget'] = budget
+    return entry
+
+
+def timings(function, repeat, warmup=2):
+    """
+    Call a function repeatedly
+    :param function: callable without arguments
+    :param repeat: number of timed calls
+    :param warmup: number of calls before timing
+    :return: list of durations in seconds
+    """
+    for _ in range(warmup):
+        function()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def percentile(durations, percent):
+    """
+    :return: percentile of the durations with the nearest-rank method, in milliseconds
+    """
+    ordered = sorted(durations)
+    return ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)] * 1000
+
+
+def latency_results(prefix, durations):
+    """
+    :return: results with the median and 95th percentile of the durations in milliseconds
+    """
+    return {
+        f'{prefix}.median_ms': result(statistics.median(durations) * 1000, 'ms'),
+        f'{prefix}.p95_ms': result(percentile(durations, 95), 'ms'),
+    }
+
+
+def sampler_tick(sampler):
+    """
+    :return: function taking one tick the way CPUWatcher does, without Qt
+    """
+    def tick():
+        if sampler.refresh_due():
+            sampler.refresh_processes()
+        cpu_usage = sampler.get_cpu_usage()
+        sampler.metric_series(cpu_usage)
+        sampler.make_records(cpu_usage)
+    return tick
+
+
+def bench_sampler(args):
+    """
+    Sampler throughput with the fake process source
+    """
+    results = {}
+    for count in args.counts:
+        registry = FakeProcessRegistry(count, churn=args.churn, seed=args.seed)
+        sampler = CPUSampler(registry.watched, metrics=args.metrics)
+        # The fake process source replaces the registry of the backend
+        sampler.backend, sampler.registry = FAKE_BACKEND, registry
+        durations = timings(sampler_tick(sampler), args.repeat)
+        results.update(latency_results(f'sampler.{FAKE_BACKEND}.{count}.tick', durations))
+        results[f'sampler.{FAKE_BACKEND}.{count}.pids_per_s'] = result(
+            count / statistics.median(durations), 'pids/s', HIGHER
+        )
+    return results
+
+
+def set_process_name(name):
+    """
+    Rename the calling process on Linux, the way ps and psutil show it
+    """
+    try:
+        ctypes.CDLL(None).prctl(PR_SET_NAME, name.encode(), 0, 0, 0)
+    except (OSError, AttributeError):
+        pass
+
+
+def busy_loop(duty, parent, period=0.1):
+    """
+    Burn CPU for a fraction of every period until the parent exits
+    :param duty: fraction of the period spent spinning
+    :param parent: PID of the benchmark
+    :param period: seconds
+    """
+    while os.getppid() == parent:
+        end = time.perf_counter() + duty * period
+        while time.perf_counter() < end:
+            pass
+        time.sleep(period * (1 - duty))
+
+
+def spawn_busy_processes(count, duty):
+    """
+    Fork processes named BUSY_NAME running busy_loop(), forked children share the memory of the benchmark
+    :return: list of PIDs
+    """
+    parent = os.getpid()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pids = []
+    for _ in range(count):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                set_process_name(BUSY_NAME)
+                busy_loop(duty, parent)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    return pids
+
+
+def stop_processes(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+def bench_real(args):
+    """
+    Sampler throughput of every available backend with spawned busy-loop processes
+    Together the processes keep half of the cores busy, whatever their number
+    """
+    if not hasattr(os, 'fork'):
+        print("Skipping the real processes: fork() is not available")
+        return {}
+    results = {}
+    num_cores = psutil.cpu_count() or 1
+    for count in args.real_counts:
+        pids = spawn_busy_processes(count, min(0.5, 0.5 * num_cores / count))
+        try:
+            for backend in available_backends():
+                sampler = CPUSampler([BUSY_NAME], metrics=args.metrics, backend=backend)
+                tick = sampler_tick(sampler)
+                # The children are named right after the fork, wait until the registry sees them all
+                deadline = time.monotonic() + 10
+                while time.monotonic() < deadline:
+                    tick()
+                    if sum(1 for name in sampler.registry.names.values() if name == BUSY_NAME) >= count:
+                        break
+                    time.sleep(0.05)
+                durations = timings(tick, args.repeat)
+                results.update(latency_results(f'sampler.{backend}.{count}.tick', durations))
+                results[f'sampler.{backend}.{count}.pids_per_s'] = result(
+                    count / statistics.median(durations), 'pids/s', HIGHER
+                )
+        finally:
+            stop_processes(pids)
+    return results
+
+
+def bench_insert(args):
+    """
+    CpuWorkload insert rate of SQLiteStore, one transaction per flush of several ticks like the collectors
+    """
+    results = {}
+    for label, metrics in (('cpu', ()), ('metrics', args.metrics)):
+        with tempfile.TemporaryDirectory() as directory:
+            store = SQLiteStore(os.path.join(directory, 'bench.db'), retention=30 * 86400)
+            store.open()
+            records, elapsed, rows = [], 0.0, 0
+            try:
+                for tick in range(args.insert_ticks):
+                    timestamp = EPOCH + tick
+                    for pid in range(args.insert_pids):
+                        record = {'pid': 1000 + pid, 'usage': (pid * 7 + tick) % 100 / 1.0,
+                                  'timestamp': timestamp, 'name': FAKE_NAMES[pid % len(FAKE_NAMES)]}
+                        if metrics:
+                            record['metrics'] = {metric: tick * pid for metric in metrics}
+                        records.append(record)
+                    if (tick + 1) % args.flush_ticks == 0 or tick == args.insert_ticks - 1:
+                        start = time.perf_counter()
+                        store.write_batch(records)
+                        elapsed += time.perf_counter() - start
+                        rows += len(records)
+                        records = []
+            finally:
+                store.close()
+        results[f'insert.{label}.rows_per_s'] = result(rows / elapsed, 'rows/s', HIGHER)
+    return results
+
+
+def bench_storage(args):
+    """
+    Footprint and range scans of the raw samples with every storage backend, see storage
+    The samples are written like the collectors, with jittered timestamps and seeded usages;
+    a full scan reads all of them, the history reads the raw samples of one process name over an hour
+    """
+    rng = random.Random(args.seed)
+    ticks = args.storage_hours * 3600
+    samples = ticks * args.storage_pids
+    results = {}
+    for storage in STORAGE_BACKENDS:
+        with tempfile.TemporaryDirectory() as directory:
+            database_name = os.path.join(directory, 'bench.db')
+            store = make_store(storage, database_name, retention=30 * 86400)
+            store.open()
+            try:
+                start = time.perf_counter()
+                for first in range(0, ticks, args.flush_ticks):
+                    store.write_batch([
+                        {'pid': 1000 + pid, 'usage': rng.expovariate(1 / (pid % 10 + 1)),
+                         'timestamp': EPOCH + tick + rng.random() * 0.002, 'name': FAKE_NAMES[pid % len(FAKE_NAMES)]}
+                        for tick in range(first, min(first + args.flush_ticks, ticks))
+                        for pid in range(args.storage_pids)
+                    ])
+                written = time.perf_counter() - start
+                if isinstance(store, columnar_store.ColumnarStore):
+                    store.flush()
+                    raw_bytes = sum(os.path.getsize(path)
+                                    for path in columnar_store.segment_files(store.directory).values())
+                else:
+                    # Sizes of the partitions and their indexes, dbstat is compiled in most builds of SQLite
+                    raw_bytes = store.connection.execute(
+                        "SELECT sum(pgsize) FROM dbstat WHERE name GLOB 'CpuWorkload_[0-9]*'"
+                    ).fetchone()[0]
+
+                def full_scan():
+                    if isinstance(store, columnar_store.ColumnarStore):
+                        for _ in columnar_store.scan(database_name):
+                            pass
+                    else:
+                        for _ in data_transfer.read_chunks(store.connection,
+                                                           overlapping_partitions(store.connection), "", {}):
+                            pass
+                scans = timings(full_scan, min(args.repeat, 5), warmup=1)
+                history = timings(lambda: store.query_history(FAKE_NAMES[0], EPOCH, EPOCH + 3600), args.repeat)
+            finally:
+                store.close()
+        results[f'storage.{storage}.bytes_per_sample'] = result(raw_bytes / samples, 'B')
+        results[f'storage.{storage}.insert_rows_per_s'] = result(samples / written, 'rows/s', HIGHER)
+        results[f'storage.{storage}.scan_rows_per_s'] = result(samples / statistics.median(scans), 'rows/s', HIGHER)
+        results.update(latency_results(f'storage.{storage}.history', history))
+    return results
+
+
+def bench_analytics(args):
+    """
+    Latency of the worst processes over a window of the simulated period, see analytics
+    The first query reads the rollups and the raw samples at the ends, the next ones find the segments memoized
+    except the last ones, invalidated by new samples like the refreshes of the Analysis tab
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        store = SQLiteStore(os.path.join(directory, 'bench.db'), retention=30 * 86400)
+        store.open()
+        try:
+            ticks = args.analytics_hours * 3600
+            for first in range(0, ticks, 60):
+                store.write_batch([
+                    {'pid': 1000 + pid, 'usage': (pid * 7 + tick * (pid % 5 + 1)) % 100 / 1.0,
+                     'timestamp': EPOCH + tick, 'name': FAKE_NAMES[pid % len(FAKE_NAMES)]}
+                    for tick in range(first, min(first + 60, ticks)) for pid in range(args.analytics_pids)
+                ])
+            # The window starts and ends in the middle of minutes
+            end = EPOCH + ticks - 0.5
+            start = max(EPOCH + 0.5, end - 86400)
+            engine = WindowAnalytics(store.connection)
+            began = time.perf_counter()
+            engine.worst(start, end)
+            cold = time.perf_counter() - began
+
+            def refresh():
+                engine.invalidate(end - 1)
+                engine.worst(start, end)
+            durations = timings(refresh, args.repeat)
+        finally:
+            store.close()
+    results = {'analytics.worst.cold_ms': result(cold * 1000, 'ms')}
+    results.update(latency_results('analytics.worst.refresh', durations))
+    return results
+
+
+def bench_aggregator(args):
+    """
+    Ticks per second written by one aggregator with agents streaming as fast as it takes them, and the CPU time
+    of the aggregator per tick; agents_at_1hz is the number of agents at one tick per second one core sustains
+    The aggregator is forked and listens on a Unix socket, the agents run in the benchmark
+    """
+    if not hasattr(os, 'fork') or not hasattr(socket, 'AF_UNIX'):
+        print("Skipping the aggregator: fork() or Unix sockets are not available")
+        return {}
+    results = {}
+    records = [[{'pid': 1000 + pid, 'usage': (pid * 7 + tick) % 100 / 1.0, 'timestamp': EPOCH + tick,
+                 'name': FAKE_NAMES[pid % len(FAKE_NAMES)]} for pid in range(args.aggregator_pids)]
+               for tick in range(args.aggregator_ticks)]
+    for count in args.aggregator_agents:
+        with tempfile.TemporaryDirectory() as directory:
+            address = (socket.AF_UNIX, os.path.join(directory, 'aggregator.sock'))
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    store = SQLiteStore(os.path.join(directory, 'bench.db'), retention=30 * 86400)
+                    asyncio.run(Aggregator(store).serve(address))
+                finally:
+                    os._exit(0)
+            try:
+                deadline = time.monotonic() + 10
+                while not os.path.exists(address[1]) and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                aggregator = psutil.Process(pid)
+                cpu_start = sum(aggregator.cpu_times()[:2])
+                start = time.perf_counter()
+                senders = [AgentSender(address, host=f'agent{agent}', max_buffered=args.aggregator_ticks)
+                           for agent in range(count)]
+                for tick, tick_records in enumerate(records):
+                    for sender in senders:
+                        sender.send(EPOCH + tick, tick_records)
+                deadline = time.monotonic() + 300
+                while any(sender.buffered for sender in senders) and time.monotonic() < deadline:
+                    for sender in senders:
+                        sender.flush()
+                    time.sleep(0.01)
+                elapsed = time.perf_counter() - start
+                cpu = sum(aggregator.cpu_times()[:2]) - cpu_start
+                for sender in senders:
+                    sender.close(timeout=0)
+            finally:
+                os.kill(pid, signal.SIGINT)
+                os.waitpid(pid, 0)
+        ticks = count * args.aggregator_ticks
+        results[f'aggregator.{count}.ticks_per_s'] = result(ticks / elapsed, 'ticks/s', HIGHER)
+        results[f'aggregator.{count}.cpu_ms_per_tick'] = result(cpu / ticks * 1000, 'ms')
+        results[f'aggregator.{count}.agents_at_1hz'] = result(ticks / cpu if cpu else 0.0, 'agents', HIGHER)
+    return results
+
+
+def qt_application():
+    """
+    :return: the QApplication, created on first use; callers keep the reference while they use Qt
+    """
+    from PyQt5.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([sys.argv[0]])
+
+
+def bench_chart(args):
+    """
+    CPUChartWidget frame and full redraw times under the offscreen Qt platform, in every mode of the chart
+    """
+    app = qt_application()
+    from cpu_chart_widget import CPUChartWidget, LINES_MODE
+    results = {}
+    for lines in args.chart_lines:
+        widget = CPUChartWidget(window=args.chart_window, interval=1)
+        widget.resize(1200, 700)
+        widget.show()
+        widget.create_figure()
+        for tick in range(args.chart_window):
+            widget.update_chart({1000 + pid: ((pid * 13 + tick) % 100, EPOCH + tick) for pid in range(lines)})
+        for index in range(widget.mode_combo.count()):
+            mode = widget.mode_combo.itemData(index)
+            name = f'chart.{lines}' if mode == LINES_MODE else f'chart.{lines}.{mode}'
+            # The first frame creates the lines or the heatmap and schedules the full redraw caching the background
+            widget.mode_combo.setCurrentIndex(index)
+            widget.render_frame()
+            app.processEvents()
+            results.update(latency_results(f'{name}.frame', timings(widget.render_frame, args.repeat)))
+            results.update(latency_results(f'{name}.draw', timings(widget.canvas.draw, args.repeat)))
+        widget.close()
+        widget.deleteLater()
+        app.processEvents()
+    return results
+
+
+def bench_history(args):
+    """
+    Memory of the CPU usage history over simulated hours of ticks, a tenth of the processes is replaced every hour
+    Once the retention window is full the memory must stay flat
+    """
+    interval, retention = 1, 3600
+    history = TimeSeriesStore(retention=retention, interval=interval)
+    pids = list(range(1000, 1000 + args.history_pids))
+    next_pid = pids[-1] + 1
+    ticks_per_hour = 3600 // interval
+    memory = []
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        for hour in range(args.hours):
+            for tick in range(ticks_per_hour):
+                timestamp = EPOCH + (hour * ticks_per_hour + tick) * interval
+                history.append_tick({pid: (float(pid % 100), timestamp) for pid in pids})
+            memory.append((tracemalloc.get_traced_memory()[0] - baseline) / (1 << 20))
+            replaced = max(1, len(pids) // 10)
+            pids = pids[replaced:] + list(range(next_pid, next_pid + replaced))
+            next_pid += replaced
+        peak = (tracemalloc.get_traced_memory()[1] - baseline) / (1 << 20)
+    finally:
+        tracemalloc.stop()
+    # Growth after the first retention window has filled up
+    full = min(len(memory) - 1, math.ceil(retention / 3600))
+    growth = (memory[-1] - memory[full]) / (len(memory) - 1 - full) if len(memory) - 1 > full else 0.0
+    return {
+        'history.final_mb': result(memory[-1], 'MB'),
+        'history.peak_mb': result(peak, 'MB'),
+        'history.growth_mb_per_hour': result(growth, 'MB/h'),
+    }, {'history.mb_by_hour': memory}
+
+
+def bench_filter(args):
+    """
+    Latency of one keystroke in the filter of ProcessManagementWidget over the fake process table
+    """
+    app = qt_application()
+    from cpu_watcher import CPUWatcher
+    from process_management_widget import ProcessManagementWidget
+    results = {}
+    for count in args.counts:
+        watcher = CPUWatcher([])
+        watcher.sampler.backend, watcher.sampler.registry = FAKE_BACKEND, FakeProcessRegistry(count, seed=args.seed)
+        widget = ProcessManagementWidget(watcher)
+        # Typing the names letter by letter and erasing them
+        keystrokes = []
+        for name in FAKE_NAMES[:3]:
+            typed = [name[:length] for length in range(1, len(name) + 1)]
+            keystrokes.extend(typed + typed[-2::-1] + [""])
+        durations = []
+        for text in keystrokes:
+            start = time.perf_counter()
+            widget.update_filtered_processes(text)
+            durations.append(time.perf_counter() - start)
+            app.processEvents()
+        results.update(latency_results(f'filter.{count}.keystroke', durations))
+        widget.deleteLater()
+    return results
+
+
+def make_rules(count):
+    """
+    :return: list of rules of every kind in turn with varied parameters
+    """
+    kinds = list(RULE_KINDS)
+    rules = []
+    for index in range(count):
+        kind = kinds[index % len(kinds)]
+        rule = {'name': f"{kind} {index}", 'kind': kind}
+        if kind == 'threshold':
+            rule.update(threshold=50.0 + index % 50, duration=float(index % 60))
+        elif kind == 'zscore':
+            rule.update(limit=3.0 + index % 3, window=60.0 + index, min_change=10.0)
+        else:
+            rule.update(limit=20.0 + index % 80)
+        rules.append(rule)
+    return rules
+
+
+def bench_rules(args):
+    """
+    Cost of the rules engine per tick, with usage drifting around a level per process and rare spikes
+    """
+    results = {}
+    rng = np.random.default_rng(args.seed)
+    for count in args.counts:
+        engine = RulesEngine(make_rules(args.rules))
+        pids = list(range(1000, 1000 + count))
+        names = {pid: f"{FAKE_NAMES[pid % len(FAKE_NAMES)]}-{pid}" for pid in pids}
+        levels = rng.random(count) * 40
+        tick = [0]
+
+        def evaluate():
+            tick[0] += 1
+            usage = levels + rng.random(count) * 5
+            usage[rng.random(count) < 0.001] = 100.0
+            timestamp = EPOCH + tick[0]
+            engine.evaluate({'cpu': {pid: (value, timestamp) for pid, value in zip(pids, usage.tolist())}}, names)
+
+        durations = timings(evaluate, args.repeat, warmup=10)
+        results.update(latency_results(f'rules.{args.rules}.{count}.tick', durations))
+        results[f'rules.{args.rules}.{count}.ns_per_rule_pid'] = result(
+            statistics.median(durations) / (args.rules * count) * 1e9, 'ns'
+        )
+    return results
+
+
+def bench_startup(args):
+    """
+    Startup of the GUI in fresh interpreters: import time of monitor_ui, and time from the start of the process
+    to the first paint of the main window, without a database and with one of --startup-rows samples
+    Both are checked against their budgets, see instrumentation.IMPORT_BUDGET and FIRST_PAINT_BUDGET
+    """
+    results = {}
+    environment = {**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}
+    imports = []
+    for label in ('empty', 'database'):
+        with tempfile.TemporaryDirectory() as directory:
+            if label == 'database':
+                store = SQLiteStore(os.path.join(directory, 'CpuMetrics'))
+                store.open()
+                try:
+                    # Recent samples, older ones would be dropped by the retention when the GUI opens the database
+                    start = time.time() - 86400
+                    pids = args.insert_pids
+                    for first in range(0, args.startup_rows, pids * 100):
+                        store.write_batch([
+                            {'pid': 1000 + row % pids, 'usage': row % 100 / 1.0, 'timestamp': start + row // pids,
+                             'name': FAKE_NAMES[row % len(FAKE_NAMES)]}
+                            for row in range(first, min(first + pids * 100, args.startup_rows))
+                        ])
+                finally:
+                    store.close()
+            paints = []
+            # The first run warms up the file cache
+            for run_index in range(args.startup_runs + 1):
+                completed = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=directory, timeout=120,
+                                           env={**environment, 'LOCALAPPDATA': directory},
+                                           capture_output=True, text=True)
+                lines = completed.stdout.split()
+                if completed.returncode or len(lines) < 2:
+                    raise RuntimeError(f"Startup failed: {completed.stderr.strip()}")
+                if run_index:
+                    imports.append(float(lines[0]))
+                    paints.append(float(lines[1]))
+            results[f'startup.{label}.first_paint_ms'] = result(
+                statistics.median(paints) * 1000, 'ms', budget=FIRST_PAINT_BUDGET * 1000
+            )
+    results['startup.import_ms'] = result(statistics.median(imports) * 1000, 'ms', budget=IMPORT_BUDGET * 1000)
+    return results
+
+
+# Benchmarks by name, in the order they run
+BENCHMARKS = {
+    'sampler': bench_sampler,
+    'insert': bench_insert,
+    'storage': bench_storage,
+    'chart': bench_chart,
+    'history': bench_history,
+    'filter': bench_filter,
+    'analytics': bench_analytics,
+    'rules': bench_rules,
+    'startup': bench_startup,
+    'aggregator': bench_aggregator,
+    # Last, the busy-loop processes load the machine while they exit
+    'real': bench_real,
+}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the results with those of a baseline run
+    :param results: dict {name: result}
+    :param baseline: dict {name: result} of the baseline
+    :param tolerance: relative change considered as noise, e.g. 0.25
+    :return: list of (name, baseline value, value, relative change, status), status is one of 'ok', 'regression',
+             'improvement'; the change is positive when the result got worse
+    """
+    rows = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None or not previous['value']:
+            continue
+        change = (current['value'] - previous['value']) / abs(previous['value'])
+        if current['better'] == HIGHER:
+            change = -change
+        status = 'regression' if change > tolerance else 'improvement' if change < -tolerance else 'ok'
+        rows.append((name, previous['value'], current['value'], change, status))
+    return rows
+
+
+def metadata(args):
+    """
+    :return: dict describing the machine and the run
+    """
+    import matplotlib
+    return {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': psutil.cpu_count(),
+        'memory': psutil.virtual_memory().total,
+        'numpy': np.__version__,
+        'psutil': psutil.__version__,
+        'matplotlib': matplotlib.__version__,
+        'arguments': {name: value for name, value in vars(args).items() if name not in ('output', 'baseline')},
+    }
+
+
+def run(args):
+    """
+    Run the benchmarks, write the results file and compare it with the baseline
+    :param args: parsed command line arguments
+    :return: exit code, 1 if a result is over its budget or regressed against the baseline
+    """
+    results, details = {}, {}
+    for name in args.only:
+        print(f"Running {name}...", flush=True)
+        start = time.perf_counter()
+        outcome = BENCHMARKS[name](args)
+        if isinstance(outcome, tuple):
+            outcome, extra = outcome
+            details.update(extra)
+        results.update(outcome)
+        print(f"  {len(outcome)} results in {time.perf_counter() - start:.1f}s")
+
+    document = {'version': RESULTS_VERSION, 'meta': metadata(args), 'results': results, 'details': details}
+    with open(args.output, 'w') as file:
+        json.dump(document, file, indent=2)
+
+    width = max((len(name) for name in results), default=0)
+    print(f"\n{'Result':<{width}}  {'Value':>14}")
+    for name, entry in results.items():
+        print(f"{name:<{width}}  {entry['value']:>14.3f} {entry['unit']}")
+    print(f"Results written to {args.output}")
+    over_budget = [name for name, entry in results.items() if entry['value'] > entry.get('budget', math.inf)]
+    for name in over_budget:
+        print(f"{name} is over its budget of {results[name]['budget']:.3f} {results[name]['unit']}")
+
+    if not args.baseline:
+        return 1 if over_budget else 0
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline.get('version') != RESULTS_VERSION:
+        print(f"Baseline {args.baseline} has another version, not compared")
+        return 1 if over_budget else 0
+    rows = compare(results, baseline['results'], args.tolerance)
+    print(f"\n{'Result':<{width}}  {'Baseline':>14}  {'Value':>14}  {'Change':>8}  Status")
+    for name, previous, current, change, status in rows:
+        print(f"{name:<{width}}  {previous:>14.3f}  {current:>14.3f}  {change:>+8.1%}  {status}")
+    regressions = [row for row in rows if row[4] == 'regression']
+    print(f"{len(regressions)} regressions against {args.baseline}, tolerance {args.tolerance:.0%}")
+    return 1 if regressions or over_budget else 0
+
+
+def parse_list(text, kind=int):
+    return [kind(item) for item in text.split(",") if item.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the CPU usage monitor, headless")
+    parser.add_argument("--only", type=lambda text: parse_list(text, str), default=list(BENCHMARKS),
+                        help=f"Comma-separated benchmarks to run: {','.join(BENCHMARKS)}")
+    parser.add_argument("--output", default="bench-results.json", help="Results file, JSON")
+    parser.add_argument("--baseline", default=None, help="Results file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Relative change of a result considered as noise, worse results are regressions")
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes, for a smoke run")
+    parser.add_argument("--repeat", type=int, default=30, help="Timed repetitions of every measurement")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fake process source")
+    parser.add_argument("--counts", type=parse_list, default=[10, 100, 1000, 10000],
+                        help="Numbers of fake processes of the sampler and filter benchmarks")
+    parser.add_argument("--churn", type=float, default=0.01,
+                        help="Fraction of the fake processes replaced on every refresh")
+    parser.add_argument("--real-counts", type=parse_list, default=[10, 100],
+                        help="Numbers of spawned busy-loop processes")
+    parser.add_argument("--metrics", type=lambda text: parse_list(text, str), default=['rss', 'threads'],
+                        help=f"Per-process metrics sampled along with CPU usage: {','.join(PROCESS_METRICS)}")
+    parser.add_argument("--insert-pids", type=int, default=100, help="Records per tick of the insert benchmark")
+    parser.add_argument("--insert-ticks", type=int, default=600, help="Ticks of the insert benchmark")
+    parser.add_argument("--flush-ticks", type=int, default=5, help="Ticks per transaction of the insert benchmark")
+    parser.add_argument("--storage-pids", type=int, default=100, help="Records per tick of the storage benchmark")
+    parser.add_argument("--storage-hours", type=int, default=2, help="Simulated hours of the storage benchmark")
+    parser.add_argument("--chart-lines", type=parse_list, default=[10, 100, 500],
+                        help="Numbers of processes in the chart")
+    parser.add_argument("--chart-window", type=int, default=300, help="Seconds of history shown in the chart")
+    parser.add_argument("--history-pids", type=int, default=100, help="Processes in the history benchmark")
+    parser.add_argument("--hours", type=int, default=6, help="Simulated hours of the history benchmark")
+    parser.add_argument("--analytics-pids", type=int, default=100, help="Processes in the analytics benchmark")
+    parser.add_argument("--aggregator-agents", type=parse_list, default=[100],
+                        help="Numbers of agents streaming to the aggregator")
+    parser.add_argument("--aggregator-pids", type=int, default=50, help="Records per tick of every agent")
+    parser.add_argument("--aggregator-ticks", type=int, default=60, help="Ticks sent by every agent")
+    parser.add_argument("--rules", type=int, default=100, help="Rules of every kind in turn in the rules benchmark")
+    parser.add_argument("--startup-runs", type=int, default=5, help="Timed startups of the GUI in every case")
+    parser.add_argument("--startup-rows", type=int, default=200000,
+                        help="Samples in the database of the startup benchmark")
+    parser.add_argument("--analytics-hours", type=int, default=6,
+                        help="Simulated hours of 1 second samples in the analytics benchmark")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.only if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+    unknown = [metric for metric in args.metrics if metric not in PROCESS_METRICS]
+    if unknown:
+        parser.error(f"unknown metrics: {', '.join(unknown)}")
+    if args.quick:
+        args.repeat = min(args.repeat, 5)
+        args.counts = [count for count in args.counts if count <= 1000]
+        args.real_counts = [count for count in args.real_counts if count <= 10]
+        args.insert_ticks = min(args.insert_ticks, 100)
+        args.storage_hours = min(args.storage_hours, 1)
+        args.chart_lines = args.chart_lines[:1]
+        args.hours = min(args.hours, 2)
+        args.analytics_hours = min(args.analytics_hours, 1)
+        args.aggregator_ticks = min(args.aggregator_ticks, 10)
+        args.startup_runs = min(args.startup_runs, 2)
+        args.startup_rows = min(args.startup_rows, 20000)
+    return args
+
+
+def main():
+    """
+    Main function of the benchmarks
+    :return: exit code
+    """
+    return run(parse_args())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,539 @@
+import argparse
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+from cpu_sampler import CPUSampler, PROCESS_METRICS, DEFAULT_BACKEND, available_backends
+from instrumentation import stats, configure_logging, SAMPLE, DB_WRITE, TICKS, DROPPED_TICKS, ROWS_WRITTEN
+from sqlite_store import DATABASE_NAME
+from storage import make_store, STORAGE_BACKENDS, DEFAULT_STORAGE
+from system_sampler import SystemSampler, SystemEventDetector
+from tick_log import TickLog, TickRecorder, paced
+from tick_scheduler import TickScheduler, MIN_INTERVAL
+
+
+def collect(args):
+    """
+    Headless collector: sample the watched processes and write them to the database
+    Uses the same sampler and schema as the GUI, without Qt
+    Records are written in one transaction per flush interval
+    With --system, system-wide resources and their notable transitions are collected on the same ticks
+    Ticks are fired at absolute deadlines, the deadlines passed while a tick was running are skipped;
+    with --adaptive the interval adapts to the load, see TickScheduler
+    Ticks and writes are timed, the statistics of the collector are logged every --stats-interval seconds
+    With --record, the records of every tick are appended to a tick log as well, see tick_log
+    With --send, the records of every tick are streamed to an aggregator instead of the database, see aggregator
+    With --rules, every tick is evaluated by the rules, the events raised are printed and written as system events
+    The modules of the other commands are imported by their handlers, a plain collector does not load them
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    sampler = CPUSampler(args.processes, refresh_every=args.refresh_every, metrics=args.metrics, backend=args.backend,
+                         tree=args.tree)
+    system_sampler = SystemSampler() if args.system else None
+    detector = SystemEventDetector()
+    rules_engine = None
+    if args.rules:
+        from rules_engine import RulesEngine
+        rules_engine = RulesEngine(args.rules)
+    store = sender = None
+    if args.send:
+        from aggregator import AgentSender, format_address
+        sender = AgentSender(args.send, host=args.host)
+        destination = f"to the aggregator at {format_address(args.send)} as {sender.host}"
+    else:
+        store = make_store(args.storage, args.database, retention=args.retention_days * 86400)
+        store.open()
+        destination = f"into {args.database}"
+    recorder = TickRecorder(args.record) if args.record else None
+    scheduler = TickScheduler(args.interval, adaptive=args.adaptive)
+    print(f"Collecting {', '.join(args.processes)} every {args.interval}s {destination}")
+
+    pending, system_samples, events = [], [], []
+    start = time.monotonic()
+    last_flush = last_report = start
+    try:
+        while True:
+            missed = scheduler.wait()
+            if args.duration is not None and time.monotonic() - start >= args.duration:
+                break
+            if missed:
+                stats.count(DROPPED_TICKS, missed)
+            tick_start = time.monotonic()
+            if sampler.refresh_due():
+                sampler.refresh_processes()
+            cpu_usage = sampler.get_cpu_usage()
+            records = sampler.make_records(cpu_usage)
+            if recorder is not None and records:
+                recorder.write(records[0]['timestamp'], records)
+            if sender is None:
+                pending.extend(records)
+            elif records:
+                sender.send(records[0]['timestamp'], records)
+            system_sample = system_sampler.sample() if system_sampler else None
+            if system_sample is not None:
+                system_samples.append(system_sample)
+                events.extend(detector.detect(system_sample))
+            if rules_engine is not None:
+                metric_series = sampler.metric_series(cpu_usage) if sampler.metrics else {}
+                rule_events = rules_engine.evaluate({'cpu': cpu_usage, **metric_series}, sampler.registry.names)
+                for timestamp, text in rule_events:
+                    print(f"{datetime.fromtimestamp(timestamp):%Y-%m-%d %H:%M:%S} {text}")
+                events.extend(rule_events)
+            stats.record(SAMPLE, time.monotonic() - tick_start)
+            stats.count(TICKS)
+            scheduler.adapt(cpu_usage)
+            if store is not None and time.monotonic() - last_flush >= args.flush_interval:
+                write_batch(store, pending, system_samples, events)
+                pending, system_samples, events = [], [], []
+                last_flush = time.monotonic()
+            if args.stats_interval and time.monotonic() - last_report >= args.stats_interval:
+                stats.log_report()
+                last_report = time.monotonic()
+    except KeyboardInterrupt:
+        # We are here after Ctrl-C
+        pass
+    finally:
+        if store is not None:
+            write_batch(store, pending, system_samples, events)
+            store.close()
+        if sender is not None:
+            sender.close()
+        if recorder is not None:
+            recorder.close()
+        if args.stats_interval:
+            stats.log_report()
+    return 0
+
+
+def aggregate(args):
+    """
+    Aggregator: receive the ticks streamed by the agents, collect --send on other hosts,
+    and write them into one database with the host of every record, see aggregator.Aggregator
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    import asyncio
+    from aggregator import Aggregator, parse_address, format_address, DEFAULT_PORT, MAX_QUEUED_TICKS
+
+    listen = args.listen or parse_address(f":{DEFAULT_PORT}", "0.0.0.0")
+    max_queued = args.max_queued if args.max_queued is not None else MAX_QUEUED_TICKS
+    store = make_store(args.storage, args.database, retention=args.retention_days * 86400)
+    aggregator = Aggregator(store, batch_interval=args.flush_interval, max_queued=max_queued,
+                            stats_interval=args.stats_interval)
+    print(f"Aggregating into {args.database}, listening on {format_address(listen)}")
+    try:
+        asyncio.run(aggregator.serve(listen))
+    except KeyboardInterrupt:
+        # We are here after Ctrl-C, the ticks received were written
+        pass
+    finally:
+        if args.stats_interval:
+            stats.log_report()
+    return 0
+
+
+def write_batch(store, records, system_samples, events):
+    """
+    Write one batch in one transaction, timed as the DB_WRITE stage
+    """
+    write_start = time.perf_counter()
+    store.write_batch(records, system_samples, events)
+    stats.record(DB_WRITE, time.perf_counter() - write_start)
+    stats.count(ROWS_WRITTEN, len(records))
+
+
+def replay(args):
+    """
+    Replay a tick log recorded by collect --record or the GUI into the database
+    The records are written as collected ones, one transaction per flush interval,
+    or per CHUNK_SIZE records when replaying as fast as possible
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    from data_transfer import CHUNK_SIZE
+
+    store = make_store(args.storage, args.database, retention=args.retention_days * 86400)
+    store.open()
+    ticks = rows = 0
+    start = last_flush = time.monotonic()
+    pending = []
+    try:
+        with TickLog(args.log) as log:
+            for _, records in paced(log.ticks(), args.speed):
+                pending.extend(records)
+                ticks += 1
+                if len(pending) >= CHUNK_SIZE or time.monotonic() - last_flush >= args.flush_interval:
+                    write_batch(store, pending, (), ())
+                    rows += len(pending)
+                    pending = []
+                    last_flush = time.monotonic()
+    except KeyboardInterrupt:
+        # We are here after Ctrl-C
+        pass
+    finally:
+        write_batch(store, pending, (), ())
+        rows += len(pending)
+        store.close()
+    print(f"Replayed {ticks} ticks, {rows} records from {args.log} into {args.database} "
+          f"in {time.monotonic() - start:.1f}s")
+    return 0
+
+
+def backup(args):
+    """
+    Archive a consistent copy of the database while collectors keep writing to it
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    import db_backup
+
+    backup_file = args.output or db_backup.backup_file_name(args.database, incremental=args.incremental)
+    if args.incremental:
+        db_backup.incremental_backup(args.database, backup_file)
+    else:
+        db_backup.full_backup(args.database, backup_file)
+    print(f"Database backed up to {backup_file}")
+    return 0
+
+
+def restore(args):
+    """
+    Restore a full backup, or merge incremental backups into the restored database, in the order they were made
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    import db_backup
+
+    for backup_file in args.archives:
+        db_backup.restore_backup(backup_file, args.database)
+        print(f"Restored {backup_file} into {args.database}")
+    return 0
+
+
+def export(args):
+    """
+    Export CpuWorkload to CSV or to the columnar format, see data_transfer
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    import data_transfer
+
+    path = args.output
+    if args.format == "columnar" and not path.endswith(data_transfer.COLUMNAR_EXTENSION):
+        path += data_transfer.COLUMNAR_EXTENSION
+    count = data_transfer.export_file(args.database, path, start=args.start, end=args.end, process=args.process)
+    print(f"Exported {count} samples to {path}")
+    return 0
+
+
+def import_(args):
+    """
+    Import a file written by the export command, samples are appended to the database
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    import data_transfer
+
+    store = make_store(args.storage, args.database, retention=args.retention_days * 86400)
+    store.open()
+    try:
+        count = data_transfer.import_file(store, args.input)
+    finally:
+        store.close()
+    print(f"Imported {count} samples from {args.input}")
+    return 0
+
+
+def analyze(args):
+    """
+    Print the statistics of CPU usage per process over a time window, worst processes first
+    Answered from the rollups, see analytics.WindowAnalytics, the database is opened read-only
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    import analytics
+
+    threshold = args.threshold if args.threshold is not None else analytics.DEFAULT_THRESHOLD
+    end = args.end if args.end is not None else time.time()
+    start = args.start if args.start is not None else end - args.last
+    try:
+        connection = analytics.connect(args.database)
+    except (sqlite3.Error, ValueError) as e:
+        print(f"Failed to open {args.database}: {e}", file=sys.stderr)
+        return 1
+    try:
+        engine = analytics.WindowAnalytics(connection)
+        if args.process is not None:
+            results = engine.statistics(start, end, threshold=threshold, by=args.by, process=args.process)
+        else:
+            results = engine.worst(start, end, key=args.sort, limit=args.limit, threshold=threshold, by=args.by)
+    finally:
+        connection.close()
+    print(f"{datetime.fromtimestamp(start):%Y-%m-%d %H:%M:%S} - {datetime.fromtimestamp(end):%Y-%m-%d %H:%M:%S}, "
+          f"time above {threshold:g}%")
+    header = ["Process"] + (["Host"] if args.by != "name" else []) + (["PID"] if args.by == "pid" else []) + [
+        "Samples", "Mean %", "Max %", "p50 %", "p95 %", "p99 %", "Above s"
+    ]
+    print("".join(f"{title:<32}" if title in ("Process", "Host") else f"{title:>10}" for title in header))
+    for result in results:
+        cells = [f"{result['name'][:31]:<32}"] + ([f"{result['host'][:31]:<32}"] if args.by != "name" else []) + \
+            ([f"{result['pid']:>10}"] if args.by == "pid" else [])
+        cells.append(f"{result['samples']:>10}")
+        cells.extend(f"{'-':>10}" if result[column] is None else f"{result[column]:>10.1f}"
+                     for column in analytics.STATISTICS[1:])
+        print("".join(cells))
+    return 0
+
+
+def parse_time(text):
+    """
+    :param text: Unix timestamp or ISO date and time in local time, e.g. 2024-05-01T12:00
+    :return: Unix timestamp
+    """
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+def parse_duration(text):
+    """
+    :param text: seconds, or a number with the unit s, m, h or d, e.g. 24h
+    :return: seconds
+    """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    try:
+        if text and text[-1] in units:
+            return float(text[:-1]) * units[text[-1]]
+        return float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid duration: {text}")
+
+
+def parse_interval(text):
+    """
+    :param text: seconds between ticks
+    :return: float, at least MIN_INTERVAL
+    """
+    interval = float(text)
+    if interval < MIN_INTERVAL:
+        raise argparse.ArgumentTypeError(f"the interval must be at least {MIN_INTERVAL}s")
+    return interval
+
+
+def parse_agent_address(text, default_host="127.0.0.1"):
+    """
+    :param text: address of the aggregator, see aggregator.parse_address()
+    :return: (family, address)
+    """
+    from aggregator import parse_address
+
+    try:
+        return parse_address(text, default_host)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid address: {text}, HOST:PORT or unix:PATH expected")
+
+
+def parse_rules(text):
+    """
+    :param text: 'default' for rules_engine.DEFAULT_RULES, or a JSON file with a list of rules
+    :return: list of rules
+    """
+    from rules_engine import DEFAULT_RULES, load_rules
+
+    if text == "default":
+        return DEFAULT_RULES
+    try:
+        return load_rules(text)
+    except (OSError, ValueError) as error:
+        raise argparse.ArgumentTypeError(f"invalid rules: {error}")
+
+
+def parse_speed(text):
+    """
+    :param text: speed factor, e.g. 1 for real time or 60, or 'max' for as fast as possible
+    :return: float, None for as fast as possible
+    """
+    if text == "max":
+        return None
+    speed = float(text)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("the speed must be positive")
+    return speed
+
+
+def parse_metrics(text):
+    """
+    :param text: comma-separated names of the metrics, or 'all'
+    :return: list of metric names, see PROCESS_METRICS
+    """
+    if text == "all":
+        return list(PROCESS_METRICS)
+    metrics = [metric.strip() for metric in text.split(",") if metric.strip()]
+    unknown = [metric for metric in metrics if metric not in PROCESS_METRICS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown metrics: {', '.join(unknown)}")
+    return metrics
+
+
+def parse_statistic(text):
+    """
+    :param text: statistic the processes are ranked by, see analytics.STATISTICS
+    :return: the statistic
+    """
+    from analytics import STATISTICS
+
+    if text not in STATISTICS:
+        raise argparse.ArgumentTypeError(f"invalid statistic: {text}, one of {', '.join(STATISTICS)} expected")
+    return text
+
+
+def parse_grouping(text):
+    """
+    :param text: grouping of the statistics, see analytics.GROUPINGS
+    :return: the grouping
+    """
+    from analytics import GROUPINGS
+
+    if text not in GROUPINGS:
+        raise argparse.ArgumentTypeError(f"invalid grouping: {text}, one of {', '.join(GROUPINGS)} expected")
+    return text
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="CPU usage monitor, command line interface")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="Level of the log written to stderr")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    collect_parser = subparsers.add_parser("collect", help="Collect CPU usage of processes into the database")
+    collect_parser.add_argument("processes", nargs="+", help="Names of the processes to watch, e.g. python.exe")
+    collect_parser.add_argument("--interval", type=parse_interval, default=1.0,
+                                help=f"Seconds between ticks, at least {MIN_INTERVAL}")
+    collect_parser.add_argument("--adaptive", action="store_true",
+                                help="Sample faster while the load changes and slower while it does not")
+    collect_parser.add_argument("--duration", type=float, default=None, help="Stop after that many seconds")
+    collect_parser.add_argument("--database", default=DATABASE_NAME, help="Path to the SQLite database")
+    collect_parser.add_argument("--flush-interval", type=float, default=5.0, help="Seconds between database writes")
+    collect_parser.add_argument("--refresh-every", type=int, default=1, help="Refresh the process table every N ticks")
+    collect_parser.add_argument("--retention-days", type=float, default=7, help="Days the raw samples are kept")
+    collect_parser.add_argument("--storage", choices=tuple(STORAGE_BACKENDS), default=DEFAULT_STORAGE,
+                                help="Storage backend of the raw samples, see storage")
+    collect_parser.add_argument("--metrics", type=parse_metrics, default=[],
+                                help="Comma-separated per-process metrics sampled along with CPU usage: "
+                                     f"{','.join(PROCESS_METRICS)}, or 'all'")
+    collect_parser.add_argument("--system", action="store_true",
+                                help="Collect per-core CPU, memory, swap, disk and network I/O as well")
+    collect_parser.add_argument("--tree", action="store_true",
+                                help="Watch the children of the processes as well and store CPU usage per family")
+    collect_parser.add_argument("--backend", choices=available_backends(), default=DEFAULT_BACKEND,
+                                help="Sampler backend, 'proc' reads /proc directly on Linux")
+    collect_parser.add_argument("--stats-interval", type=float, default=60,
+                                help="Seconds between logs of the statistics of the collector itself, 0 for none")
+    collect_parser.add_argument("--rules", type=parse_rules, default=None,
+                                help="Evaluate alert rules on every tick, 'default' or a JSON file with a list "
+                                     "of rules")
+    collect_parser.add_argument("--record", default=None, help="Append the records of every tick to this tick log")
+    collect_parser.add_argument("--send", type=parse_agent_address, default=None,
+                                help="Stream the ticks to the aggregator at HOST:PORT or unix:PATH "
+                                     "instead of writing them to the database")
+    collect_parser.add_argument("--host", default=None,
+                                help="Host name the aggregator stores the records with, this host's name by default")
+    collect_parser.set_defaults(handler=collect)
+
+    aggregate_parser = subparsers.add_parser("aggregate",
+                                             help="Receive the ticks of agents (collect --send) into one database")
+    aggregate_parser.add_argument("--listen", type=lambda text: parse_agent_address(text, "0.0.0.0"), default=None,
+                                  help="[HOST]:PORT or unix:PATH to listen on, the default port of the aggregator "
+                                       "on all interfaces by default")
+    aggregate_parser.add_argument("--database", default=DATABASE_NAME, help="Path to the SQLite database")
+    aggregate_parser.add_argument("--flush-interval", type=float, default=1.0, help="Seconds between database writes")
+    aggregate_parser.add_argument("--max-queued", type=int, default=None,
+                                  help="Ticks received and not written yet, the agents are not read beyond that, "
+                                       "aggregator.MAX_QUEUED_TICKS by default")
+    aggregate_parser.add_argument("--retention-days", type=float, default=7, help="Days the raw samples are kept")
+    aggregate_parser.add_argument("--storage", choices=tuple(STORAGE_BACKENDS), default=DEFAULT_STORAGE,
+                                  help="Storage backend of the raw samples, see storage")
+    aggregate_parser.add_argument("--stats-interval", type=float, default=60,
+                                  help="Seconds between logs of the statistics of the aggregator, 0 for none")
+    aggregate_parser.set_defaults(handler=aggregate)
+
+    replay_parser = subparsers.add_parser("replay", help="Replay a tick log into the database")
+    replay_parser.add_argument("log", help="Tick log recorded by collect --record or the GUI")
+    replay_parser.add_argument("--speed", type=parse_speed, default=None,
+                               help="1 for real time, N for N times faster, 'max' (default) for as fast as possible")
+    replay_parser.add_argument("--database", default=DATABASE_NAME, help="Path to the SQLite database")
+    replay_parser.add_argument("--flush-interval", type=float, default=5.0, help="Seconds between database writes")
+    replay_parser.add_argument("--retention-days", type=float, default=7, help="Days the raw samples are kept")
+    replay_parser.add_argument("--storage", choices=tuple(STORAGE_BACKENDS), default=DEFAULT_STORAGE,
+                               help="Storage backend of the raw samples, see storage")
+    replay_parser.set_defaults(handler=replay)
+
+    backup_parser = subparsers.add_parser("backup", help="Back up the database into a zip archive")
+    backup_parser.add_argument("--database", default=DATABASE_NAME, help="Path to the SQLite database")
+    backup_parser.add_argument("--output", default=None, help="Archive name, CpuMetrics-YYYYMMDD-HHMMSS.zip by default")
+    backup_parser.add_argument("--incremental", action="store_true",
+                               help="Archive only the data added since the last backup")
+    backup_parser.set_defaults(handler=backup)
+
+    restore_parser = subparsers.add_parser("restore", help="Restore the database from backup archives")
+    restore_parser.add_argument("archives", nargs="+",
+                                help="Full backup archive, then the incremental ones made after it, oldest first")
+    restore_parser.add_argument("--database", default=DATABASE_NAME, help="Path to the SQLite database")
+    restore_parser.set_defaults(handler=restore)
+
+    export_parser = subparsers.add_parser("export", help="Export CPU usage samples to a file")
+    export_parser.add_argument("output", help="Output file")
+    export_parser.add_argument("--database", default=DATABASE_NAME, help="Path to the SQLite database")
+    export_parser.add_argument("--format", choices=("csv", "columnar"), default="csv", help="File format")
+    export_parser.add_argument("--start", type=parse_time, default=None, help="Export samples from that time on")
+    export_parser.add_argument("--end", type=parse_time, default=None, help="Export samples before that time")
+    export_parser.add_argument("--process", default=None, help="Export only the process with that name")
+    export_parser.set_defaults(handler=export)
+
+    import_parser = subparsers.add_parser("import", help="Import CPU usage samples from an exported file")
+    import_parser.add_argument("input", help="CSV or columnar (.cpuc) file")
+    import_parser.add_argument("--database", default=DATABASE_NAME, help="Path to the SQLite database")
+    import_parser.add_argument("--retention-days", type=float, default=7, help="Days the raw samples are kept")
+    import_parser.add_argument("--storage", choices=tuple(STORAGE_BACKENDS), default=DEFAULT_STORAGE,
+                               help="Storage backend of the raw samples, see storage")
+    import_parser.set_defaults(handler=import_)
+
+    analyze_parser = subparsers.add_parser("analyze", help="Show statistics of CPU usage per process over a window")
+    analyze_parser.add_argument("--database", default=DATABASE_NAME, help="Path to the SQLite database")
+    analyze_parser.add_argument("--last", type=parse_duration, default=86400,
+                                help="Window ending at --end, e.g. 15m, 24h or 7d (default 24h)")
+    analyze_parser.add_argument("--start", type=parse_time, default=None, help="Window start, overrides --last")
+    analyze_parser.add_argument("--end", type=parse_time, default=None, help="Window end, now by default")
+    analyze_parser.add_argument("--threshold", type=float, default=None,
+                                help="CPU usage in percent, the time above it is shown, "
+                                     "analytics.DEFAULT_THRESHOLD by default")
+    analyze_parser.add_argument("--sort", type=parse_statistic, default="p95",
+                                help="Statistic the processes are ranked by, see analytics.STATISTICS, p95 by default")
+    analyze_parser.add_argument("--limit", type=int, default=20, help="Number of processes shown")
+    analyze_parser.add_argument("--by", type=parse_grouping, default="name",
+                                help="Statistics per process name (default), per host and process name, or per PID")
+    analyze_parser.add_argument("--process", default=None, help="Show only the process with that name")
+    analyze_parser.set_defaults(handler=analyze)
+    args = parser.parse_args(argv)
+    if args.command == "collect" and args.send and args.system:
+        parser.error("system metrics are not sent to the aggregator, --system can't be used with --send")
+    if args.command == "collect" and args.send and args.rules:
+        parser.error("system events are not sent to the aggregator, --rules can't be used with --send")
+    return args
+
+
+def main():
+    """
+    Main function of the command line interface
+    :return: exit code
+    """
+    args = parse_args()
+    configure_logging(args.log_level)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
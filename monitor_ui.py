@@ -1,13 +1,35 @@
 import json
+import logging
 import os
 import sys
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QHBoxLayout, QTabWidget, QVBoxLayout, QAction
+import time
 
+from PyQt5.QtCore import QTimer, pyqtSignal
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QHBoxLayout, QTabWidget, QVBoxLayout, QAction,
+                             QFileDialog, QInputDialog)
+
+from analysis_widget import AnalysisWidget
 from process_management_widget import ProcessManagementWidget
 from cpu_chart_widget import CPUChartWidget
 from cpu_watcher import CPUWatcher
 from database_widget import DatabaseWidget
+from export_widget import ExportWidget, FILE_FILTERS
+from instrumentation import stats, configure_logging, FIRST_PAINT_BUDGET
 from settings_widget import SettingsWidget, DEFAULT_SETTINGS
+from status_panel import StatusPanel
+from tick_log import TICK_LOG_EXTENSION
+
+TICK_LOG_FILTER = f"Tick log (*{TICK_LOG_EXTENSION})"
+# Replay speeds offered: label: speed, see CPUWatcher.replay()
+REPLAY_SPEEDS = {
+    "Real time": 1.0,
+    "10x": 10.0,
+    "100x": 100.0,
+    "1000x": 1000.0,
+    "As fast as possible": None,
+}
+
+logger = logging.getLogger(__name__)
 
 
 def appdata_local_path():
@@ -23,10 +45,16 @@ class MainWindow(QMainWindow):
     """
     Application main window
     Assume width 90% of screen width and height 80% of screen height
+    Only what the first paint needs is built before it: the chart imports matplotlib once shown,
+    the Database and Analysis tabs are built when first shown, NumPy is imported with the first use,
+    and the database is opened by the writer thread
     """
 
     SETTINGS_FILENAME = "settings.json"
 
+    # Seconds from the start of the process to the first paint of the window
+    first_painted = pyqtSignal(float)
+
     def __init__(self, cpu_watcher: CPUWatcher):
         """
         Contains ownership for child widgets, but not for the CPUWatcher object
@@ -42,6 +70,7 @@ class MainWindow(QMainWindow):
         screen_width = desktop.width()
         screen_height = desktop.height()
         self.setGeometry(20, 20, int(screen_width * 0.9), int(screen_height * 0.8))
+        self.painted = False
         self.settings = None
         self.settings_file = os.path.join(appdata_local_path(), self.SETTINGS_FILENAME)
 
@@ -49,9 +78,15 @@ class MainWindow(QMainWindow):
 
         # Widgets
         self.cpu_watcher = cpu_watcher
-        self.cpu_chart_widget = CPUChartWidget(self)
+        self.apply_sampling_settings()
+        self.cpu_chart_widget = CPUChartWidget(self, interval=cpu_watcher.scheduler.fastest_interval)
         self.process_management_widget = ProcessManagementWidget(cpu_watcher)
-        self.database_widget = DatabaseWidget(self.settings['rewrite_database'])
+        self.database_widget = DatabaseWidget(
+            self.settings['rewrite_database'],
+            flush_interval=self.settings.get('db_flush_interval', DEFAULT_SETTINGS['db_flush_interval']),
+            retention=self.settings.get('retention_days', DEFAULT_SETTINGS['retention_days']) * 86400,
+            storage=self.settings.get('storage_backend', DEFAULT_SETTINGS['storage_backend'])
+        )
 
         # Create tabs
         tab_widget = QTabWidget()
@@ -69,11 +104,31 @@ class MainWindow(QMainWindow):
         database_layout.addWidget(self.database_widget)
         tab_widget.addTab(database_tab, "Database")
 
+        # Create Analysis tab, its cached statistics are invalidated by the writes
+        self.analysis_widget = AnalysisWidget()
+        self.database_widget.writer.samples_written.connect(self.analysis_widget.samples_written)
+        self.database_widget.writer.task_done.connect(self.analysis_widget.invalidate)
+        tab_widget.addTab(self.analysis_widget, "Analysis")
+
         self.setCentralWidget(tab_widget)
 
+        # Cost of the monitor itself, shown in the status bar and logged periodically
+        self.status_panel = StatusPanel(self)
+        self.statusBar().addPermanentWidget(self.status_panel, 1)
+        self.stats_log_timer = QTimer(self)
+        self.stats_log_timer.timeout.connect(stats.log_report)
+        self.apply_logging_settings()
+
         self.cpu_watcher.new_data.connect(self.cpu_chart_widget.update_chart)
+        self.cpu_watcher.new_metrics.connect(self.cpu_chart_widget.update_metrics)
+        self.cpu_watcher.new_families.connect(self.cpu_chart_widget.update_families)
         self.cpu_watcher.insert_record.connect(self.database_widget.insert_cpu_workload)
+        self.cpu_watcher.system_sample.connect(self.database_widget.insert_system_sample)
+        self.cpu_watcher.rule_events.connect(self.show_rule_events)
         self.cpu_watcher.stopped.connect(self.thread_stopped)
+        self.cpu_watcher.replay_finished.connect(self.replay_finished)
+        # Replaying as fast as possible waits for the database writer
+        self.cpu_watcher.replay_backlog = self.database_widget.writer.queue.qsize
 
         self.create_menu()
 
@@ -86,15 +141,15 @@ class MainWindow(QMainWindow):
 
         if not os.path.isfile(self.settings_file):
             with open(self.settings_file, 'w') as file:
-                print(f'Created settings file: {self.settings_file} with default settings')
+                logger.info("Created settings file: %s with default settings", self.settings_file)
                 json.dump(DEFAULT_SETTINGS, file)
 
     def load_settings(self):
-        print('MainWindows.load_settings()')
+        logger.debug("MainWindow.load_settings()")
         self.create_default()
         with open(self.settings_file, 'r') as file:
             self.settings = json.load(file)
-            print(f'Init with settings: {self.settings}')
+            logger.info("Init with settings: %s", self.settings)
 
     def create_menu(self):
         menubar = self.menuBar()
@@ -113,7 +168,20 @@ class MainWindow(QMainWindow):
         settings_action = QAction("Settings...", self)
         database_menu.addAction(export_action)
         database_menu.addAction(import_action)
+        self.record_action = QAction("Record Ticks...", self)
+        self.record_action.setCheckable(True)
+        self.replay_action = QAction("Replay Ticks...", self)
+        database_menu.addAction(self.record_action)
+        database_menu.addAction(self.replay_action)
 
+        # noinspection PyUnresolvedReferences
+        export_action.triggered.connect(self.export_data)
+        # noinspection PyUnresolvedReferences
+        import_action.triggered.connect(self.import_data)
+        # noinspection PyUnresolvedReferences
+        self.record_action.toggled.connect(self.record_ticks)
+        # noinspection PyUnresolvedReferences
+        self.replay_action.triggered.connect(self.replay_ticks)
         # noinspection PyUnresolvedReferences
         settings_action.triggered.connect(self.show_settings)
         database_menu.addAction(settings_action)
@@ -125,12 +193,32 @@ class MainWindow(QMainWindow):
         help_menu.addAction(docs_action)
         help_menu.addAction(about_action)
 
+    def paintEvent(self, event):
+        """
+        The time to the first paint is logged, and checked against FIRST_PAINT_BUDGET
+        """
+        super().paintEvent(event)
+        if self.painted:
+            return
+        self.painted = True
+        import psutil
+
+        elapsed = time.time() - psutil.Process().create_time()
+        if elapsed > FIRST_PAINT_BUDGET:
+            logger.warning("First paint %.0f ms after the start, over the budget of %.0f ms",
+                           elapsed * 1000, FIRST_PAINT_BUDGET * 1000)
+        else:
+            logger.info("First paint %.0f ms after the start", elapsed * 1000)
+        self.first_painted.emit(elapsed)
+
     def closeEvent(self, event):
         """
         Stop the CPU watcher thread when the window is closed
+        Pending database records are flushed before the window closes
         :param event: QCloseEvent
         """
         self.cpu_watcher.stop()
+        self.database_widget.close_db()
         event.accept()
 
     def thread_stopped(self):
@@ -139,14 +227,119 @@ class MainWindow(QMainWindow):
         """
         self.close()
 
+    def export_data(self):
+        """
+        Show export window and export the samples in the background
+        """
+        export_widget = ExportWidget(parent=self)
+        if export_widget.exec_():
+            start, end = export_widget.time_range()
+            self.database_widget.export_data(export_widget.path, start=start, end=end, process=export_widget.process())
+
+    def import_data(self):
+        """
+        Choose an exported file and import it in the background
+        """
+        path, _ = QFileDialog.getOpenFileName(self, "Import", "", FILE_FILTERS)
+        if path:
+            self.database_widget.import_data(path)
+
+    def record_ticks(self, enabled):
+        """
+        Choose a tick log and record the ticks sampled to it, or stop recording
+        """
+        path = None
+        if enabled:
+            path, _ = QFileDialog.getSaveFileName(self, "Record Ticks", f"session{TICK_LOG_EXTENSION}",
+                                                  TICK_LOG_FILTER)
+            if not path:
+                self.record_action.setChecked(False)
+                return
+        self.cpu_watcher.set_recording(path)
+
+    def replay_ticks(self):
+        """
+        Choose a tick log and a speed, and replay it through the chart and the database
+        The processes can be monitored again once the replay is over
+        """
+        if self.cpu_watcher.isRunning():
+            self.statusBar().showMessage("Ticks can be replayed before monitoring is started", 5000)
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Replay Ticks", "", TICK_LOG_FILTER)
+        if not path:
+            return
+        speed, accepted = QInputDialog.getItem(self, "Replay Ticks", "Speed:", list(REPLAY_SPEEDS), 0, False)
+        if not accepted:
+            return
+        self.process_management_widget.setEnabled(False)
+        self.replay_action.setEnabled(False)
+        self.cpu_watcher.replay(path, REPLAY_SPEEDS[speed])
+
+    def replay_finished(self, count):
+        self.process_management_widget.setEnabled(True)
+        self.replay_action.setEnabled(True)
+        self.statusBar().showMessage(f"Replayed {count} ticks", 5000)
+
     def show_settings(self):
         """
         Show settings window
         """
         settings_widget = SettingsWidget(settings_file=self.settings_file, parent=self)
-        print(f'Showing settings window with settings: {self.settings}')
+        logger.debug("Showing settings window with settings: %s", self.settings)
         if settings_widget.exec_():
             self.load_settings()
+            self.apply_sampling_settings()
+            self.apply_logging_settings()
+            self.cpu_chart_widget.set_interval(self.cpu_watcher.scheduler.fastest_interval)
+
+    def apply_sampling_settings(self):
+        """
+        Choose the sampling interval, the sampler backend, the per-process metrics and the rules, and turn
+        the tree mode and the system-wide sampling of the CPU watcher on or off according to the settings
+        """
+        interval = self.settings.get('sampling_interval', DEFAULT_SETTINGS['sampling_interval'])
+        adaptive = self.settings.get('adaptive_interval', DEFAULT_SETTINGS['adaptive_interval'])
+        try:
+            self.cpu_watcher.set_interval(interval, adaptive)
+        except ValueError as error:
+            logger.warning("%s, keeping %ss", error, self.cpu_watcher.interval)
+        backend = self.settings.get('sampler_backend', DEFAULT_SETTINGS['sampler_backend'])
+        try:
+            self.cpu_watcher.set_backend(backend)
+        except ValueError as error:
+            # E.g. settings copied from another platform
+            logger.warning("%s, keeping the %s backend", error, self.cpu_watcher.sampler.backend)
+        self.cpu_watcher.set_metrics(self.settings.get('process_metrics', DEFAULT_SETTINGS['process_metrics']))
+        self.cpu_watcher.set_tree_mode(self.settings.get('process_tree', DEFAULT_SETTINGS['process_tree']))
+        self.cpu_watcher.set_system_metrics(self.settings.get('system_metrics', DEFAULT_SETTINGS['system_metrics']))
+        rules = self.settings.get('rules', DEFAULT_SETTINGS['rules'])
+        if not self.settings.get('rules_enabled', DEFAULT_SETTINGS['rules_enabled']):
+            rules = None
+        try:
+            self.cpu_watcher.set_rules(rules)
+        except ValueError as error:
+            logger.warning("Invalid rules in %s: %s", self.settings_file, error)
+
+    def show_rule_events(self, events):
+        """
+        Write the events raised by the rules to the SystemEvents table and show the newest in the status bar
+        :param events: list of (timestamp, event text)
+        """
+        self.database_widget.insert_system_sample(None, events)
+        for _, text in events:
+            logger.info("Rule event: %s", text)
+        text = events[-1][1] if len(events) == 1 else f"{events[-1][1]} (and {len(events) - 1} more events)"
+        self.statusBar().showMessage(text, 10000)
+
+    def apply_logging_settings(self):
+        """
+        Log the statistics of the monitor every stats_log_interval seconds, 0 turns the log off
+        """
+        interval = self.settings.get('stats_log_interval', DEFAULT_SETTINGS['stats_log_interval'])
+        if interval > 0:
+            self.stats_log_timer.start(int(interval * 1000))
+        else:
+            self.stats_log_timer.stop()
 
 
 def main():
@@ -155,6 +348,7 @@ def main():
     Catches Ctrl-C and gracefully stop the CPU watcher thread
     :return: `sys.exit` return code
     """
+    configure_logging(os.environ.get('MONITOR_LOG_LEVEL', 'INFO'))
     app = QApplication(sys.argv)
     cpu_watcher = CPUWatcher([], interval=1)
     window = MainWindow(cpu_watcher)
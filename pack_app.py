@@ -11,8 +11,14 @@ def pack_application(venv):
 
     # Copy necessary files and directories to the temporary directory
     shutil.copytree(venv, os.path.join(dist_dir, venv))
-    for filename in ['cpu_chart_widget.py', 'cpu_watcher.py', 'database_widget.py', 'monitor_cli.py',
-                     'monitor_ui.py', 'process_management_widget.py', 'settings_widget.py', 'settings.json']:
+    for filename in ['aggregator.py', 'analysis_widget.py', 'analytics.py', 'backup_worker.py', 'columnar_store.py',
+                     'cpu_chart_widget.py', 'cpu_sampler.py', 'cpu_watcher.py', 'data_transfer.py',
+                     'database_widget.py', 'database_writer.py', 'db_backup.py', 'export_widget.py', 'export_worker.py',
+                     'instrumentation.py', 'monitor_cli.py', 'monitor_ui.py', 'paged_table_model.py',
+                     'proc_stat_registry.py', 'process_management_widget.py', 'process_name_index.py',
+                     'process_name_model.py', 'process_registry.py', 'process_tree.py', 'rules_engine.py',
+                     'settings_widget.py', 'sqlite_store.py', 'status_panel.py', 'storage.py', 'system_sampler.py',
+                     'tick_log.py', 'tick_scheduler.py', 'time_series.py', 'settings.json']:
         shutil.copy(filename, dist_dir)
 
     # Run PyInstaller to package the application
@@ -0,0 +1,255 @@
+import logging
+
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex
+from PyQt5.QtSql import QSqlDatabase, QSqlQuery
+
+logger = logging.getLogger(__name__)
+
+
+def prefix_end(prefix):
+    """
+    :param prefix: non-empty string
+    :return: smallest string above all the strings starting with the prefix, None if there is none
+             SQLite compares text as UTF-8 bytes, in the order of the code points
+    """
+    while prefix:
+        code = ord(prefix[-1]) + 1
+        if code == 0xD800:
+            # Surrogates are not characters
+            code = 0xE000
+        if code <= 0x10FFFF:
+            return prefix[:-1] + chr(code)
+        prefix = prefix[:-1]
+    return None
+
+
+class PagedSqlTableModel(QAbstractTableModel):
+    """
+    Read-only table model which fetches rows lazily, one page at a time, as the view scrolls
+    Pages are read with keyset pagination: every page continues after the (sort column, ID)
+    of the last fetched row, so the cost of a page does not depend on how far the view has scrolled
+    Filtering and sorting are done in SQL
+    For the partitioned CpuWorkload table the pages are read partition by partition
+    while sorting by ID or Timestamp, the order in which the partitions follow each other;
+    it can't be sorted by other columns, each page would sort the whole view
+    New rows are appended (or prepended in descending order) by refresh() without resetting the model
+    """
+
+    # Columns whose order matches the order of the partitions
+    PARTITION_ALIGNED = ("ID", "Timestamp")
+
+    def __init__(self, table, key_column="ID", filter_column=None, partition_catalog=None,
+                 page_size=256, parent=None):
+        """
+        :param table: table or view name
+        :param key_column: unique column used as the tie-breaker of the keyset
+        :param filter_column: column matched against the filter prefix
+        :param partition_catalog: table listing the partitions of the view (Name, Start), if partitioned
+        :param page_size: number of rows fetched at once
+        :param parent: parent object
+        """
+        super().__init__(parent)
+        self.table = table
+        self.key_column = key_column
+        self.filter_column = filter_column
+        self.partition_catalog = partition_catalog
+        self.page_size = page_size
+        self.columns = []
+        self.rows = []
+        self.sort_column = key_column
+        self.sort_order = Qt.AscendingOrder
+        self.filter_text = ""
+        self.sources = []  # Tables read in scan order
+        self.source_index = 0
+        self.exhausted = True
+
+    def select(self):
+        """
+        Reset the model, the first page is fetched when the view asks for it
+        """
+        self.beginResetModel()
+        record = QSqlDatabase.database().record(self.table)
+        self.columns = [record.fieldName(i) for i in range(record.count())]
+        self.rows = []
+        self.sources = self.load_sources()
+        self.source_index = 0
+        self.exhausted = not self.columns or not self.sources
+        self.endResetModel()
+        return True
+
+    def load_sources(self):
+        """
+        :return: tables to read in scan order
+        """
+        if not self.partition_catalog or self.sort_column not in self.PARTITION_ALIGNED:
+            return [self.table]
+        query = QSqlQuery()
+        query.exec_(f"SELECT Name FROM {self.partition_catalog} ORDER BY Start")
+        sources = []
+        while query.next():
+            sources.append(query.value(0))
+        if self.sort_order == Qt.DescendingOrder:
+            sources.reverse()
+        return sources
+
+    def set_filter(self, text):
+        """
+        Show only rows whose filter column starts with the text
+        :param text: prefix, empty to show all rows
+        """
+        self.filter_text = text
+        self.select()
+
+    # noinspection PyPep8Naming
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    # noinspection PyPep8Naming
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return self.rows[index.row()][index.column()]
+
+    # noinspection PyPep8Naming
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.columns[section] if section < len(self.columns) else None
+        return section + 1
+
+    # noinspection PyPep8Naming
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    # noinspection PyPep8Naming
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.exhausted:
+            return
+        rows = []
+        after = self.row_key(self.rows[-1]) if self.rows else None
+        while len(rows) < self.page_size and self.source_index < len(self.sources):
+            wanted = self.page_size - len(rows)
+            page = self.query(self.sources[self.source_index], after, self.sort_order, wanted)
+            rows.extend(page)
+            if page:
+                after = self.row_key(page[-1])
+            if len(page) < wanted:
+                self.source_index += 1
+        if self.source_index >= len(self.sources):
+            # Stay on the last source, so refresh() can continue from it
+            self.source_index = len(self.sources) - 1
+            self.exhausted = True
+        if rows:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+            self.rows.extend(rows)
+            self.endInsertRows()
+
+    def sortable(self, column):
+        """
+        :param column: column name
+        :return: True if the rows can be sorted by the column, see PARTITION_ALIGNED
+        """
+        return not self.partition_catalog or column in self.PARTITION_ALIGNED
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if column < len(self.columns) and self.sortable(self.columns[column]):
+            self.sort_column = self.columns[column]
+            self.sort_order = order
+            self.select()
+
+    def refresh(self):
+        """
+        Show rows written since the last fetch, without resetting the model
+        When sorted by ID or Timestamp new rows go to the end (ascending) or to the top (descending),
+        otherwise the rows after the last fetched one are fetched as the view scrolls,
+        the others are shown by the next sort or filter
+        """
+        if not self.columns:
+            self.select()
+            return
+        if self.sort_column not in self.PARTITION_ALIGNED:
+            self.exhausted = not self.sources
+            return
+        current = self.sources[self.source_index] if self.sources else None
+        self.sources = self.load_sources()
+        # Partitions may have been created or dropped meanwhile
+        self.source_index = self.sources.index(current) if current in self.sources else 0
+        if self.sort_order == Qt.AscendingOrder:
+            if self.exhausted:
+                self.exhausted = not self.sources
+        elif self.rows:
+            self.prepend_new_rows()
+        else:
+            self.select()
+
+    def prepend_new_rows(self):
+        """
+        Insert rows newer than the first row at the top of a descending model
+        """
+        first = self.row_key(self.rows[0])
+        rows = []
+        # Sources are in descending order, new rows can only be in the newest partitions
+        for source in self.sources:
+            page = self.query(source, first, Qt.AscendingOrder, None)
+            rows = page + rows
+            if len(page) == 0:
+                break
+        if rows:
+            rows.reverse()
+            self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+            self.rows[0:0] = rows
+            self.endInsertRows()
+
+    def row_key(self, row):
+        return row[self.columns.index(self.sort_column)], row[self.columns.index(self.key_column)]
+
+    def query(self, source, after, order, limit):
+        """
+        Read rows following the keyset in the given order
+        :param source: table to read
+        :param after: (sort value, key) of the row to continue after, None to start from the beginning
+        :param order: Qt.AscendingOrder or Qt.DescendingOrder
+        :param limit: maximal number of rows, None for all
+        :return: list of row tuples
+        """
+        clauses = []
+        filter_to = None
+        if self.filter_text and self.filter_column:
+            # A range instead of LIKE, so the index on the filter column can be used
+            clauses.append(f"{self.filter_column} >= :filter_from")
+            filter_to = prefix_end(self.filter_text)
+            if filter_to is not None:
+                clauses.append(f"{self.filter_column} < :filter_to")
+        if after is not None:
+            operator = ">" if order == Qt.AscendingOrder else "<"
+            clauses.append(f"({self.sort_column}, {self.key_column}) {operator} (:sort_value, :key_value)")
+        direction = "ASC" if order == Qt.AscendingOrder else "DESC"
+        sql = f"SELECT {', '.join(self.columns)} FROM {source}"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += f" ORDER BY {self.sort_column} {direction}, {self.key_column} {direction}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+
+        query = QSqlQuery()
+        query.setForwardOnly(True)
+        query.prepare(sql)
+        if self.filter_text and self.filter_column:
+            query.bindValue(":filter_from", self.filter_text)
+            if filter_to is not None:
+                query.bindValue(":filter_to", filter_to)
+        if after is not None:
+            query.bindValue(":sort_value", after[0])
+            query.bindValue(":key_value", after[1])
+        if not query.exec_():
+            logger.error("Failed to fetch rows: %s", query.lastError().text())
+            return []
+        rows = []
+        column_count = len(self.columns)
+        while query.next():
+            rows.append(tuple(query.value(i) for i in range(column_count)))
+        return rows
@@ -0,0 +1,290 @@
+import errno
+import os
+import sys
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where /proc does not exist anyway
+    resource = None
+
+# Fields of /proc/[pid]/stat counted from the first field after the process name, see proc(5)
+PPID = 1
+UTIME = 11
+STIME = 12
+NUM_THREADS = 17
+STARTTIME = 19
+# psutil extends names truncated by the kernel to 15 characters from the command line
+TRUNCATED_NAME = 15
+
+
+class ProcStatRegistry:
+    """
+    Linux sampler backend with the interface of ProcessRegistry, reading /proc directly instead of through psutil
+    The /proc/[pid]/stat file of every known process is opened once and kept open,
+    every tick reads it again with a single preadv() into a reused buffer, and only the needed fields are parsed.
+    A stat file held open belongs to its process for good: once the process exits, reading it fails with ESRCH,
+    even if the PID is reused in the meantime, so the identity of the processes comes for free
+    CPU times are counted in jiffies, and the clock is the total of jiffies of /proc/stat divided by the number
+    of cores, so the usage is the ratio of two counters of the kernel's own accounting
+    Processes are identified by the key (pid, starttime), the values read are those of psutil
+    """
+
+    STAT_SIZE = 1024
+
+    def __init__(self):
+        if not self.available():
+            raise RuntimeError("/proc is not available, use the psutil backend")
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.buffer = bytearray(self.STAT_SIZE)
+        self.buffers = [self.buffer]
+        self.num_cores = sum(1 for line in self.read_file('/proc/stat').splitlines() if line[:3] == b'cpu') - 1
+        self.max_files = self.file_budget()
+        # Dictionaries are replaced rather than mutated on refresh,
+        # so readers from other threads always see a consistent snapshot
+        self.keys = {}  # {pid: (pid, starttime)}
+        self.names = {}  # {pid: name}
+        self.parents = {}  # {pid: ppid}
+        self.files = {}  # {pid: descriptor of /proc/[pid]/stat kept open}
+        self.stale = set()  # PIDs whose process was found exited while reading it
+        self.stat_file = os.open('/proc/stat', os.O_RDONLY)
+
+    def __del__(self):
+        # Once the registry is dropped, e.g. when switching backends, no sweep can use the descriptors any more
+        if hasattr(self, 'stat_file'):
+            self.clear()
+            os.close(self.stat_file)
+
+    @staticmethod
+    def available():
+        return sys.platform.startswith('linux') and os.path.isfile('/proc/stat')
+
+    @staticmethod
+    def file_budget():
+        """
+        Raise the soft limit of open files up to the hard limit, so that the stat files of thousands of processes
+        can be kept open
+        :return: number of stat files kept open, half of the limit is left to the rest of the application
+        """
+        if resource is None:
+            return 0
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = 65536 if hard == resource.RLIM_INFINITY else min(hard, 65536)
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+                soft = wanted
+            except (ValueError, OSError):
+                pass
+        return min(soft, 65536) // 2
+
+    @staticmethod
+    def read_file(path):
+        """
+        :return: content of a small /proc file as bytes
+        """
+        with open(path, 'rb', buffering=0) as file:
+            return file.read()
+
+    def refresh(self, verify=()):
+        """
+        Diff the process table against the known processes, see ProcessRegistry.refresh()
+        Exited processes are noticed while reading their stat file, so `verify` is not needed
+        :param verify: ignored, kept for the interface
+        :return: tuple (added, exited), lists of (pid, name)
+        """
+        current = {int(entry) for entry in os.listdir('/proc') if entry.isdigit()}
+        known = set(self.keys)
+        recycled = self.stale & current & known
+        self.stale = set()
+        gone = (known - current) | recycled
+        new = (current - known) | recycled
+        if not gone and not new:
+            return [], []
+
+        keys, names, parents, files = dict(self.keys), dict(self.names), dict(self.parents), dict(self.files)
+        exited = [(pid, names[pid]) for pid in sorted(gone)]
+        for pid in gone:
+            del keys[pid], names[pid], parents[pid]
+            fd = files.pop(pid, None)
+            if fd is not None:
+                os.close(fd)
+        if gone:
+            # Children of exited processes are reparented
+            for pid in [pid for pid, ppid in parents.items() if ppid in gone]:
+                ppid = self.read_parent(pid, files.get(pid))
+                if ppid is not None:
+                    parents[pid] = ppid
+
+        added = []
+        for pid in sorted(new):
+            try:
+                fd = os.open(f'/proc/{pid}/stat', os.O_RDONLY)
+            except OSError:
+                # Exited in the meantime
+                continue
+            try:
+                data = os.pread(fd, self.STAT_SIZE, 0)
+                name = self.read_name(pid, data)
+            except OSError:
+                os.close(fd)
+                continue
+            fields = data[data.rfind(b')') + 2:].split(None, STARTTIME + 1)
+            keys[pid] = (pid, int(fields[STARTTIME]))
+            names[pid] = name
+            parents[pid] = int(fields[PPID])
+            if len(files) < self.max_files:
+                files[pid] = fd
+            else:
+                os.close(fd)
+            added.append((pid, name))
+
+        self.keys, self.names, self.parents, self.files = keys, names, parents, files
+        return added, exited
+
+    def read_parent(self, pid, fd=None):
+        """
+        :param pid: process id
+        :param fd: descriptor of /proc/[pid]/stat if it is kept open
+        :return: parent process id or None if the process exited
+        """
+        try:
+            if fd is not None:
+                data = os.pread(fd, self.STAT_SIZE, 0)
+            else:
+                data = self.read_file(f'/proc/{pid}/stat')
+        except OSError:
+            return None
+        return int(data[data.rfind(b')') + 2:].split(None, PPID + 1)[PPID])
+
+    @staticmethod
+    def read_name(pid, data):
+        """
+        Name of the process the way psutil reports it
+        :param pid: process id
+        :param data: content of /proc/[pid]/stat
+        :return: str
+        """
+        name = os.fsdecode(data[data.find(b'(') + 1:data.rfind(b')')])
+        if len(name) < TRUNCATED_NAME:
+            return name
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as file:
+                cmdline = file.read()
+        except OSError:
+            return name
+        if cmdline.endswith(b'\0'):
+            cmdline = cmdline[:-1]
+        # Processes rewriting their title may separate the arguments with spaces
+        separator = b'\0' if b'\0' in cmdline or b' ' not in cmdline else b' '
+        extended_name = os.path.basename(os.fsdecode(cmdline.split(separator, 1)[0]))
+        return extended_name if extended_name and extended_name.startswith(name) else name
+
+    def read(self, pids, metrics=()):
+        """
+        Read CPU time and the other metrics of the processes in one sweep, see ProcessRegistry.read()
+        :param pids: process ids, known to the registry
+        :param metrics: names of the other metrics, see PROCESS_METRICS
+        :return: dict {pid: (cpu_time, values)}, cpu_time in seconds, values is a dict {metric: value}
+                 or None without metrics; processes which exited are left out
+        """
+        readings = {}
+        files, keys, stale = self.files, self.keys, self.stale
+        buffer, buffers, preadv = self.buffer, self.buffers, os.preadv
+        clock_ticks = self.clock_ticks
+        # Split only as far as the last field needed, files opened for this read are checked for a recycled PID
+        last_field = NUM_THREADS if 'threads' in metrics else STIME
+        checked_field = max(last_field, STARTTIME)
+        for pid in pids:
+            fd = files.get(pid)
+            held = fd is not None
+            try:
+                if not held:
+                    # Over the budget of open files
+                    fd = os.open(f'/proc/{pid}/stat', os.O_RDONLY)
+                try:
+                    size = preadv(fd, buffers, 0)
+                finally:
+                    if not held:
+                        os.close(fd)
+            except OSError as error:
+                if error.errno in (errno.ESRCH, errno.ENOENT):
+                    stale.add(pid)
+                continue
+            split_at = (last_field if held else checked_field) + 1
+            fields = buffer[buffer.rfind(b')', 0, size) + 2:size].split(None, split_at)
+            if not held and int(fields[STARTTIME]) != keys[pid][1]:
+                # Another process with a recycled PID
+                stale.add(pid)
+                continue
+            cpu_time = (int(fields[UTIME]) + int(fields[STIME])) / clock_ticks
+            readings[pid] = (cpu_time, self.read_metrics(pid, fields, metrics) if metrics else None)
+        return readings
+
+    def read_metrics(self, pid, fields, metrics):
+        """
+        :param pid: process id
+        :param fields: fields of /proc/[pid]/stat after the process name
+        :param metrics: names of the metrics, see PROCESS_METRICS
+        :return: dict {metric: value}, counters are cumulative
+        Metrics the process does not allow to read are left out
+        """
+        values = {}
+        if 'threads' in metrics:
+            values['threads'] = int(fields[NUM_THREADS])
+        try:
+            if 'rss' in metrics:
+                # The resident size of /proc/[pid]/stat is an approximation of the per-CPU counters, statm is exact
+                values['rss'] = int(self.read_file(f'/proc/{pid}/statm').split()[1]) * self.page_size
+            if 'ctx_switches' in metrics:
+                ctx_switches = 0
+                for line in self.read_file(f'/proc/{pid}/status').splitlines():
+                    if line.startswith((b'voluntary_ctxt_switches', b'nonvoluntary_ctxt_switches')):
+                        ctx_switches += int(line.split()[1])
+                values['ctx_switches'] = ctx_switches
+            if 'fds' in metrics:
+                values['fds'] = len(os.listdir(f'/proc/{pid}/fd'))
+        except OSError:
+            pass
+        if 'read_bytes' in metrics or 'write_bytes' in metrics:
+            try:
+                io_counters = self.read_file(f'/proc/{pid}/io')
+            except OSError:
+                # Not readable for processes of other users
+                return values
+            for line in io_counters.splitlines():
+                counter, _, value = line.partition(b': ')
+                if counter in (b'read_bytes', b'write_bytes') and counter.decode() in metrics:
+                    values[counter.decode()] = int(value)
+        return values
+
+    def clock(self):
+        """
+        :return: seconds elapsed on one core, counted in jiffies by the kernel like the CPU times of processes
+        """
+        size = os.preadv(self.stat_file, self.buffers, 0)
+        # The first line is the total of all cores: user nice system idle iowait irq softirq steal guest guest_nice
+        fields = self.buffer[:size].split(b'\n', 1)[0].split()
+        # Guest time is already included in user time
+        return sum(int(field) for field in fields[1:9]) / self.clock_ticks / self.num_cores
+
+    def key(self, pid):
+        """
+        :param pid: process id
+        :return: (pid, starttime) identifying the process or None if the process is not known
+        """
+        return self.keys.get(pid)
+
+    def name(self, pid):
+        """
+        :param pid: process id
+        :return: process name or None if the process is not known
+        """
+        return self.names.get(pid)
+
+    def clear(self):
+        files, self.files = self.files, {}
+        self.keys, self.names, self.parents, self.stale = {}, {}, {}, set()
+        for fd in files.values():
+            os.close(fd)
@@ -1,8 +1,10 @@
 import warnings
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QWidget, QSizePolicy, QVBoxLayout, QHBoxLayout
 from PyQt5.QtWidgets import QListView, QPushButton, QLabel, QLineEdit, QAbstractItemView
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from cpu_watcher import CPUWatcher
+from process_name_model import ProcessNameModel, PrefixFilterProxyModel
 
 # Suppress DeprecationWarning for sipPyTypeDict
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -15,30 +17,47 @@ class ProcessManagementWidget(QWidget):
     Contains ownership for child widgets, but not for the CPUWatcher object
     """
 
+    # Milliseconds of typing pause before the filter is applied
+    FILTER_DELAY = 100
+
     def __init__(self, cpu_watcher: CPUWatcher):
         """
         Connect changing of process name and filtering of monitored processes
-        QStandardItemModel is chosen for the process list view,
+        Distinct process names are kept in a sorted model updated from the process table diffs,
+        the filter is a prefix range of it, so filtering does not depend on the number of processes
+        QStandardItemModel is chosen for the selected process list view,
         because it is easier to work with and the list won't be too large
         :param cpu_watcher: a valid CPUWatcher
         """
         super().__init__()
         assert isinstance(cpu_watcher, CPUWatcher)
         self.cpu_watcher = cpu_watcher
-        self.filtered_processes = []
 
-        # Line Edit for filtering processes
+        # Line Edit for filtering processes, the filter is applied when typing pauses
         self.process_filter_label = QLabel("Filter:")
         self.process_filter_edit = QLineEdit()
-        self.process_filter_edit.textChanged.connect(self.update_filtered_processes)
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(self.FILTER_DELAY)
+        self.filter_timer.timeout.connect(self.apply_filter)
+        self.process_filter_edit.textChanged.connect(self.filter_timer.start)
 
         # Button for adding processes
         self.add_button = QPushButton("Add")
         self.add_button.clicked.connect(self.press_add)
 
         # List Views for filtered processes and selected processes
-        self.filter_list_model = QStandardItemModel()
+        self.process_name_model = ProcessNameModel(self)
+        self.process_name_model.reset_processes(self.cpu_watcher.get_processes())
+        self.cpu_watcher.processes_added.connect(self.process_name_model.add_processes)
+        self.cpu_watcher.processes_exited.connect(self.process_name_model.remove_processes)
+        self.filter_list_model = PrefixFilterProxyModel(self)
+        self.filter_list_model.setSourceModel(self.process_name_model)
         self.filter_list_view = QListView()
+        # Lay out long lists in batches between events, the first rows are shown at once
+        self.filter_list_view.setUniformItemSizes(True)
+        self.filter_list_view.setLayoutMode(QListView.Batched)
+        self.filter_list_view.setBatchSize(100)
         self.filter_list_view.setModel(self.filter_list_model)
         self.filter_list_view.doubleClicked.connect(self.add_process)
 
@@ -90,21 +109,29 @@ class ProcessManagementWidget(QWidget):
 
         self.update_filtered_processes(text="")
 
+    def apply_filter(self):
+        self.update_filtered_processes(self.process_filter_edit.text())
+
     def update_filtered_processes(self, text: str):
         """
         Update the filtered processes based on the entered text
+        The process table is refreshed afterwards, started and exited processes are added and removed
+        from the list without rebuilding it
         """
-        self.filtered_processes = self.cpu_watcher.filter_processes(text)
-        extracted_names = [name for pid, name in self.filtered_processes.items()]
-        self.filter_list_model.clear()
-        for name in extracted_names:
-            item = QStandardItem(name)
-            self.filter_list_model.appendRow(item)
+        self.filter_list_model.set_prefix(text)
 
         # Select the first item in the list if it exists
         if self.filter_list_model.rowCount() > 0:
             first_index = self.filter_list_model.index(0, 0)
             self.filter_list_view.setCurrentIndex(first_index)
+        QTimer.singleShot(0, self.refresh_processes)
+
+    def refresh_processes(self):
+        """
+        While the thread is running, the process table is refreshed by the thread itself
+        """
+        if not self.cpu_watcher.isRunning():
+            self.cpu_watcher.refresh_processes()
 
     def press_add(self):
         """
@@ -119,11 +146,9 @@ class ProcessManagementWidget(QWidget):
         """
         Add the double-clicked process from the filtered list to the process list
         """
-        item = self.filter_list_model.itemFromIndex(index)
-        process_name = item.text()
+        process_name = index.data()
         self.process_list_model.appendRow(QStandardItem(process_name))
         self.process_filter_edit.clear()
-        self.filter_list_model.clear()
 
     def start_monitoring(self):
         """
@@ -136,7 +161,6 @@ class ProcessManagementWidget(QWidget):
             return
         selected_processes = [self.process_list_model.item(i).text() for i in range(self.process_list_model.rowCount())]
         self.cpu_watcher.watched_processes = selected_processes
-        self.cpu_watcher.cpu_usage_history = []
         self.process_list_model.clear()
         self.update_filtered_processes(text="")
         self.cpu_watcher.start()
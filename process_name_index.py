@@ -0,0 +1,84 @@
+import bisect
+
+
+class ProcessNameIndex:
+    """
+    Prefix index over the distinct names of running processes
+    Names are kept in a sorted list, so all names starting with a prefix form one contiguous range,
+    found with two binary searches
+    The index is updated incrementally from the (pid, name) diffs of the process table,
+    a name stays in the index while at least one process has it
+    """
+
+    def __init__(self):
+        self.names = []  # Sorted distinct names
+        self.pids = {}  # {pid: name}
+        self.counts = {}  # {name: number of processes}
+
+    def insertion_row(self, pid, name):
+        """
+        :return: row at which add() will insert the name, None if the name is already indexed
+        """
+        if pid in self.pids or name in self.counts:
+            return None
+        return bisect.bisect_left(self.names, name)
+
+    def removal_row(self, pid):
+        """
+        :return: row which remove() will delete, None if other processes have the same name
+        """
+        name = self.pids.get(pid)
+        if name is None or self.counts[name] > 1:
+            return None
+        return bisect.bisect_left(self.names, name)
+
+    def add(self, pid, name):
+        """
+        Index a started process, known PIDs are ignored
+        """
+        if pid in self.pids:
+            return
+        self.pids[pid] = name
+        count = self.counts.get(name, 0)
+        if count == 0:
+            bisect.insort(self.names, name)
+        self.counts[name] = count + 1
+
+    def remove(self, pid):
+        """
+        Remove an exited process, unknown PIDs are ignored
+        """
+        name = self.pids.pop(pid, None)
+        if name is None:
+            return
+        count = self.counts[name] - 1
+        if count == 0:
+            del self.counts[name]
+            del self.names[bisect.bisect_left(self.names, name)]
+        else:
+            self.counts[name] = count
+
+    def reset(self, processes):
+        """
+        Rebuild the index from the whole process table
+        :param processes: dict {pid: name}
+        """
+        self.pids = dict(processes)
+        self.counts = {}
+        for name in self.pids.values():
+            self.counts[name] = self.counts.get(name, 0) + 1
+        self.names = sorted(self.counts)
+
+    def prefix_range(self, prefix):
+        """
+        :param prefix: beginning of the name, empty for all names
+        :return: (first, last) rows of the names starting with the prefix, last is exclusive
+        """
+        if not prefix:
+            return 0, len(self.names)
+        first = bisect.bisect_left(self.names, prefix)
+        last = bisect.bisect_left(self.names, prefix + "\uffff", first)
+        return first, last
+
+    def __len__(self):
+        return len(self.names)
@@ -0,0 +1,178 @@
+from PyQt5.QtCore import Qt, QAbstractListModel, QAbstractProxyModel, QModelIndex
+
+from process_name_index import ProcessNameIndex
+
+
+class ProcessNameModel(QAbstractListModel):
+    """
+    Sorted list of the distinct names of running processes, backed by ProcessNameIndex
+    Rows are inserted and removed one by one as processes start and exit,
+    large diffs such as the first process table reset the model instead
+    """
+
+    # Diffs larger than that reset the model
+    RESET_THRESHOLD = 256
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.name_index = ProcessNameIndex()
+
+    # noinspection PyPep8Naming
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.name_index)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return self.name_index.names[index.row()]
+
+    def reset_processes(self, processes):
+        """
+        :param processes: dict {pid: name} of the whole process table
+        """
+        self.beginResetModel()
+        self.name_index.reset(processes)
+        self.endResetModel()
+
+    def add_processes(self, processes):
+        """
+        :param processes: list of (pid, name) of started processes
+        """
+        if len(processes) > self.RESET_THRESHOLD:
+            self.beginResetModel()
+            for pid, name in processes:
+                self.name_index.add(pid, name)
+            self.endResetModel()
+            return
+        for pid, name in processes:
+            row = self.name_index.insertion_row(pid, name)
+            if row is None:
+                self.name_index.add(pid, name)
+                continue
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.name_index.add(pid, name)
+            self.endInsertRows()
+
+    def remove_processes(self, processes):
+        """
+        :param processes: list of (pid, name) of exited processes
+        """
+        if len(processes) > self.RESET_THRESHOLD:
+            self.beginResetModel()
+            for pid, _ in processes:
+                self.name_index.remove(pid)
+            self.endResetModel()
+            return
+        for pid, _ in processes:
+            row = self.name_index.removal_row(pid)
+            if row is None:
+                self.name_index.remove(pid)
+                continue
+            self.beginRemoveRows(QModelIndex(), row, row)
+            self.name_index.remove(pid)
+            self.endRemoveRows()
+
+    def prefix_range(self, prefix):
+        return self.name_index.prefix_range(prefix)
+
+
+class PrefixFilterProxyModel(QAbstractProxyModel):
+    """
+    Shows the rows of a ProcessNameModel starting with a prefix
+    The source is sorted, so the matching rows are one contiguous range found by binary search:
+    changing the prefix costs O(log n) instead of testing every row as QSortFilterProxyModel does
+    Rows inserted into or removed from the source inside the range are forwarded without a reset
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.prefix = ""
+        self.first = 0
+        self.last = 0
+        self.removing = False
+        self.inserted = None  # (start, count) of source rows being inserted, hidden until the insertion ends
+
+    # noinspection PyPep8Naming
+    def setSourceModel(self, model):
+        self.beginResetModel()
+        super().setSourceModel(model)
+        model.rowsInserted.connect(self.source_rows_inserted)
+        model.rowsAboutToBeRemoved.connect(self.source_rows_about_to_be_removed)
+        model.rowsRemoved.connect(self.source_rows_removed)
+        model.modelAboutToBeReset.connect(self.beginResetModel)
+        model.modelReset.connect(self.source_reset)
+        self.first, self.last = model.prefix_range(self.prefix)
+        self.endResetModel()
+
+    def set_prefix(self, prefix):
+        """
+        Show only names starting with the prefix
+        :param prefix: beginning of the name, empty to show all names
+        """
+        self.beginResetModel()
+        self.prefix = prefix
+        self.first, self.last = self.sourceModel().prefix_range(prefix)
+        self.endResetModel()
+
+    # noinspection PyPep8Naming
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.last - self.first
+
+    # noinspection PyPep8Naming
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 1
+
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() or column != 0 or not 0 <= row < self.last - self.first:
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=None):
+        # Without an index it is QObject.parent()
+        if index is None:
+            return super().parent()
+        return QModelIndex()
+
+    # noinspection PyPep8Naming
+    def mapToSource(self, proxy_index):
+        if not proxy_index.isValid() or self.sourceModel() is None:
+            return QModelIndex()
+        row = proxy_index.row() + self.first
+        if self.inserted is not None and row >= self.inserted[0]:
+            row += self.inserted[1]
+        return self.sourceModel().index(row, proxy_index.column())
+
+    # noinspection PyPep8Naming
+    def mapFromSource(self, source_index):
+        if not source_index.isValid() or not self.first <= source_index.row() < self.last:
+            return QModelIndex()
+        return self.index(source_index.row() - self.first, source_index.column())
+
+    def source_rows_inserted(self, _parent, start, end):
+        first, last = self.sourceModel().prefix_range(self.prefix)
+        low, high = max(start, first), min(end, last - 1)
+        if low > high:
+            self.first, self.last = first, last
+            return
+        # Views look at the rows around the insertion point before it ends
+        self.inserted = (start, end - start + 1)
+        self.beginInsertRows(QModelIndex(), low - first, high - first)
+        self.inserted = None
+        self.first, self.last = first, last
+        self.endInsertRows()
+
+    def source_rows_about_to_be_removed(self, _parent, start, end):
+        low, high = max(start, self.first), min(end, self.last - 1)
+        if low <= high:
+            self.beginRemoveRows(QModelIndex(), low - self.first, high - self.first)
+            self.removing = True
+
+    def source_rows_removed(self, _parent, _start, _end):
+        self.first, self.last = self.sourceModel().prefix_range(self.prefix)
+        if self.removing:
+            self.removing = False
+            self.endRemoveRows()
+
+    def source_reset(self):
+        self.first, self.last = self.sourceModel().prefix_range(self.prefix)
+        self.endResetModel()
@@ -0,0 +1,182 @@
+import time
+
+import psutil
+
+# Refreshes between checks of the create time of all known processes, to notice PIDs recycled while not watched
+SWEEP_REFRESHES = 10
+
+
+def read_process_metrics(process, metrics):
+    """
+    Read the metrics of one process, must be called inside process.oneshot(),
+    so that the metrics coming from the same /proc file are read once
+    Metrics the process does not allow to read are left out
+    :param process: psutil.Process
+    :param metrics: names of the metrics, see PROCESS_METRICS
+    :return: dict {metric: value}, counters are cumulative
+    """
+    values = {}
+    try:
+        if 'rss' in metrics:
+            values['rss'] = process.memory_info().rss
+        if 'threads' in metrics:
+            values['threads'] = process.num_threads()
+        if 'ctx_switches' in metrics:
+            ctx_switches = process.num_ctx_switches()
+            values['ctx_switches'] = ctx_switches.voluntary + ctx_switches.involuntary
+    except psutil.AccessDenied:
+        pass
+    if 'fds' in metrics:
+        try:
+            values['fds'] = process.num_fds() if hasattr(process, 'num_fds') else process.num_handles()
+        except psutil.AccessDenied:
+            pass
+    if 'read_bytes' in metrics or 'write_bytes' in metrics:
+        try:
+            io_counters = process.io_counters()
+        except (psutil.AccessDenied, AttributeError):
+            # I/O counters are not available on macOS and for processes of other users
+            pass
+        else:
+            if 'read_bytes' in metrics:
+                values['read_bytes'] = io_counters.read_bytes
+            if 'write_bytes' in metrics:
+                values['write_bytes'] = io_counters.write_bytes
+    return values
+
+
+class ProcessRegistry:
+    """
+    Keeps psutil.Process handles alive between ticks
+    This is the default sampler backend, portable to every platform psutil supports
+    Every process is identified by the key (pid, create_time),
+    so a recycled PID is never confused with the process that owned it before
+    The registry is refreshed by diffing the PID table against the known processes,
+    handles are only created for PIDs that appeared since the previous refresh
+    """
+
+    def __init__(self):
+        # Dictionaries are replaced rather than mutated on refresh,
+        # so readers from other threads always see a consistent snapshot
+        self.handles = {}  # {pid: psutil.Process}
+        self.keys = {}  # {pid: (pid, create_time)}
+        self.names = {}  # {pid: name}
+        self.parents = {}  # {pid: ppid}
+        self.refreshes = 0
+
+    @staticmethod
+    def available():
+        return True
+
+    def refresh(self, verify=()):
+        """
+        Diff the process table against the known processes
+        PIDs present in both are assumed to belong to the same process,
+        except those passed in `verify`, whose create time is checked to detect PID reuse,
+        and every SWEEP_REFRESHES refreshes all of them, so an unwatched recycled PID is not kept with a stale name
+        Parents of the processes are read when they appear, and again for the children of exited processes,
+        which are reparented by the system
+        :param verify: PIDs whose identity must be confirmed, usually the watched ones
+        :return: tuple (added, exited), lists of (pid, name)
+        """
+        current = set(psutil.pids())
+        known = set(self.handles)
+        self.refreshes += 1
+        if self.refreshes % SWEEP_REFRESHES == 0:
+            verify = known
+        recycled = {
+            pid for pid in verify if pid in current and pid in known and not self.handles[pid].is_running()
+        }
+        gone = (known - current) | recycled
+        new = (current - known) | recycled
+        if not gone and not new:
+            return [], []
+
+        handles, keys, names, parents = dict(self.handles), dict(self.keys), dict(self.names), dict(self.parents)
+        exited = [(pid, names[pid]) for pid in sorted(gone)]
+        for pid in gone:
+            del handles[pid], keys[pid], names[pid], parents[pid]
+        if gone:
+            for pid in [pid for pid, ppid in parents.items() if ppid in gone]:
+                try:
+                    parents[pid] = handles[pid].ppid()
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    pass
+
+        added = []
+        for pid in sorted(new):
+            try:
+                process = psutil.Process(pid)
+                with process.oneshot():
+                    name = process.name()
+                    create_time = process.create_time()
+                    ppid = process.ppid()
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                # Exited in the meantime, or cannot be monitored anyway
+                continue
+            handles[pid] = process
+            keys[pid] = (pid, create_time)
+            names[pid] = name
+            parents[pid] = ppid
+            added.append((pid, name))
+
+        self.handles, self.keys, self.names, self.parents = handles, keys, names, parents
+        return added, exited
+
+    def read(self, pids, metrics=()):
+        """
+        Read CPU time and the other metrics of the processes in one pass
+        The metrics are read inside one oneshot() per process
+        :param pids: process ids, known to the registry
+        :param metrics: names of the other metrics, see PROCESS_METRICS
+        :return: dict {pid: (cpu_time, values)}, cpu_time in seconds, values is a dict {metric: value}
+                 or None without metrics; processes which exited are left out
+        """
+        readings = {}
+        handles = self.handles
+        for pid in pids:
+            process = handles[pid]
+            try:
+                if metrics:
+                    with process.oneshot():
+                        cpu_times = process.cpu_times()
+                        values = read_process_metrics(process, metrics)
+                else:
+                    cpu_times = process.cpu_times()
+                    values = None
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            readings[pid] = (cpu_times.user + cpu_times.system, values)
+        return readings
+
+    @staticmethod
+    def clock():
+        """
+        :return: seconds of the monotonic clock, CPU usage is the CPU time consumed over the time elapsed on it
+        """
+        return time.monotonic()
+
+    def get(self, pid):
+        """
+        :param pid: process id
+        :return: psutil.Process handle or None if the process is not known
+        """
+        return self.handles.get(pid)
+
+    def key(self, pid):
+        """
+        :param pid: process id
+        :return: (pid, create_time) identifying the process or None if the process is not known
+        """
+        return self.keys.get(pid)
+
+    def name(self, pid):
+        """
+        :param pid: process id
+        :return: process name or None if the process is not known
+        """
+        return self.names.get(pid)
+
+    def clear(self):
+        self.handles, self.keys, self.names, self.parents = {}, {}, {}, {}
+        self.refreshes = 0
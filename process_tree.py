@@ -0,0 +1,160 @@
+class ProcessTree:
+    """
+    Families of the watched processes
+    A process with a watched name roots a family unless one of its ancestors already belongs to one,
+    all descendants of the root belong to its family whatever their names, e.g. forked workers and shell children
+    The parent/child map is built from the process table snapshot of the registry once,
+    then updated incrementally with the processes started and exited since the previous refresh:
+    a started process joins the family of its parent, children of an exited process are moved
+    with their subtrees under the parent they were reparented to
+    """
+
+    def __init__(self):
+        self.watched = frozenset()  # Names of the processes rooting the families
+        self.parents = {}  # {pid: ppid}
+        self.children = {}  # {ppid: set of pids}
+        self.roots = {}  # {pid: root of the family of the process, None outside the families}
+        self.families = {}  # {root: set of member pids, the root included}
+        self.snapshot = None  # Cached result of members()
+
+    def rebuild(self, watched, names, parents):
+        """
+        Build the families from the whole process table
+        :param watched: names of the watched processes
+        :param names: dict {pid: name} of the registry
+        :param parents: dict {pid: ppid} of the registry
+        """
+        self.watched = frozenset(watched)
+        self.parents = dict(parents)
+        self.children = {}
+        for pid, ppid in self.parents.items():
+            self.children.setdefault(ppid, set()).add(pid)
+        self.roots, self.families = {}, {}
+        for pid, ppid in self.parents.items():
+            if ppid not in self.parents:
+                self.assign_subtree(pid, names)
+        self.snapshot = None
+
+    def update(self, watched, names, parents, added, exited):
+        """
+        Apply the diff of one refresh of the process table
+        Changing the watched names rebuilds the families from scratch
+        :param watched: names of the watched processes
+        :param names: dict {pid: name} of the registry, after the refresh
+        :param parents: dict {pid: ppid} of the registry, after the refresh
+        :param added: list of (pid, name) of started processes
+        :param exited: list of (pid, name) of exited processes
+        """
+        if frozenset(watched) != self.watched:
+            self.rebuild(watched, names, parents)
+            return
+        if not added and not exited:
+            return
+        orphans = []
+        for pid, _ in exited:
+            ppid = self.parents.pop(pid, None)
+            if ppid is None:
+                continue
+            self.unlink(pid, ppid)
+            orphans.extend(self.children.pop(pid, ()))
+            root = self.roots.pop(pid, None)
+            if root is not None:
+                self.leave(pid, root)
+        for pid in orphans:
+            if pid not in self.parents:
+                # Exited along with its parent
+                continue
+            ppid = parents.get(pid, 0)
+            self.unlink(pid, self.parents[pid])
+            self.link(pid, ppid)
+        started = {pid for pid, _ in added if pid in parents}
+        for pid in started:
+            # A recycled PID may still be linked under the previous owner
+            if pid in self.parents:
+                self.unlink(pid, self.parents[pid])
+            self.link(pid, parents[pid])
+        # Subtrees are assigned from their topmost process, the parent of a started process may have started too
+        for pid in orphans:
+            if pid in self.parents:
+                self.assign_subtree(pid, names)
+        for pid in started:
+            if self.parents[pid] not in started:
+                self.assign_subtree(pid, names)
+        self.snapshot = None
+
+    def link(self, pid, ppid):
+        self.parents[pid] = ppid
+        self.children.setdefault(ppid, set()).add(pid)
+
+    def unlink(self, pid, ppid):
+        siblings = self.children.get(ppid)
+        if siblings is not None:
+            siblings.discard(pid)
+            if not siblings:
+                del self.children[ppid]
+
+    def leave(self, pid, root):
+        """
+        Remove a process from its family, the family is gone with its last member
+        """
+        members = self.families[root]
+        members.discard(pid)
+        if not members:
+            del self.families[root]
+
+    def assign_subtree(self, top, names):
+        """
+        Find the family of a process from its parent, and propagate it to all its descendants
+        :param top: process whose parent has its family assigned already
+        :param names: dict {pid: name} of the registry
+        """
+        stack = [top]
+        while stack:
+            pid = stack.pop()
+            parent_root = self.roots.get(self.parents.get(pid))
+            if parent_root is not None:
+                root = parent_root
+            else:
+                root = pid if names.get(pid) in self.watched else None
+            previous = self.roots.get(pid)
+            if previous is not None and previous != root:
+                self.leave(pid, previous)
+            self.roots[pid] = root
+            if root is not None:
+                self.families.setdefault(root, set()).add(pid)
+            stack.extend(self.children.get(pid, ()))
+
+    def members(self):
+        """
+        :return: dict {root: tuple of member pids}, a snapshot which is safe to pass to other threads
+        """
+        if self.snapshot is None:
+            self.snapshot = {root: tuple(sorted(members)) for root, members in self.families.items()}
+        return self.snapshot
+
+    def pids(self):
+        """
+        :return: list of pids of all family members
+        """
+        return [pid for members in self.families.values() for pid in members]
+
+    def totals(self, series):
+        """
+        Sum the values of every family
+        :param series: dict {pid: (value, timestamp)} of one tick
+        :return: dict {root: (total, timestamp, number of members with a value)}
+        """
+        totals = {}
+        roots = self.roots
+        for pid, (value, timestamp) in series.items():
+            root = roots.get(pid)
+            if root is None:
+                continue
+            total = totals.get(root)
+            totals[root] = (value, timestamp, 1) if total is None else (total[0] + value, timestamp, total[2] + 1)
+        return totals
+
+    def clear(self):
+        self.watched = frozenset()
+        self.parents, self.children, self.roots, self.families = {}, {}, {}, {}
+        self.snapshot = None
@@ -0,0 +1,411 @@
+import json
+import math
+
+# Parameters of the kinds of rules: kind: {parameter: default}, None for the required ones
+# threshold: value at or above `threshold` for `duration` seconds, cleared below `clear`, by default the threshold
+# zscore: value above its exponentially weighted mean over `window` seconds by `limit` standard deviations
+#         and by `min_change` at least, once `warmup` samples of the process were seen; cleared below limit / 2
+# rate: change per second between two samples of at least `limit`, or at most `limit` if it is negative
+RULE_KINDS = {
+    'threshold': {'threshold': None, 'duration': 0.0, 'clear': None},
+    'zscore': {'limit': 3.0, 'window': 300.0, 'min_change': 0.0, 'warmup': 30},
+    'rate': {'limit': None},
+}
+# Parameters of all kinds: `metric` is 'cpu' or one of PROCESS_METRICS in the units sampled,
+# `processes` limits the rule to processes of these names, `cooldown` is the shortest time in seconds
+# between two events raised by the rule for the same process
+COMMON_PARAMETERS = {'name': None, 'kind': None, 'metric': 'cpu', 'processes': (), 'cooldown': 60.0}
+DEFAULT_RULES = [
+    {'name': "High CPU", 'kind': 'threshold', 'threshold': 90.0, 'duration': 30.0, 'clear': 80.0},
+    {'name': "CPU spike", 'kind': 'zscore', 'limit': 4.0, 'window': 300.0, 'min_change': 20.0},
+    {'name': "CPU surge", 'kind': 'rate', 'limit': 50.0},
+]
+# Processes the state is allocated for at first, doubled as needed
+INITIAL_CAPACITY = 64
+
+
+def load_rules(path):
+    """
+    :param path: JSON file with a list of rules, see RULE_KINDS
+    :return: list of rules
+    :raise OSError, ValueError: if the file can't be read or the rules are invalid
+    """
+    with open(path) as file:
+        rules = json.load(file)
+    if not isinstance(rules, list):
+        raise ValueError(f"{path} must contain a list of rules")
+    for rule in rules:
+        validate_rule(rule)
+    return rules
+
+
+def validate_rule(rule):
+    """
+    :param rule: dict of the parameters of a rule
+    :return: the parameters with the defaults filled in
+    :raise ValueError: if the rule is invalid
+    """
+    if not isinstance(rule, dict):
+        raise ValueError(f"Rule {rule!r} must be an object")
+    kind = rule.get('kind')
+    if kind not in RULE_KINDS:
+        raise ValueError(f"Rule {rule.get('name')!r} has an unknown kind {kind!r}, choose from {list(RULE_KINDS)}")
+    parameters = {**COMMON_PARAMETERS, **RULE_KINDS[kind]}
+    unknown = set(rule) - set(parameters)
+    if unknown:
+        raise ValueError(f"Rule {rule.get('name')!r} has unknown parameters {sorted(unknown)}")
+    parameters.update(rule)
+    missing = [name for name, value in parameters.items() if value is None and name != 'clear']
+    if missing:
+        raise ValueError(f"Rule {rule.get('name')!r} misses parameters {missing}")
+    if kind == 'zscore' and parameters['window'] <= 0:
+        raise ValueError(f"Rule {rule['name']!r} needs a positive window")
+    return parameters
+
+
+class RuleGroup:
+    """
+    Rules of one kind on one metric, evaluated together for all processes
+    Parameters are columns of shape (rules, 1) and state is of shape (rules, slots), a slot per process,
+    so a tick is a handful of NumPy operations whatever the number of rules and processes
+    Subclasses compute which rules fire, the group turns that into de-duplicated events:
+    an event is raised when a rule starts firing for a process, unless one was raised less than `cooldown` ago,
+    and a cleared event follows once the rule stops firing, if the raise was reported
+    """
+
+    # State arrays of the kind: name: (fill value of a free slot, dtype)
+    # NumPy is imported by the methods, so importing the module, e.g. for the settings, does not import it
+    STATE = {}
+    # State arrays which do not depend on the parameters, a single row shared by the rules
+    SHARED = frozenset()
+
+    def __init__(self, metric, rules, capacity):
+        """
+        :param metric: name of the metric
+        :param rules: list of validated rules of the kind
+        :param capacity: number of slots
+        """
+        import numpy as np
+
+        self.metric = metric
+        self.rules = rules
+        self.names = [rule['name'] for rule in rules]
+        self.filters = [frozenset(rule['processes']) for rule in rules]
+        self.cooldown = self.column('cooldown')
+        self.state = {'active': (False, bool), 'notified': (False, bool), 'last_raised': (-math.inf, 'float64'),
+                      **self.STATE}
+        self.arrays = {name: np.full((1 if name in self.SHARED else len(rules), capacity), fill, dtype)
+                       for name, (fill, dtype) in self.state.items()}
+        # Rules applying to the process in the slot, rules without a filter apply to every process
+        self.applies = np.ones((len(rules), capacity), dtype=bool)
+        self.filtered = [row for row, processes in enumerate(self.filters) if processes]
+
+    def column(self, parameter):
+        import numpy as np
+
+        return np.array([[rule[parameter]] for rule in self.rules], dtype=np.float64)
+
+    def grow(self, capacity):
+        import numpy as np
+
+        for name, (fill, dtype) in self.state.items():
+            array = self.arrays[name]
+            grown = np.full((array.shape[0], capacity), fill, dtype)
+            grown[:, :array.shape[1]] = array
+            self.arrays[name] = grown
+        applies = np.ones((len(self.rules), capacity), dtype=bool)
+        applies[:, :self.applies.shape[1]] = self.applies
+        self.applies = applies
+
+    def assign(self, slot, name):
+        """
+        A process was given the slot, its state starts over
+        :param slot: slot of the process
+        :param name: name of the process
+        """
+        for array_name, (fill, _) in self.state.items():
+            self.arrays[array_name][:, slot] = fill
+        for row in self.filtered:
+            self.applies[row, slot] = name in self.filters[row]
+
+    def release(self, slots):
+        """
+        The processes in the slots exited
+        :return: (rule row, slot) of the reported events not yet cleared
+        """
+        import numpy as np
+
+        notified = self.arrays['notified'][:, slots] & self.arrays['active'][:, slots]
+        rows, columns = np.nonzero(notified)
+        return [(row, slots[column]) for row, column in zip(rows, columns)]
+
+    def firing(self, timestamp, values, times, present):
+        """
+        Update the state with the samples of a tick
+        :param timestamp: timestamp of the tick
+        :param values: array of the values per slot, NaN where there is no sample
+        :param times: array of the timestamps of the samples per slot
+        :param present: boolean array of the slots with a sample
+        :return: (rules, slots) boolean array of the rules firing, and an array to describe the events with
+        """
+        raise NotImplementedError
+
+    def describe(self, row, value, detail):
+        """
+        :return: text explaining why the rule fired
+        """
+        raise NotImplementedError
+
+    def evaluate(self, timestamp, values, times, present):
+        """
+        :return: lists of (rule row, slot, detail) of the events raised and cleared in this tick
+        """
+        import numpy as np
+
+        firing, detail = self.firing(timestamp, values, times, present)
+        firing &= self.applies
+        active = self.arrays['active']
+        notified = self.arrays['notified']
+        last_raised = self.arrays['last_raised']
+        raised = firing & ~active
+        stopped = active & ~firing & present
+        if not raised.any() and not stopped.any():
+            return [], []
+        reported = raised & (timestamp - last_raised >= self.cooldown)
+        last_raised[reported] = timestamp
+        cleared = stopped & notified
+        active |= raised
+        active &= ~stopped
+        notified &= ~stopped
+        notified |= reported
+        return ([(row, slot, detail[row, slot]) for row, slot in zip(*np.nonzero(reported))],
+                [(row, slot, detail[row, slot]) for row, slot in zip(*np.nonzero(cleared))])
+
+
+class ThresholdRules(RuleGroup):
+    STATE = {'since': (math.nan, 'float64')}  # Time the value went above the threshold, NaN while below
+
+    def __init__(self, metric, rules, capacity):
+        import numpy as np
+
+        super().__init__(metric, rules, capacity)
+        self.threshold = self.column('threshold')
+        self.duration = self.column('duration')
+        self.clear = np.array([[rule['threshold'] if rule['clear'] is None else rule['clear']] for rule in rules])
+
+    def firing(self, timestamp, values, times, present):
+        import numpy as np
+
+        since, active = self.arrays['since'], self.arrays['active']
+        above = values >= self.threshold
+        np.copyto(since, times, where=above & np.isnan(since))
+        np.copyto(since, np.nan, where=~above)
+        firing = active & (values >= self.clear) | ~active & above & (times - since >= self.duration)
+        return firing, np.broadcast_to(values, firing.shape)
+
+    def describe(self, row, value, detail):
+        return f"at {value:.1f}, threshold {self.threshold[row, 0]:g} for {self.duration[row, 0]:g}s"
+
+
+class ZScoreRules(RuleGroup):
+    STATE = {
+        'mean': (0.0, 'float64'),  # Exponentially weighted mean and variance
+        'variance': (0.0, 'float64'),
+        'count': (0, 'int64'),  # Samples seen, the first one initializes the mean
+        'last_time': (math.nan, 'float64'),
+    }
+    SHARED = frozenset(('count', 'last_time'))
+
+    def __init__(self, metric, rules, capacity):
+        super().__init__(metric, rules, capacity)
+        self.limit = self.column('limit')
+        self.window = self.column('window')
+        self.min_change = self.column('min_change')
+        self.warmup = self.column('warmup')
+
+    def firing(self, timestamp, values, times, present):
+        import numpy as np
+
+        mean, variance, count, last_time = (self.arrays[name] for name in ('mean', 'variance', 'count', 'last_time'))
+        active = self.arrays['active']
+        difference = values - mean
+        # A change from a constant value scores infinite, no change scores NaN and never fires
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = difference / np.sqrt(variance)
+        raising = (score >= self.limit) & (difference >= self.min_change)
+        firing = (active & (score >= self.limit / 2) | ~active & raising) & (count >= self.warmup)
+        # Exponential weights follow the time between samples, so the window does not depend on the interval;
+        # the samples of a tick are usually as old as each other, then the weights are a column per rule
+        seen = present & (count[0] > 0)
+        elapsed = np.maximum(times[seen] - last_time[0, seen], 0.0)
+        if len(elapsed) and elapsed.min() == elapsed.max():
+            alpha = 1 - np.exp(-elapsed[0] / self.window)
+        else:
+            with np.errstate(invalid='ignore'):
+                alpha = 1 - np.exp(-np.maximum(times - last_time, 0.0) / self.window)
+        increment = alpha * difference
+        np.add(mean, increment, out=mean, where=seen)
+        np.copyto(mean, values, where=present & (count[0] == 0))
+        np.copyto(variance, (1 - alpha) * (variance + difference * increment), where=seen)
+        count += present
+        np.copyto(last_time, times, where=present)
+        return firing, score
+
+    def describe(self, row, value, detail):
+        return f"at {value:.1f}, {detail:.1f} standard deviations above the mean over {self.window[row, 0]:g}s"
+
+
+class RateRules(RuleGroup):
+    STATE = {
+        'previous': (math.nan, 'float64'),  # Value and time of the previous sample
+        'previous_time': (math.nan, 'float64'),
+    }
+    SHARED = frozenset(('previous', 'previous_time'))
+
+    def __init__(self, metric, rules, capacity):
+        super().__init__(metric, rules, capacity)
+        self.limit = self.column('limit')
+
+    def firing(self, timestamp, values, times, present):
+        import numpy as np
+
+        previous, previous_time = self.arrays['previous'], self.arrays['previous_time']
+        elapsed = times - previous_time
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.where(elapsed > 0, (values - previous) / elapsed, np.nan)
+            firing = rate * np.sign(self.limit) >= np.abs(self.limit)
+        np.copyto(previous, values, where=present)
+        np.copyto(previous_time, times, where=present)
+        return firing, np.broadcast_to(rate, firing.shape)
+
+    def describe(self, row, value, detail):
+        return f"at {value:.1f}, changing by {detail:+.1f}/s, limit {self.limit[row, 0]:+g}/s"
+
+
+# Group class of every kind
+RULE_GROUPS = {
+    'threshold': ThresholdRules,
+    'zscore': ZScoreRules,
+    'rate': RateRules,
+}
+
+
+class RulesEngine:
+    """
+    Evaluates threshold, z-score and rate of change rules on every tick of the monitored processes, independent of Qt
+    Every process is given a slot in the state arrays of the rule groups while it is sampled,
+    a tick copies the samples into one array per metric and evaluates each group with whole-array operations:
+    the cost per sample does not grow with the history, and hundreds of rules cost little more than one
+    Events are de-duplicated per rule and process, see RuleGroup
+    """
+
+    def __init__(self, rules=None):
+        """
+        :param rules: list of rules, see RULE_KINDS, None for DEFAULT_RULES
+        :raise ValueError: if a rule is invalid
+        """
+        self.rules = [validate_rule(rule) for rule in (DEFAULT_RULES if rules is None else rules)]
+        self.capacity = None
+        self.slots = None
+        self.processes = None
+        self.free = None
+        self.groups = None
+        self.clear()
+        self.metrics = sorted({group.metric for group in self.groups})
+
+    def __len__(self):
+        return len(self.rules)
+
+    def clear(self):
+        """
+        Forget all processes, e.g. when monitoring is restarted
+        """
+        self.capacity = INITIAL_CAPACITY
+        self.slots = {}  # {pid: slot}
+        self.processes = []  # (pid, name) per slot, None for free slots
+        self.free = []  # Free slots, reused before the arrays grow
+        grouped = {}
+        for rule in self.rules:
+            grouped.setdefault((rule['kind'], rule['metric']), []).append(rule)
+        self.groups = [RULE_GROUPS[kind](metric, group_rules, self.capacity)
+                       for (kind, metric), group_rules in grouped.items()]
+
+    def allocate(self, pid, name):
+        if not self.free:
+            used = len(self.processes)
+            if used == self.capacity:
+                self.capacity *= 2
+                for group in self.groups:
+                    group.grow(self.capacity)
+            self.processes.append(None)
+            self.free.append(used)
+        slot = self.free.pop()
+        self.slots[pid] = slot
+        self.processes[slot] = (pid, name)
+        for group in self.groups:
+            group.assign(slot, name)
+        return slot
+
+    def release(self, timestamp, pids):
+        """
+        Free the slots of exited processes
+        :return: list of (timestamp, event text) clearing the events they still had
+        """
+        slots = [self.slots.pop(pid) for pid in pids]
+        events = []
+        for group in self.groups:
+            for row, slot in group.release(slots):
+                pid, name = self.processes[slot]
+                events.append((timestamp, f"{group.names[row]} cleared: {name} ({pid}) exited"))
+        for slot in slots:
+            self.processes[slot] = None
+        self.free.extend(slots)
+        return events
+
+    def evaluate(self, series, names):
+        """
+        Evaluate the rules on the samples of one tick
+        :param series: dictionary {metric: {pid: (value, timestamp)}}, 'cpu' for the CPU usage,
+                       processes missing from the CPU usage are considered exited
+        :param names: dictionary {pid: name} of the processes
+        :return: list of (timestamp, event text)
+        """
+        import numpy as np
+
+        cpu_usage = series.get('cpu', {})
+        if not cpu_usage or not self.groups:
+            return []
+        timestamp = max(timestamp for _, timestamp in cpu_usage.values())
+        events = []
+        exited = self.slots.keys() - cpu_usage.keys()
+        if exited:
+            events.extend(self.release(timestamp, exited))
+        slots = self.slots
+        for pid in cpu_usage.keys() - slots.keys():
+            self.allocate(pid, names.get(pid, ""))
+
+        for metric in self.metrics:
+            samples = series.get(metric, {})
+            values = np.full(self.capacity, np.nan)
+            times = np.full(self.capacity, np.nan)
+            if samples:
+                indices = np.fromiter((slots[pid] for pid in samples if pid in slots), dtype=np.intp)
+                pairs = np.array([sample for pid, sample in samples.items() if pid in slots], dtype=np.float64)
+                if len(indices):
+                    values[indices] = pairs[:, 0]
+                    times[indices] = pairs[:, 1]
+            present = ~np.isnan(values)
+            for group in self.groups:
+                if group.metric != metric:
+                    continue
+                raised, cleared = group.evaluate(timestamp, values, times, present)
+                for row, slot, detail in raised:
+                    pid, name = self.processes[slot]
+                    events.append((timestamp, f"{group.names[row]}: {name} ({pid}) {metric} "
+                                              f"{group.describe(row, values[slot], detail)}"))
+                for row, slot, _ in cleared:
+                    pid, name = self.processes[slot]
+                    events.append((timestamp, f"{group.names[row]} cleared: {name} ({pid}) {metric} "
+                                              f"at {values[slot]:.1f}"))
+        return events
+
@@ -1,10 +1,32 @@
 import json
+import logging
 import os.path
 
-from PyQt5.QtWidgets import QDialogButtonBox, QCheckBox, QDialog, QVBoxLayout
+from PyQt5.QtWidgets import (QDialogButtonBox, QCheckBox, QDialog, QVBoxLayout, QGroupBox, QComboBox, QFormLayout,
+                             QSpinBox, QDoubleSpinBox)
+
+from cpu_sampler import PROCESS_METRICS, DEFAULT_BACKEND, available_backends
+from rules_engine import DEFAULT_RULES
+from storage import STORAGE_BACKENDS, DEFAULT_STORAGE
+from tick_scheduler import MIN_INTERVAL
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_SETTINGS = {
-    "rewrite_database": False
+    "rewrite_database": False,
+    "db_flush_interval": 1.0,
+    "retention_days": 7,
+    "system_metrics": True,
+    "process_metrics": list(PROCESS_METRICS),
+    "sampler_backend": DEFAULT_BACKEND,
+    "storage_backend": DEFAULT_STORAGE,
+    "process_tree": False,
+    "stats_log_interval": 60,
+    "sampling_interval": 1.0,
+    "adaptive_interval": False,
+    "rules_enabled": True,
+    # Edited in the settings file, see rules_engine.RULE_KINDS
+    "rules": DEFAULT_RULES
 }
 
 
@@ -23,6 +45,54 @@ class SettingsWidget(QDialog):
         self.rewrite_database_checkbox = QCheckBox("Rewrite Database on Startup")
         layout.addWidget(self.rewrite_database_checkbox)
 
+        # Add setting for "Collect System Metrics"
+        self.system_metrics_checkbox = QCheckBox("Collect System Metrics (per-core CPU, memory, I/O)")
+        layout.addWidget(self.system_metrics_checkbox)
+
+        # Add setting for "Aggregate Process Trees"
+        self.process_tree_checkbox = QCheckBox("Aggregate Process Trees (watch children of the watched processes)")
+        layout.addWidget(self.process_tree_checkbox)
+
+        # Add setting for "Adaptive Sampling Interval"
+        self.adaptive_interval_checkbox = QCheckBox("Adaptive Sampling Interval (faster while the load changes)")
+        layout.addWidget(self.adaptive_interval_checkbox)
+
+        # Add setting for "Evaluate Alert Rules"
+        self.rules_enabled_checkbox = QCheckBox("Evaluate Alert Rules (events written to System Events)")
+        layout.addWidget(self.rules_enabled_checkbox)
+
+        # Add setting for the sampler backend, 'proc' is only available on Linux
+        backend_layout = QFormLayout()
+        self.sampling_interval_spinbox = QDoubleSpinBox()
+        self.sampling_interval_spinbox.setRange(MIN_INTERVAL, 60)
+        self.sampling_interval_spinbox.setSingleStep(0.1)
+        self.sampling_interval_spinbox.setDecimals(1)
+        self.sampling_interval_spinbox.setSuffix(" s")
+        backend_layout.addRow("Sampling Interval", self.sampling_interval_spinbox)
+        self.sampler_backend_combo = QComboBox()
+        self.sampler_backend_combo.addItems(available_backends())
+        backend_layout.addRow("Sampler Backend", self.sampler_backend_combo)
+        # The database is opened at startup, the storage backend is applied on restart
+        self.storage_backend_combo = QComboBox()
+        self.storage_backend_combo.addItems(STORAGE_BACKENDS)
+        backend_layout.addRow("Storage Backend (on restart)", self.storage_backend_combo)
+
+        # Add setting for the periodic log of the statistics of the monitor itself, 0 turns it off
+        self.stats_log_interval_spinbox = QSpinBox()
+        self.stats_log_interval_spinbox.setRange(0, 86400)
+        self.stats_log_interval_spinbox.setSuffix(" s")
+        backend_layout.addRow("Statistics Log Interval", self.stats_log_interval_spinbox)
+        layout.addLayout(backend_layout)
+
+        # Add settings for the per-process metrics sampled along with CPU usage
+        process_metrics_group = QGroupBox("Process Metrics")
+        process_metrics_layout = QVBoxLayout(process_metrics_group)
+        self.process_metric_checkboxes = {}
+        for metric, (label, _, _, _) in PROCESS_METRICS.items():
+            self.process_metric_checkboxes[metric] = QCheckBox(label)
+            process_metrics_layout.addWidget(self.process_metric_checkboxes[metric])
+        layout.addWidget(process_metrics_group)
+
         # Add buttons
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         # noinspection PyUnresolvedReferences
@@ -37,30 +107,61 @@ class SettingsWidget(QDialog):
         """
         Load settings from file
         """
-        print('SettingsWidget.load_settings()')
+        logger.debug("SettingsWidget.load_settings()")
         # Create settings file if it does not exist
         if not os.path.isfile(self.settings_file):
             with open(self.settings_file, 'w') as file:
-                print(f'Created settings file: {self.settings_file} with default settings')
+                logger.info("Created settings file: %s with default settings", self.settings_file)
                 json.dump(DEFAULT_SETTINGS, file)
 
         # Load settings from file
         with open(self.settings_file, 'r') as file:
             settings = json.load(file)
-            print(f'Loaded settings: {settings} from {self.settings_file}')
+            logger.debug("Loaded settings: %s from %s", settings, self.settings_file)
             self.rewrite_database_checkbox.setChecked(settings["rewrite_database"])
+            system_metrics = settings.get("system_metrics", DEFAULT_SETTINGS["system_metrics"])
+            self.system_metrics_checkbox.setChecked(system_metrics)
+            process_metrics = settings.get("process_metrics", DEFAULT_SETTINGS["process_metrics"])
+            for metric, checkbox in self.process_metric_checkboxes.items():
+                checkbox.setChecked(metric in process_metrics)
+            backend = settings.get("sampler_backend", DEFAULT_SETTINGS["sampler_backend"])
+            self.sampler_backend_combo.setCurrentText(backend)
+            storage = settings.get("storage_backend", DEFAULT_SETTINGS["storage_backend"])
+            self.storage_backend_combo.setCurrentText(storage)
+            self.process_tree_checkbox.setChecked(settings.get("process_tree", DEFAULT_SETTINGS["process_tree"]))
+            stats_log_interval = settings.get("stats_log_interval", DEFAULT_SETTINGS["stats_log_interval"])
+            self.stats_log_interval_spinbox.setValue(int(stats_log_interval))
+            self.sampling_interval_spinbox.setValue(
+                settings.get("sampling_interval", DEFAULT_SETTINGS["sampling_interval"])
+            )
+            self.adaptive_interval_checkbox.setChecked(
+                settings.get("adaptive_interval", DEFAULT_SETTINGS["adaptive_interval"])
+            )
+            self.rules_enabled_checkbox.setChecked(settings.get("rules_enabled", DEFAULT_SETTINGS["rules_enabled"]))
 
     def write_settings(self):
         """
         Write settings to file
         """
-        print('SettingsWidget.write_settings()')
-        settings = {
-            "rewrite_database": self.rewrite_database_checkbox.isChecked()
-        }
+        logger.debug("SettingsWidget.write_settings()")
+        # Keep settings which are not edited in this window
+        with open(self.settings_file, 'r') as file:
+            settings = json.load(file)
+        settings["rewrite_database"] = self.rewrite_database_checkbox.isChecked()
+        settings["system_metrics"] = self.system_metrics_checkbox.isChecked()
+        settings["process_metrics"] = [
+            metric for metric, checkbox in self.process_metric_checkboxes.items() if checkbox.isChecked()
+        ]
+        settings["sampler_backend"] = self.sampler_backend_combo.currentText()
+        settings["storage_backend"] = self.storage_backend_combo.currentText()
+        settings["process_tree"] = self.process_tree_checkbox.isChecked()
+        settings["stats_log_interval"] = self.stats_log_interval_spinbox.value()
+        settings["sampling_interval"] = self.sampling_interval_spinbox.value()
+        settings["adaptive_interval"] = self.adaptive_interval_checkbox.isChecked()
+        settings["rules_enabled"] = self.rules_enabled_checkbox.isChecked()
 
         with open(self.settings_file, 'w') as file:
             json.dump(settings, file)
-            print(f'Saved settings: {settings} to {self.settings_file}')
+            logger.info("Saved settings: %s to %s", settings, self.settings_file)
 
         self.accept()
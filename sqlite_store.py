@@ -0,0 +1,837 @@
+import math
+import sqlite3
+import sys
+import time
+from array import array
+from contextlib import contextmanager
+
+from cpu_sampler import PROCESS_METRICS
+
+# Version of the schema, stored in PRAGMA user_version
+# 0 - single CpuWorkload table
+# 1 - CpuWorkload partitioned by day with covering indexes, rollup tables
+# 2 - SystemMetrics table
+# 3 - ProcessMetrics table
+# 4 - FamilyWorkload table
+# 5 - Histogram column of the rollup tables
+# 6 - Host column of CpuWorkload, the rollups, ProcessMetrics and FamilyWorkload, Hosts table, see aggregator
+# 7 - Timestamp index of the CpuWorkload partitions
+# 8 - TimeHistogram column of the rollup tables
+# 9 - WriteLog table, see db_backup
+SCHEMA_VERSION = 9
+
+# Default database file, created in the working directory
+DATABASE_NAME = "CpuMetrics"
+# Host of the samples collected locally, samples received by the aggregator have the name of the agent host
+LOCAL_HOST = ""
+
+# Histograms of the rollup buckets: CPU usage in bins of 0.5%, the last bin holds 100% and above
+HISTOGRAM_BIN_WIDTH = 0.5
+HISTOGRAM_BINS = 201
+# Histogram BLOB: first non-empty bin uint8, then the counts up to the last non-empty bin, uint32 little-endian
+# TimeHistogram BLOB: the same bins with the seconds the samples stand for, float32 little-endian
+# A sample stands for the time since the previous sample of its process, its CPU usage is measured over it,
+# so the time above a threshold does not depend on the sampling interval, see SQLiteStore.sample_durations()
+# A longer gap, e.g. while the monitoring was stopped, counts as no time; the longest adaptive interval is 300 s
+MAX_SAMPLE_SECONDS = 600
+
+
+def overlapping_partitions(connection, start=None, end=None):
+    """
+    :param connection: sqlite3 connection
+    :param start: range start timestamp, None for unbounded
+    :param end: range end timestamp, None for unbounded
+    :return: names of the CpuWorkload partitions overlapping the time range, oldest first
+    """
+    return [name for name, in connection.execute(
+        "SELECT Name FROM CpuWorkloadPartitions WHERE (:start IS NULL OR End > :start) "
+        "AND (:end IS NULL OR Start < :end) ORDER BY Start", {'start': start, 'end': end}
+    )]
+
+
+def pack_floats(values):
+    """
+    :return: values as a BLOB of little-endian float32
+    """
+    packed = array('f', values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_floats(blob):
+    """
+    :return: list of floats packed by pack_floats()
+    """
+    unpacked = array('f')
+    unpacked.frombytes(blob)
+    if sys.byteorder != 'little':
+        unpacked.byteswap()
+    return unpacked.tolist()
+
+
+def histogram_bin(usage):
+    """
+    :return: histogram bin of a CPU usage in percent
+    """
+    return min(max(int(usage / HISTOGRAM_BIN_WIDTH), 0), HISTOGRAM_BINS - 1)
+
+
+def pack_histogram(counts, first, last, typecode='I'):
+    """
+    :param counts: array of the counts of all bins, or of their seconds
+    :param first: first non-empty bin
+    :param last: last non-empty bin
+    :param typecode: array typecode of the BLOB, 'I' for the counts, 'f' for the seconds
+    :return: BLOB of the histogram
+    """
+    packed = array(typecode, counts[first:last + 1])
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return bytes((first,)) + packed.tobytes()
+
+
+def unpack_histogram(blob, typecode='I'):
+    """
+    :return: array of the counts, or the seconds, of all bins packed by pack_histogram()
+    """
+    counts = array(typecode, bytes(4 * blob[0]) + blob[1:])
+    if sys.byteorder != 'little':
+        counts.byteswap()
+    counts.extend([0] * (HISTOGRAM_BINS - len(counts)))
+    return counts
+
+
+class RollupAccumulator:
+    """
+    Incrementally maintained rollup of CPU usage per process and time bucket: min/avg/max/p95 and a histogram
+    The buckets touched recently are kept in memory as count, sum, min, max, histogram counts and the seconds
+    of each bin, whatever the number of samples in them, so each flush only rewrites the touched buckets
+    p95 is read from the histogram like the percentiles of analytics, exact to a bin
+    Histograms of several buckets can be merged, see analytics
+    A bucket evicted from memory and touched again by a late sample is reloaded from its rollup row
+    """
+
+    def __init__(self, table, bucket_seconds, retention, read_workloads):
+        """
+        :param table: rollup table name
+        :param bucket_seconds: bucket width in seconds
+        :param retention: seconds the rollup rows are kept
+        :param read_workloads: function(connection, host, pid, start, end) returning the raw samples of a process,
+                               to reload the rollup rows written without histograms, see SQLiteStore.read_workloads()
+        """
+        self.table = table
+        self.bucket_seconds = bucket_seconds
+        self.retention = retention
+        self.read_workloads = read_workloads
+        # {(bucket, host, pid): [name, count, sum, min, max, array('I') of histogram counts, array('d') of seconds]}
+        self.buckets = {}
+
+    def bucket_of(self, timestamp):
+        return int(timestamp // self.bucket_seconds) * self.bucket_seconds
+
+    def add(self, connection, records, durations):
+        """
+        Add samples to their buckets, must be called before the samples are inserted into the raw table, see load()
+        :param connection: sqlite3 connection
+        :param records: list of dicts with keys 'timestamp', 'pid', 'name', 'usage', and optionally 'host'
+        :param durations: seconds every record stands for, see SQLiteStore.sample_durations()
+        :return: set of touched (bucket, host, pid) keys
+        """
+        # Samples are grouped per bucket first, so a large batch updates every bucket once
+        grouped = {}
+        bucket_seconds = self.bucket_seconds
+        for record, duration in zip(records, durations):
+            key = (int(record['timestamp'] // bucket_seconds) * bucket_seconds, record.get('host', LOCAL_HOST),
+                   record['pid'])
+            group = grouped.get(key)
+            if group is None:
+                group = grouped[key] = [record['name'], [], []]
+            group[1].append(record['usage'])
+            group[2].append(duration)
+        for key, (name, workloads, seconds) in grouped.items():
+            entry = self.buckets.get(key)
+            if entry is None:
+                entry = self.load(connection, *key)
+                if entry is None:
+                    entry = [name, 0, 0.0, math.inf, -math.inf, array('I', bytes(4 * HISTOGRAM_BINS)),
+                             array('d', bytes(8 * HISTOGRAM_BINS))]
+                self.buckets[key] = entry
+            entry[1] += len(workloads)
+            entry[2] += sum(workloads)
+            entry[3] = min(entry[3], min(workloads))
+            entry[4] = max(entry[4], max(workloads))
+            self.count_bins(entry[5], entry[6], workloads, seconds)
+        touched = set(grouped)
+        return touched
+
+    @staticmethod
+    def count_bins(counts, seconds, workloads, durations):
+        # histogram_bin() inlined, it runs for every sample
+        last, width = HISTOGRAM_BINS - 1, HISTOGRAM_BIN_WIDTH
+        for workload, duration in zip(workloads, durations):
+            number = min(max(int(workload / width), 0), last)
+            counts[number] += 1
+            seconds[number] += duration
+
+    def load(self, connection, bucket, host, pid):
+        """
+        Load a bucket which was already rolled up before from its rollup row
+        Rows written before the histograms were added are rebuilt from the raw samples still kept,
+        the samples of rows written before the seconds were added are spread over the bucket
+        :return: entry of the bucket, None for a new bucket
+        """
+        row = connection.execute(
+            f"SELECT ProcessName, Samples, AvgWorkload, MinWorkload, MaxWorkload, Histogram, TimeHistogram "
+            f"FROM {self.table} WHERE Bucket = ? AND Host = ? AND PID = ?", (bucket, host, pid)
+        ).fetchone()
+        if row is None:
+            return None
+        name, count, average, minimum, maximum, histogram, time_histogram = row
+        if histogram is not None:
+            counts = unpack_histogram(histogram)
+            if time_histogram is not None:
+                seconds = array('d', unpack_histogram(time_histogram, 'f'))
+            else:
+                seconds = array('d', (number * self.bucket_seconds / count for number in counts))
+            return [name, count, average * count, minimum, maximum, counts, seconds]
+        workloads = list(self.read_workloads(connection, host, pid, bucket, bucket + self.bucket_seconds))
+        if not workloads:
+            return None
+        counts, seconds = array('I', bytes(4 * HISTOGRAM_BINS)), array('d', bytes(8 * HISTOGRAM_BINS))
+        self.count_bins(counts, seconds, workloads, [self.bucket_seconds / len(workloads)] * len(workloads))
+        return [name, len(workloads), sum(workloads), min(workloads), max(workloads), counts, seconds]
+
+    @staticmethod
+    def p95(count, minimum, maximum, counts):
+        """
+        :return: 95th percentile by nearest rank, the middle of its histogram bin within the min and the max
+        """
+        # Counted down from the max, only the bins of the top 5% of the samples are visited
+        above = count - max(math.ceil(0.95 * count), 1)
+        number = histogram_bin(maximum)
+        seen = counts[number]
+        while seen <= above:
+            number -= 1
+            seen += counts[number]
+        return min(max((number + 0.5) * HISTOGRAM_BIN_WIDTH, minimum), maximum)
+
+    def upsert(self, connection, keys):
+        """
+        Write the rollup rows of the given buckets
+        :param connection: sqlite3 connection
+        :param keys: (bucket, host, pid) keys to write
+        """
+        rows = []
+        for key in keys:
+            name, count, total, minimum, maximum, counts, seconds = self.buckets[key]
+            first, last = histogram_bin(minimum), histogram_bin(maximum)
+            rows.append((*key, name, count, minimum, total / count, maximum, self.p95(count, minimum, maximum, counts),
+                         pack_histogram(counts, first, last), pack_histogram(seconds, first, last, 'f')))
+        connection.executemany(
+            f"INSERT OR REPLACE INTO {self.table} (Bucket, Host, PID, ProcessName, Samples, "
+            f"MinWorkload, AvgWorkload, MaxWorkload, P95Workload, Histogram, TimeHistogram) "
+            f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+
+    def evict(self, latest):
+        """
+        Forget samples of the buckets closed before the latest timestamp
+        :param latest: newest timestamp written
+        """
+        closed = [key for key in self.buckets if key[0] + self.bucket_seconds <= latest]
+        for key in closed:
+            del self.buckets[key]
+
+    def clear(self):
+        self.buckets = {}
+
+
+class SQLiteStore:
+    """
+    Qt-independent access to the metrics database
+    Used from worker threads and headless tools, where QSqlDatabase connections are not available
+    The database is switched to WAL journaling, so the GUI can read while samples are written
+
+    Raw samples are stored in daily partitions CpuWorkload_YYYYMMDD (UTC),
+    each with covering indexes on (ProcessName, Timestamp) and (PID, Timestamp) and an index on Timestamp
+    The view CpuWorkload unites all partitions, the catalog CpuWorkloadPartitions lists them
+    Expired partitions are dropped as a whole, so the retention does not depend on the number of rows
+    Rollup tables with 1 minute and 1 hour buckets are maintained as samples are written,
+    each bucket has a histogram of the samples and of the seconds they stand for,
+    so statistics of any window can be merged from the buckets
+    Every sample has the host it was collected on, LOCAL_HOST unless it was received by the aggregator,
+    the PIDs of a bucket or a tick are unique per host only
+    """
+
+    PARTITION_SECONDS = 86400
+    # IDs are unique across partitions: each partition starts at its start time multiplied by this
+    PARTITION_ID_STRIDE = 100000
+    DEFAULT_RETENTION = 7 * 86400
+    # (table, bucket width, retention) in seconds
+    ROLLUPS = (
+        ("CpuWorkloadRollup1m", 60, 30 * 86400),
+        ("CpuWorkloadRollup1h", 3600, 400 * 86400),
+    )
+
+    CREATE_SYSTEM_EVENTS = "CREATE TABLE IF NOT EXISTS SystemEvents " \
+                           "(ID INTEGER PRIMARY KEY AUTOINCREMENT, Timestamp INTEGER, Event TEXT)"
+    # One row per tick, usage of all cores is packed into one array of little-endian float32
+    CREATE_SYSTEM_METRICS = "CREATE TABLE IF NOT EXISTS SystemMetrics " \
+                            "(Timestamp REAL PRIMARY KEY, CoreUsage BLOB, MaxCoreUsage REAL, LoadAverage REAL, " \
+                            "MemoryUsage REAL, MemoryAvailable INTEGER, SwapUsage REAL, SwapIn REAL, SwapOut REAL, " \
+                            "DiskRead REAL, DiskWrite REAL, NetSent REAL, NetReceived REAL, ContextSwitches REAL) " \
+                            "WITHOUT ROWID"
+    # Other per-process metrics, one row per process and tick, NULL for the metrics not sampled
+    CREATE_PROCESS_METRICS = "CREATE TABLE IF NOT EXISTS ProcessMetrics " \
+                             "(Timestamp REAL, PID INTEGER, ProcessName TEXT, Rss INTEGER, Threads INTEGER, " \
+                             "Fds INTEGER, ReadBytes REAL, WriteBytes REAL, ContextSwitches REAL, " \
+                             "Host TEXT NOT NULL DEFAULT '', PRIMARY KEY (Timestamp, Host, PID)) WITHOUT ROWID"
+    CREATE_PROCESS_METRICS_INDEXES = (
+        "CREATE INDEX IF NOT EXISTS ProcessMetrics_ProcessName ON ProcessMetrics (ProcessName, Timestamp)",
+        "CREATE INDEX IF NOT EXISTS ProcessMetrics_PID ON ProcessMetrics (PID, Timestamp)",
+    )
+    # CPU usage summed over the family of a watched process in tree mode, one row per family and tick
+    CREATE_FAMILY_WORKLOAD = "CREATE TABLE IF NOT EXISTS FamilyWorkload " \
+                             "(Timestamp REAL, RootPID INTEGER, ProcessName TEXT, Workload REAL, Members INTEGER, " \
+                             "Host TEXT NOT NULL DEFAULT '', PRIMARY KEY (Timestamp, Host, RootPID)) WITHOUT ROWID"
+    CREATE_FAMILY_WORKLOAD_INDEX = "CREATE INDEX IF NOT EXISTS FamilyWorkload_ProcessName " \
+                                   "ON FamilyWorkload (ProcessName, Timestamp)"
+    # One row per write transaction with the oldest timestamp it wrote: samples may commit long after their timestamp,
+    # incremental backups archive the rows written by the revisions after the last backup, see db_backup
+    # AUTOINCREMENT keeps the revisions increasing when the rows are pruned by the retention
+    CREATE_WRITE_LOG = "CREATE TABLE IF NOT EXISTS WriteLog " \
+                       "(Revision INTEGER PRIMARY KEY AUTOINCREMENT, Oldest REAL, Time REAL)"
+    # Hosts the aggregator received samples from, with the timestamp of their newest tick written
+    CREATE_HOSTS = "CREATE TABLE IF NOT EXISTS Hosts (Host TEXT PRIMARY KEY, LastTimestamp REAL)"
+    CREATE_PARTITION_CATALOG = "CREATE TABLE IF NOT EXISTS CpuWorkloadPartitions " \
+                               "(Name TEXT PRIMARY KEY, Start REAL, End REAL)"
+    CREATE_PARTITION = "CREATE TABLE IF NOT EXISTS {name} " \
+                       "(ID INTEGER PRIMARY KEY, Timestamp INTEGER, PID INTEGER, ProcessName TEXT, Workload REAL, " \
+                       "Host TEXT NOT NULL DEFAULT '')"
+    CREATE_PARTITION_INDEXES = (
+        "CREATE INDEX IF NOT EXISTS {name}_ProcessName ON {name} (ProcessName, Timestamp, Workload)",
+        "CREATE INDEX IF NOT EXISTS {name}_PID ON {name} (PID, Timestamp, Workload)",
+        # Pages of the Database tab sorted by time, ID is the rowid: the index is ordered by (Timestamp, ID)
+        "CREATE INDEX IF NOT EXISTS {name}_Timestamp ON {name} (Timestamp)",
+    )
+    CREATE_ROLLUP = "CREATE TABLE IF NOT EXISTS {name} " \
+                    "(Bucket INTEGER, PID INTEGER, ProcessName TEXT, Samples INTEGER, " \
+                    "MinWorkload REAL, AvgWorkload REAL, MaxWorkload REAL, P95Workload REAL, Histogram BLOB, " \
+                    "Host TEXT NOT NULL DEFAULT '', TimeHistogram BLOB, PRIMARY KEY (Bucket, Host, PID)) WITHOUT ROWID"
+    CREATE_ROLLUP_INDEX = "CREATE INDEX IF NOT EXISTS {name}_ProcessName ON {name} (ProcessName, Bucket)"
+    INSERT_CPU_WORKLOAD = "INSERT INTO {name} (ID, Timestamp, PID, ProcessName, Workload, Host) " \
+                          "VALUES (?, ?, ?, ?, ?, ?)"
+    COLUMNS = "ID, Timestamp, PID, ProcessName, Workload, Host"
+    INSERT_SYSTEM_METRICS = "INSERT OR REPLACE INTO SystemMetrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    INSERT_PROCESS_METRICS = "INSERT OR REPLACE INTO ProcessMetrics (Timestamp, PID, ProcessName, Host, " + \
+                             ", ".join(column for _, column, _, _ in PROCESS_METRICS.values()) + \
+                             ") VALUES (?, ?, ?, ?" + ", ?" * len(PROCESS_METRICS) + ")"
+    INSERT_FAMILY_WORKLOAD = "INSERT OR REPLACE INTO FamilyWorkload " \
+                             "(Timestamp, RootPID, ProcessName, Workload, Members, Host) VALUES (?, ?, ?, ?, ?, ?)"
+    INSERT_SYSTEM_EVENT = "INSERT INTO SystemEvents (Timestamp, Event) VALUES (?, ?)"
+    INSERT_WRITE_LOG = "INSERT INTO WriteLog (Oldest, Time) VALUES (?, ?)"
+    SYSTEM_METRICS_COLUMNS = "Timestamp, CoreUsage, MaxCoreUsage, LoadAverage, MemoryUsage, MemoryAvailable, " \
+                             "SwapUsage, SwapIn, SwapOut, DiskRead, DiskWrite, NetSent, NetReceived, ContextSwitches"
+
+    def __init__(self, database_name, retention=DEFAULT_RETENTION):
+        """
+        :param database_name: path to the SQLite database file
+        :param retention: seconds the raw samples are kept
+        """
+        self.database_name = database_name
+        self.retention = retention
+        self.connection = None
+        self.partitions = {}  # {name: start timestamp}
+        self.rollups = [RollupAccumulator(*rollup, self.read_workloads) for rollup in self.ROLLUPS]
+        self.last_sampled = {}  # {(host, pid): timestamp of its newest sample}, see sample_durations()
+        # State changed by the open transaction, restored if it is rolled back, see discard_uncommitted()
+        self.uncommitted_buckets = []  # [(RollupAccumulator, touched keys)]
+        # [(last_sampled dict changed, (host, pid), timestamp of its newest sample before, None if unknown)]
+        self.uncommitted_sampled = []
+
+    def open(self):
+        """
+        Open the database, creating or migrating the schema if needed
+        """
+        # Transactions are controlled explicitly, see transaction()
+        self.connection = sqlite3.connect(self.database_name, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL is still safe against corruption and avoids fsync on every commit
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.transaction():
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+            legacy = version < 1 and self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'CpuWorkload'"
+            ).fetchone()
+            if legacy:
+                self.connection.execute("ALTER TABLE CpuWorkload RENAME TO CpuWorkload_v0")
+            self.create_schema()
+            if legacy:
+                self.migrate_v0()
+            else:
+                if 0 < version < 5:
+                    self.migrate_v4()
+                if 0 < version < 6:
+                    self.migrate_v5()
+                if 0 < version < 7:
+                    self.migrate_v6()
+                if 0 < version < 8:
+                    self.migrate_v7()
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.apply_retention(time.time())
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction, the write lock is taken at the beginning,
+        so several processes writing to the same database wait for each other instead of failing
+        The rollup buckets and the sample times changed by a transaction rolled back are restored
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            self.connection.execute("COMMIT")
+        except BaseException:
+            # A failed COMMIT may have rolled back already
+            if self.connection.in_transaction:
+                self.connection.execute("ROLLBACK")
+            self.discard_uncommitted()
+            raise
+        self.uncommitted_buckets = []
+        self.uncommitted_sampled = []
+
+    def discard_uncommitted(self):
+        """
+        Forget the rollup buckets touched by the transaction rolled back, they are reloaded from their committed rows,
+        and restore the times of the newest samples
+        """
+        for rollup, keys in self.uncommitted_buckets:
+            for key in keys:
+                rollup.buckets.pop(key, None)
+        # In reverse, the timestamp before the transaction is restored last
+        for last_sampled, key, timestamp in reversed(self.uncommitted_sampled):
+            if timestamp is None:
+                last_sampled.pop(key, None)
+            else:
+                last_sampled[key] = timestamp
+        self.uncommitted_buckets = []
+        self.uncommitted_sampled = []
+
+    def create_schema(self):
+        self.connection.execute(self.CREATE_SYSTEM_EVENTS)
+        self.connection.execute(self.CREATE_SYSTEM_METRICS)
+        self.connection.execute(self.CREATE_PROCESS_METRICS)
+        for create_index in self.CREATE_PROCESS_METRICS_INDEXES:
+            self.connection.execute(create_index)
+        self.connection.execute(self.CREATE_FAMILY_WORKLOAD)
+        self.connection.execute(self.CREATE_FAMILY_WORKLOAD_INDEX)
+        self.connection.execute(self.CREATE_HOSTS)
+        self.connection.execute(self.CREATE_WRITE_LOG)
+        self.connection.execute(self.CREATE_PARTITION_CATALOG)
+        for rollup in self.rollups:
+            self.connection.execute(self.CREATE_ROLLUP.format(name=rollup.table))
+            self.connection.execute(self.CREATE_ROLLUP_INDEX.format(name=rollup.table))
+        self.load_partitions()
+        self.rebuild_view()
+
+    def load_partitions(self):
+        """
+        Read the partition catalog, other processes may create or drop partitions
+        """
+        self.partitions = dict(self.connection.execute("SELECT Name, Start FROM CpuWorkloadPartitions"))
+
+    def migrate_v0(self):
+        """
+        Move the rows of the unpartitioned table into partitions and build the rollups
+        """
+        cursor = self.connection.execute(
+            "SELECT Timestamp, PID, ProcessName, Workload FROM CpuWorkload_v0 ORDER BY Timestamp"
+        )
+        while True:
+            rows = cursor.fetchmany(50000)
+            if not rows:
+                break
+            self.insert([
+                {'timestamp': timestamp, 'pid': pid, 'name': name, 'usage': usage}
+                for timestamp, pid, name, usage in rows
+            ])
+        self.connection.execute("DROP TABLE CpuWorkload_v0")
+
+    def migrate_v4(self):
+        """
+        Add the histograms to the rollup rows, computed from the raw samples still kept
+        Older rollup rows keep no histogram, they count in the samples, mean and max of analytics only
+        """
+        for rollup in self.rollups:
+            self.connection.execute(f"ALTER TABLE {rollup.table} ADD COLUMN Histogram BLOB")
+            width = rollup.bucket_seconds
+            for name in self.partitions:
+                histograms = {}
+                for bucket, pid, number, count in self.connection.execute(
+                    f"SELECT CAST(Timestamp / {width} AS INTEGER) * {width}, PID, "
+                    f"MAX(0, MIN(CAST(Workload / {HISTOGRAM_BIN_WIDTH} AS INTEGER), {HISTOGRAM_BINS - 1})), "
+                    f"COUNT(*) FROM {name} GROUP BY 1, 2, 3"
+                ):
+                    histograms.setdefault((bucket, pid), {})[number] = count
+                self.connection.executemany(
+                    f"UPDATE {rollup.table} SET Histogram = ? WHERE Bucket = ? AND PID = ?",
+                    ((pack_histogram(array('I', [counts.get(number, 0) for number in range(HISTOGRAM_BINS)]),
+                                     min(counts), max(counts)), bucket, pid)
+                     for (bucket, pid), counts in histograms.items())
+                )
+
+    def migrate_v5(self):
+        """
+        Add the Host column, the rows of the older versions were collected locally
+        The tables keyed by PID are copied into new tables with the host in their key, the partitions are altered
+        """
+        for name in self.partitions:
+            self.connection.execute(f"ALTER TABLE {name} ADD COLUMN Host TEXT NOT NULL DEFAULT ''")
+        self.rebuild_view()
+        tables = [(rollup.table, self.CREATE_ROLLUP.format(name=rollup.table),
+                   [self.CREATE_ROLLUP_INDEX.format(name=rollup.table)]) for rollup in self.rollups]
+        tables.append(("ProcessMetrics", self.CREATE_PROCESS_METRICS, self.CREATE_PROCESS_METRICS_INDEXES))
+        tables.append(("FamilyWorkload", self.CREATE_FAMILY_WORKLOAD, [self.CREATE_FAMILY_WORKLOAD_INDEX]))
+        for table, create, create_indexes in tables:
+            columns = ", ".join(column for _, column, *_ in self.connection.execute(f"PRAGMA table_info({table})"))
+            self.connection.execute(f"ALTER TABLE {table} RENAME TO {table}_v5")
+            # Indexes follow the renamed table, they are dropped with it
+            self.connection.execute(create)
+            self.connection.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_v5")
+            self.connection.execute(f"DROP TABLE {table}_v5")
+            for create_index in create_indexes:
+                self.connection.execute(create_index)
+
+    def migrate_v6(self):
+        """
+        Add the Timestamp index to the partitions
+        """
+        for name in self.partitions:
+            for statement in self.CREATE_PARTITION_INDEXES:
+                self.connection.execute(statement.format(name=name))
+
+    def migrate_v7(self):
+        """
+        Add the TimeHistogram column to the rollup tables, the tables created by migrate_v5() already have it
+        Older rollup rows keep none, analytics spreads their samples over the bucket
+        """
+        for rollup in self.rollups:
+            columns = [column for _, column, *_ in self.connection.execute(f"PRAGMA table_info({rollup.table})")]
+            if "TimeHistogram" not in columns:
+                self.connection.execute(f"ALTER TABLE {rollup.table} ADD COLUMN TimeHistogram BLOB")
+
+    def write_batch(self, records, system_samples=(), events=(), hosts=None, last_sampled=None):
+        """
+        Insert CPU usage records, system samples and events, and update the rollups in one transaction
+        Prepared statements are cached by sqlite3, rows are inserted with executemany per partition
+        :param records: list of dicts with keys 'timestamp', 'pid', 'name', 'usage', optionally 'host',
+                        LOCAL_HOST by default, and 'metrics', {metric: value} written to ProcessMetrics;
+                        family totals of the tree mode have the key 'members' and are written to FamilyWorkload
+        :param system_samples: list of dicts returned by SystemSampler.sample()
+        :param events: list of (timestamp, event text)
+        :param hosts: {host: timestamp of its newest tick} of the records received from other hosts, see query_hosts()
+        :param last_sampled: {(host, pid): timestamp of its newest sample} the durations of the records follow,
+                             the samples collected by default, see sample_durations()
+        """
+        if not records and not system_samples and not events and not hosts:
+            return
+        with self.transaction():
+            self.load_partitions()
+            if records:
+                self.insert(records, last_sampled)
+            if system_samples:
+                self.insert_system_samples(system_samples)
+            if records or system_samples:
+                oldest = min(sample['timestamp'] for samples in (records, system_samples) for sample in samples)
+                self.connection.execute(self.INSERT_WRITE_LOG, (oldest, time.time()))
+            if events:
+                self.connection.executemany(self.INSERT_SYSTEM_EVENT, events)
+            if hosts:
+                self.connection.executemany(
+                    "INSERT INTO Hosts (Host, LastTimestamp) VALUES (?, ?) ON CONFLICT (Host) "
+                    "DO UPDATE SET LastTimestamp = max(LastTimestamp, excluded.LastTimestamp)", hosts.items()
+                )
+
+    def insert(self, records, last_sampled=None):
+        families = [record for record in records if 'members' in record]
+        if families:
+            self.connection.executemany(self.INSERT_FAMILY_WORKLOAD, (
+                (record['timestamp'], record['pid'], record['name'], record['usage'], record['members'],
+                 record.get('host', LOCAL_HOST))
+                for record in families
+            ))
+            records = [record for record in records if 'members' not in record]
+            if not records:
+                return
+        latest = max(record['timestamp'] for record in records)
+        durations = self.sample_durations(records, latest, last_sampled)
+        touched = [(rollup, rollup.add(self.connection, records, durations)) for rollup in self.rollups]
+        self.uncommitted_buckets.extend(touched)
+
+        created = self.insert_samples(records)
+
+        metric_rows = [
+            (record['timestamp'], record['pid'], record['name'], record.get('host', LOCAL_HOST),
+             *(record['metrics'].get(metric) for metric in PROCESS_METRICS))
+            for record in records if 'metrics' in record
+        ]
+        if metric_rows:
+            self.connection.executemany(self.INSERT_PROCESS_METRICS, metric_rows)
+
+        for rollup, keys in touched:
+            rollup.upsert(self.connection, keys)
+            rollup.evict(latest)
+        if created:
+            self.apply_retention(latest)
+
+    def insert_samples(self, records):
+        """
+        Write the raw CPU usage samples into the daily partitions
+        :param records: CPU usage records, without the family totals
+        :return: True if a partition was created, the retention is applied then
+        """
+        by_partition = {}
+        for record in records:
+            by_partition.setdefault(self.partition_start(record['timestamp']), []).append(record)
+        created = False
+        for start, partition_records in by_partition.items():
+            name = self.partition_name(start)
+            created |= self.ensure_partition(name, start)
+            first_id = self.next_id(name, start)
+            self.connection.executemany(
+                self.INSERT_CPU_WORKLOAD.format(name=name),
+                ((first_id + i, record['timestamp'], record['pid'], record['name'], record['usage'],
+                  record.get('host', LOCAL_HOST))
+                 for i, record in enumerate(partition_records))
+            )
+        return created
+
+    def sample_durations(self, records, latest, last_sampled=None):
+        """
+        :param records: CPU usage records, without the family totals
+        :param latest: newest timestamp of the records
+        :param last_sampled: {(host, pid): timestamp of its newest sample}, updated with the records,
+                             self.last_sampled by default
+        :return: list of the seconds every record stands for: the time since the previous sample of its process,
+                 0 for the first one and after a gap longer than MAX_SAMPLE_SECONDS
+        """
+        if last_sampled is None:
+            last_sampled = self.last_sampled
+        uncommitted = self.uncommitted_sampled
+        durations = []
+        for record in records:
+            key = (record.get('host', LOCAL_HOST), record['pid'])
+            timestamp = record['timestamp']
+            previous = last_sampled.get(key)
+            if previous is None or timestamp > previous:
+                uncommitted.append((last_sampled, key, previous))
+                last_sampled[key] = timestamp
+            gap = timestamp - previous if previous is not None else 0.0
+            durations.append(gap if 0.0 < gap <= MAX_SAMPLE_SECONDS else 0.0)
+        # Processes not sampled for longer start over
+        for key in [key for key, timestamp in last_sampled.items() if timestamp < latest - MAX_SAMPLE_SECONDS]:
+            uncommitted.append((last_sampled, key, last_sampled.pop(key)))
+        return durations
+
+    @staticmethod
+    def read_workloads(connection, host, pid, start, end):
+        """
+        Read the raw CPU usage samples of a process, to reload a rollup bucket
+        :return: iterable of workloads in the time range
+        """
+        rows = connection.execute(
+            "SELECT Workload FROM CpuWorkload WHERE PID = ? AND Timestamp >= ? AND Timestamp < ? AND Host = ?",
+            (pid, start, end, host)
+        )
+        return (workload for workload, in rows)
+
+    def insert_system_samples(self, samples):
+        self.connection.executemany(self.INSERT_SYSTEM_METRICS, (
+            (sample['timestamp'], pack_floats(sample['cores']), max(sample['cores'], default=0.0),
+             sample['load_average'], sample['memory'], sample['memory_available'], sample['swap'],
+             sample['swap_in'], sample['swap_out'], sample['disk_read'], sample['disk_write'],
+             sample['net_sent'], sample['net_received'], sample['context_switches'])
+            for sample in samples
+        ))
+
+    def partition_start(self, timestamp):
+        return int(timestamp // self.PARTITION_SECONDS) * self.PARTITION_SECONDS
+
+    @staticmethod
+    def partition_name(start):
+        """
+        :param start: partition start timestamp
+        :return: name of the partition table
+        """
+        return "CpuWorkload_" + time.strftime('%Y%m%d', time.gmtime(start))
+
+    def next_id(self, name, start):
+        """
+        Next free ID of the partition, read in the write transaction (max of the rowid is a single lookup)
+        """
+        last_id = self.connection.execute(f"SELECT max(ID) FROM {name}").fetchone()[0]
+        return last_id + 1 if last_id is not None else int(start) * self.PARTITION_ID_STRIDE
+
+    def ensure_partition(self, name, start):
+        """
+        Create the partition with its indexes if it does not exist
+        :param name: partition name
+        :param start: partition start timestamp
+        :return: True if the partition was created
+        """
+        if name in self.partitions:
+            return False
+        self.connection.execute(self.CREATE_PARTITION.format(name=name))
+        for statement in self.CREATE_PARTITION_INDEXES:
+            self.connection.execute(statement.format(name=name))
+        self.connection.execute(
+            "INSERT OR IGNORE INTO CpuWorkloadPartitions (Name, Start, End) VALUES (?, ?, ?)",
+            (name, start, start + self.PARTITION_SECONDS)
+        )
+        self.partitions[name] = start
+        self.rebuild_view()
+        return True
+
+    def rebuild_view(self):
+        """
+        Recreate the CpuWorkload view over all partitions
+        """
+        selects = [f"SELECT {self.COLUMNS} FROM {name}" for name in sorted(self.partitions)]
+        body = " UNION ALL ".join(selects) or \
+            "SELECT NULL AS ID, NULL AS Timestamp, NULL AS PID, NULL AS ProcessName, NULL AS Workload, " \
+            "NULL AS Host WHERE 0"
+        self.connection.execute("DROP VIEW IF EXISTS CpuWorkload")
+        self.connection.execute(f"CREATE VIEW CpuWorkload AS {body}")
+
+    def apply_retention(self, now):
+        """
+        Drop raw partitions and rollup rows older than their retention
+        :param now: current timestamp
+        """
+        expired = [
+            name for name, start in self.partitions.items()
+            if start + self.PARTITION_SECONDS <= now - self.retention
+        ]
+        for name in expired:
+            self.drop_partition(name)
+        if expired:
+            self.rebuild_view()
+        for rollup in self.rollups:
+            self.connection.execute(f"DELETE FROM {rollup.table} WHERE Bucket < ?", (now - rollup.retention,))
+        self.connection.execute("DELETE FROM SystemMetrics WHERE Timestamp < ?", (now - self.retention,))
+        self.connection.execute("DELETE FROM ProcessMetrics WHERE Timestamp < ?", (now - self.retention,))
+        self.connection.execute("DELETE FROM FamilyWorkload WHERE Timestamp < ?", (now - self.retention,))
+        self.connection.execute("DELETE FROM WriteLog WHERE Time < ?", (time.time() - self.retention,))
+
+    def drop_partition(self, name):
+        self.connection.execute(f"DROP TABLE IF EXISTS {name}")
+        self.connection.execute("DELETE FROM CpuWorkloadPartitions WHERE Name = ?", (name,))
+        del self.partitions[name]
+
+    def cleanup(self):
+        """
+        Delete all data from the database
+        """
+        with self.transaction():
+            self.load_partitions()
+            for name in list(self.partitions):
+                self.drop_partition(name)
+            self.rebuild_view()
+            for rollup in self.rollups:
+                self.connection.execute(f"DELETE FROM {rollup.table}")
+                rollup.clear()
+            self.last_sampled = {}
+            self.uncommitted_buckets = []
+            self.uncommitted_sampled = []
+            self.connection.execute("DELETE FROM SystemEvents")
+            self.connection.execute("DELETE FROM SystemMetrics")
+            self.connection.execute("DELETE FROM ProcessMetrics")
+            self.connection.execute("DELETE FROM FamilyWorkload")
+
+    def query_history(self, process_name, start, end):
+        """
+        Read the history of a process at a resolution matching the time range:
+        raw samples up to 2 hours, 1 minute rollups up to 2 days, 1 hour rollups beyond
+        Only partitions overlapping the range are read
+        :param process_name: process name
+        :param start: range start timestamp
+        :param end: range end timestamp
+        :return: list of (timestamp, pid, min, avg, max, p95) ordered by timestamp
+        """
+        span = end - start
+        if span <= 2 * 3600:
+            names = overlapping_partitions(self.connection, start, end)
+            if not names:
+                return []
+            query = " UNION ALL ".join(
+                f"SELECT Timestamp, PID, Workload, Workload, Workload, Workload FROM {name} "
+                f"WHERE ProcessName = :name AND Timestamp >= :start AND Timestamp < :end"
+                for name in names
+            )
+        else:
+            table = self.ROLLUPS[0][0] if span <= 2 * 86400 else self.ROLLUPS[1][0]
+            query = f"SELECT Bucket, PID, MinWorkload, AvgWorkload, MaxWorkload, P95Workload FROM {table} " \
+                    f"WHERE ProcessName = :name AND Bucket >= :start AND Bucket < :end"
+        return self.connection.execute(
+            f"{query} ORDER BY 1", {'name': process_name, 'start': start, 'end': end}
+        ).fetchall()
+
+    def query_hosts(self):
+        """
+        :return: dict {host: timestamp of its newest tick written} of the hosts the aggregator received samples from
+        """
+        return dict(self.connection.execute("SELECT Host, LastTimestamp FROM Hosts"))
+
+    def query_process_metrics(self, process_name, start, end):
+        """
+        Read the other metrics of a process
+        :param process_name: process name
+        :param start: range start timestamp
+        :param end: range end timestamp
+        :return: list of dicts with the ProcessMetrics columns as keys, ordered by timestamp
+        """
+        cursor = self.connection.execute(
+            "SELECT * FROM ProcessMetrics WHERE ProcessName = ? AND Timestamp >= ? AND Timestamp < ? "
+            "ORDER BY Timestamp", (process_name, start, end)
+        )
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def query_family_history(self, process_name, start, end):
+        """
+        Read the CPU usage of the families rooted by processes with a name, collected in tree mode
+        :param process_name: name of the family root
+        :param start: range start timestamp
+        :param end: range end timestamp
+        :return: list of (timestamp, root pid, usage, members) ordered by timestamp
+        """
+        return self.connection.execute(
+            "SELECT Timestamp, RootPID, Workload, Members FROM FamilyWorkload "
+            "WHERE ProcessName = ? AND Timestamp >= ? AND Timestamp < ? ORDER BY Timestamp",
+            (process_name, start, end)
+        ).fetchall()
+
+    def query_system_metrics(self, start, end):
+        """
+        Read system samples of a time range, e.g. to correlate a process spike with the state of the system
+        :param start: range start timestamp
+        :param end: range end timestamp
+        :return: list of dicts with the SystemMetrics columns as keys, CoreUsage unpacked into a list of percents
+        """
+        cursor = self.connection.execute(
+            f"SELECT {self.SYSTEM_METRICS_COLUMNS} FROM SystemMetrics "
+            f"WHERE Timestamp >= ? AND Timestamp < ? ORDER BY Timestamp", (start, end)
+        )
+        columns = [column[0] for column in cursor.description]
+        rows = []
+        for row in cursor:
+            row = dict(zip(columns, row))
+            row['CoreUsage'] = unpack_floats(row['CoreUsage'])
+            rows.append(row)
+        return rows
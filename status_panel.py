@@ -0,0 +1,59 @@
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QLabel
+
+from instrumentation import stats, CPU_BUDGET, STAGES, SAMPLE, EMIT, DB_WRITE, RENDER, DROPPED_TICKS, QUEUE_DEPTH
+
+# Columns of the tooltip table after the count
+SUMMARY_KEYS = ('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+
+
+# noinspection PyUnresolvedReferences
+class StatusPanel(QLabel):
+    """
+    Status bar panel showing how much the monitor itself costs, see instrumentation
+    One line with the CPU usage and memory of the monitor, the 95th percentiles of the pipeline stages,
+    the depth of the database queue and the dropped ticks, the tooltip has the table of all stages
+    Every refresh summarizes the period since the previous one
+    """
+
+    def __init__(self, parent=None, refresh_interval=2.0):
+        """
+        :param parent: parent widget
+        :param refresh_interval: seconds between refreshes
+        """
+        super().__init__(parent)
+        self.dropped_ticks = 0  # Since start
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start(int(refresh_interval * 1000))
+        self.setText("Monitor: collecting statistics...")
+
+    def refresh(self):
+        report = stats.report('panel')
+        self.dropped_ticks += report['counters'][DROPPED_TICKS]
+        stages = report['stages']
+        self.setText(
+            f"Monitor CPU {report['cpu_percent']:.2f}% | RSS {report['rss'] / (1 << 20):.0f} MB | "
+            f"p95 sample {stages[SAMPLE]['p95_ms']:.1f} ms, emit {stages[EMIT]['p95_ms']:.1f} ms, "
+            f"db {stages[DB_WRITE]['p95_ms']:.1f} ms, render {stages[RENDER]['p95_ms']:.1f} ms | "
+            f"queue {report['gauges'].get(QUEUE_DEPTH, 0)} | dropped ticks {self.dropped_ticks}"
+        )
+        # Over the budget, the panel turns red
+        self.setStyleSheet("color: red" if report['cpu_budget_exceeded'] else "")
+        self.setToolTip(self.stage_table(report))
+
+    @staticmethod
+    def stage_table(report):
+        """
+        :param report: dict returned by Instrumentation.report()
+        :return: str, rich text table of the stages over the period of the report
+        """
+        header = "".join(f"<th>{title}</th>" for title in ("Stage", "Count", "Mean", "p50", "p95", "p99", "Max"))
+        rows = []
+        for stage in STAGES:
+            summary = report['stages'][stage]
+            cells = "".join(f"<td align='right'>{summary[key]:.2f}</td>" for key in SUMMARY_KEYS)
+            rows.append(f"<tr><td>{stage}</td><td align='right'>{summary['count']}</td>{cells}</tr>")
+        counters = ", ".join(f"{name} {value}" for name, value in report['counters'].items())
+        return (f"<p>Last {report['period']:.0f} s, durations in ms, CPU budget {CPU_BUDGET:.0f}%</p>"
+                f"<table><tr>{header}</tr>{''.join(rows)}</table><p>{counters}</p>")
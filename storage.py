@@ -0,0 +1,24 @@
+import importlib
+
+from sqlite_store import SQLiteStore
+
+# Backends of the metrics database, selected by the storage setting and the --storage option: name: (module, class)
+# Both have the interface of SQLiteStore used by the writers and the tasks: open(), close(), write_batch(),
+# cleanup(), the queries, and the SQLite connection holding everything but the raw samples of the columnar backend
+# The module is imported by make_store(), the columnar backend imports NumPy
+STORAGE_BACKENDS = {
+    'sqlite': ('sqlite_store', 'SQLiteStore'),
+    'columnar': ('columnar_store', 'ColumnarStore'),
+}
+DEFAULT_STORAGE = 'sqlite'
+
+
+def make_store(storage, database_name, retention=SQLiteStore.DEFAULT_RETENTION):
+    """
+    :param storage: name of the backend, see STORAGE_BACKENDS
+    :param database_name: path to the SQLite database file
+    :param retention: seconds the raw samples are kept
+    :return: store of the backend, not opened yet
+    """
+    module, name = STORAGE_BACKENDS[storage]
+    return getattr(importlib.import_module(module), name)(database_name, retention=retention)
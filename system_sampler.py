@@ -0,0 +1,150 @@
+import time
+from array import array
+
+import psutil
+
+
+class SystemSampler:
+    """
+    Samples system-wide resources, independent of Qt
+    Every tick takes one snapshot of the cumulative counters: per-core CPU times, swap, disk and network I/O,
+    context switches, and computes rates against the previous snapshot
+    Unlike the per-process usage, core usage is not averaged over the cores, so a single saturated core is visible
+    """
+
+    def __init__(self):
+        self.snapshot = None  # Counters of the previous tick
+        self.last_clock = None  # Monotonic time of the previous tick
+
+    def take_snapshot(self):
+        """
+        :return: dict of the cumulative counters and the swap usage
+        """
+        swap = psutil.swap_memory()
+        disk = psutil.disk_io_counters()
+        net = psutil.net_io_counters()
+        return {
+            'cores': [self.busy_and_total(times) for times in psutil.cpu_times(percpu=True)],
+            'swap': swap.percent,
+            'swap_in': swap.sin,
+            'swap_out': swap.sout,
+            'disk_read': disk.read_bytes if disk else 0,
+            'disk_write': disk.write_bytes if disk else 0,
+            'net_sent': net.bytes_sent if net else 0,
+            'net_received': net.bytes_recv if net else 0,
+            'context_switches': psutil.cpu_stats().ctx_switches,
+        }
+
+    @staticmethod
+    def busy_and_total(times):
+        """
+        :param times: CPU times of one core
+        :return: (busy, total) seconds, waiting for I/O counts as idle
+        """
+        total = sum(times)
+        # Guest time is already included in user time on Linux
+        total -= getattr(times, 'guest', 0) + getattr(times, 'guest_nice', 0)
+        return total - times.idle - getattr(times, 'iowait', 0), total
+
+    def sample(self):
+        """
+        Take a snapshot and compute usage and rates since the previous one
+        The first call has nothing to compare with, it returns None
+        :return: dict with keys 'timestamp', 'cores' (array of percents), 'load_average', 'memory' (percent),
+                 'memory_available' (bytes), 'swap' (percent), and the rates per second
+                 'swap_in', 'swap_out', 'disk_read', 'disk_write', 'net_sent', 'net_received' (bytes),
+                 'context_switches'
+        """
+        timestamp = time.time()
+        clock = time.monotonic()
+        snapshot = self.take_snapshot()
+        previous, elapsed = self.snapshot, clock - self.last_clock if self.last_clock is not None else 0
+        self.snapshot, self.last_clock = snapshot, clock
+        if previous is None or elapsed <= 0:
+            return None
+
+        cores = array('f')
+        for (busy, total), (previous_busy, previous_total) in zip(snapshot['cores'], previous['cores']):
+            delta = total - previous_total
+            cores.append(min(max(busy - previous_busy, 0.0) / delta * 100, 100.0) if delta > 0 else 0.0)
+        memory = psutil.virtual_memory()
+        sample = {
+            'timestamp': timestamp,
+            'cores': cores,
+            'load_average': psutil.getloadavg()[0],
+            'memory': memory.percent,
+            'memory_available': memory.available,
+            'swap': snapshot['swap'],
+        }
+        for counter in ('swap_in', 'swap_out', 'disk_read', 'disk_write', 'net_sent', 'net_received',
+                        'context_switches'):
+            # Counters may wrap or be reset, e.g. when a network interface is removed
+            sample[counter] = max(snapshot[counter] - previous[counter], 0) / elapsed
+        return sample
+
+
+class SystemEventDetector:
+    """
+    Turns system samples into notable transitions, e.g. a core pinned at 100% or memory pressure
+    A condition must hold for `sustain` ticks in a row to raise an event,
+    and it is cleared with hysteresis, so a value oscillating around the threshold does not flood the events
+    """
+
+    CORE_SATURATED = 99.0
+    CORE_CLEARED = 90.0
+    MEMORY_PRESSURE = 90.0
+    MEMORY_CLEARED = 85.0
+    # Bytes per second swapped in or out
+    SWAPPING = 1 << 20
+    SWAPPING_CLEARED = 0
+
+    def __init__(self, sustain=3):
+        """
+        :param sustain: ticks a condition must hold before it is reported
+        """
+        self.sustain = sustain
+        self.states = {}  # {condition: [active, ticks in the opposite state]}
+
+    def detect(self, sample):
+        """
+        :param sample: dict returned by SystemSampler.sample()
+        :return: list of (timestamp, event text)
+        """
+        events = []
+        timestamp = sample['timestamp']
+        for core, usage in enumerate(sample['cores']):
+            event = self.transition(('core', core), usage >= self.CORE_SATURATED, usage < self.CORE_CLEARED)
+            if event is not None:
+                text = f"Core {core} saturated" if event else f"Core {core} no longer saturated"
+                events.append((timestamp, f"{text}: {usage:.0f}%"))
+        memory = sample['memory']
+        event = self.transition('memory', memory >= self.MEMORY_PRESSURE, memory < self.MEMORY_CLEARED)
+        if event is not None:
+            text = "Memory pressure" if event else "Memory pressure relieved"
+            events.append((timestamp, f"{text}: {memory:.0f}% used"))
+        swapping = sample['swap_in'] + sample['swap_out']
+        event = self.transition('swap', swapping >= self.SWAPPING, swapping <= self.SWAPPING_CLEARED)
+        if event is not None:
+            text = "Swapping" if event else "Swapping stopped"
+            events.append((timestamp, f"{text}: {swapping / (1 << 20):.1f} MB/s"))
+        return events
+
+    def transition(self, condition, raised, cleared):
+        """
+        :param condition: key of the condition
+        :param raised: the raising threshold is crossed in this sample
+        :param cleared: the clearing threshold is crossed in this sample
+        :return: True if the condition became active, False if it cleared, None if nothing changed
+        """
+        state = self.states.setdefault(condition, [False, 0])
+        if state[0] and cleared or not state[0] and raised:
+            state[1] += 1
+        else:
+            state[1] = 0
+        if state[1] < self.sustain:
+            return None
+        state[0], state[1] = not state[0], 0
+        return state[0]
+
+    def clear(self):
+        self.states = {}
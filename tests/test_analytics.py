@@ -0,0 +1,38 @@
+import math
+import time
+
+import analytics
+from sqlite_store import SQLiteStore
+
+
+def test_time_above_follows_the_sampling_interval(tmp_path):
+    database_name = str(tmp_path / "metrics.db")
+    store = SQLiteStore(database_name)
+    store.open()
+    start = int(time.time() // 3600) * 3600 - 3600
+    records, expected = [], 0.0
+    # Sampled every 0.2 s, then every second as an adaptive interval would, busy in the odd minutes
+    for minute in range(20):
+        interval = 0.2 if minute < 10 else 1.0
+        usage = 80.0 if minute % 2 else 10.0
+        for tick in range(round(60 / interval)):
+            records.append({'timestamp': start + minute * 60 + tick * interval, 'pid': 1, 'name': 'worker',
+                            'usage': usage})
+    for first in range(0, len(records), 1000):
+        store.write_batch(records[first:first + 1000])
+    store.close()
+    # The window ends in the middle of minutes, the ends are read from the raw samples
+    window_start, window_end = start + 30, start + 19 * 60 + 30
+    previous = None
+    for record in records:
+        timestamp = record['timestamp']
+        if window_start <= timestamp < window_end and previous is not None and record['usage'] > 50:
+            expected += timestamp - previous
+        previous = timestamp
+    connection = analytics.connect(database_name)
+    try:
+        result, = analytics.WindowAnalytics(connection).statistics(window_start, window_end, threshold=50)
+    finally:
+        connection.close()
+    assert math.isclose(result['time_above'], expected, rel_tol=1e-3)
+    assert math.isclose(result['time_above'], 9.5 * 60, rel_tol=1e-3)
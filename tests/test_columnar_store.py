@@ -0,0 +1,121 @@
+import time
+
+import numpy as np
+
+from columnar_store import ColumnarStore, Segment, DTYPES, USAGE_SCALE
+
+
+def hour_start():
+    """
+    :return: start of the previous hour, within the retention of the store
+    """
+    return int(time.time() // 3600) * 3600 - 3600
+
+
+def write(store, timestamps, usage, pid=100):
+    store.write_batch([{'timestamp': timestamp, 'pid': pid, 'name': 'worker', 'usage': usage}
+                       for timestamp in timestamps])
+
+
+def test_rollup_survives_reopen(tmp_path):
+    database = str(tmp_path / "metrics.db")
+    start = hour_start()
+    store = ColumnarStore(database)
+    store.open()
+    write(store, [start + second for second in range(100)], 10.0)
+    store.close()
+
+    store = ColumnarStore(database)
+    store.open()
+    write(store, [start + 200], 30.0)
+    store.close()
+
+    store = ColumnarStore(database)
+    store.open()
+    samples, minimum, average, maximum = store.connection.execute(
+        "SELECT Samples, MinWorkload, AvgWorkload, MaxWorkload FROM CpuWorkloadRollup1h WHERE Bucket = ?", (start,)
+    ).fetchone()
+    store.close()
+    assert samples == 101
+    assert (minimum, maximum) == (10.0, 30.0)
+    assert abs(average - (100 * 10.0 + 30.0) / 101) < 1e-9
+
+
+def test_rollup_reloads_buffered_samples(tmp_path):
+    store = ColumnarStore(str(tmp_path / "metrics.db"))
+    store.open()
+    start = hour_start()
+    write(store, [start + 10, start + 20], 5.0)
+    # The next minute evicts the first 1 minute bucket while its samples are still buffered, a late sample reloads it
+    write(store, [start + 70], 5.0)
+    write(store, [start + 30], 5.0)
+    samples, = store.connection.execute(
+        "SELECT Samples FROM CpuWorkloadRollup1m WHERE Bucket = ?", (start,)
+    ).fetchone()
+    store.close()
+    assert samples == 3
+
+
+def test_segment_encoding_roundtrip(tmp_path):
+    day = 1700000000 // 86400 * 86400
+    # Irregular intervals: positive and negative delta-of-deltas, a long gap and sub-millisecond jitter
+    ticks = day + np.cumsum([0.0, 1.0, 1.0, 0.2, 5.0, 0.0004, 3600.0, 1.0, 0.9996])
+    records = [{'timestamp': float(timestamp), 'pid': pid, 'name': f'process{pid % 3}', 'usage': usage,
+                'host': 'agent' if pid % 2 else ''}
+               for timestamp in ticks for pid, usage in ((1, 0.0), (2, 12.345), (70000, 99.999), (3, 1234.5678))]
+    path = str(tmp_path / "CpuWorkload_20231114.cpus")
+    segment = Segment(path)
+    segment.append(records[:10])
+    segment.append(records[10:])
+    segment.close()
+
+    segment = Segment(path)
+    columns = list(segment.scan())
+    segment.close()
+    timestamps = np.concatenate([chunk['timestamp'] for chunk in columns])
+    usages = np.concatenate([chunk['usage'] for chunk in columns])
+    keys = [(host, int(pid), name) for chunk in columns
+            for host, pid, name in zip(chunk['host'], chunk['pid'], chunk['name'])]
+    assert len(timestamps) == len(records)
+    # Rows of a chunk are ordered by timestamp, the records are in that order already
+    for timestamp, usage, key, record in zip(timestamps, usages, keys, records):
+        assert abs(timestamp - record['timestamp']) <= 0.0005
+        assert abs(usage - record['usage']) <= 0.5 / USAGE_SCALE + 1e-9
+        assert key == (record['host'], record['pid'], record['name'])
+    # The usages of this chunk fit in uint32, the series numbers in uint8
+    _, _, _, _, codes, _ = segment.chunks[-1]
+    assert DTYPES[codes[2]] == np.dtype('<u1')
+    assert DTYPES[codes[3]] == np.dtype('<u4')
+
+
+
+def test_concurrent_writers_append_in_turn(tmp_path):
+    path = str(tmp_path / "CpuWorkload_20231114.cpus")
+    day = 1700000000 // 86400 * 86400
+    writers = [Segment(path), Segment(path)]
+    for tick in range(6):
+        # Each writer adds a series unknown to the other one
+        writer = writers[tick % 2]
+        writer.append([{'timestamp': day + tick, 'pid': tick, 'name': f'writer{tick % 2}', 'usage': float(tick)}])
+    for writer in writers:
+        writer.close()
+
+    segment = Segment(path)
+    rows = [(float(timestamp), int(pid), name, float(usage)) for columns in segment.scan()
+            for timestamp, pid, name, usage in zip(columns['timestamp'], columns['pid'], columns['name'],
+                                                   columns['usage'])]
+    segment.close()
+    assert rows == [(day + tick, tick, f'writer{tick % 2}', float(tick)) for tick in range(6)]
+
+
+def test_count_matches_scan(tmp_path):
+    segment = Segment(str(tmp_path / "segment.cpus"))
+    start = hour_start()
+    for chunk in range(4):
+        segment.append([{'timestamp': start + chunk * 10 + second + 0.5, 'pid': pid, 'name': f"worker{pid % 2}",
+                         'usage': 1.0} for second in range(10) for pid in range(3)])
+    for bounds in ((None, None), (start + 5, None), (None, start + 25), (start + 10, start + 30), (start, start + 3)):
+        for process_name in (None, 'worker0', 'worker1', 'unknown'):
+            scanned = sum(len(columns['pid']) for columns in segment.scan(*bounds, process_name))
+            assert segment.count(*bounds, process_name) == scanned
+    segment.close()
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+import analytics
+import data_transfer
+from sqlite_store import SQLiteStore
+
+
+@pytest.mark.parametrize("extension", [".csv", data_transfer.COLUMNAR_EXTENSION])
+def test_export_import_keeps_hosts(tmp_path, extension):
+    start = int(time.time()) - 600
+    records = [{'timestamp': start + second, 'pid': 42, 'name': 'worker', 'usage': usage, 'host': host}
+               for second in range(10) for host, usage in (('', 10.0), ('agent1', 20.0), ('agent2', 30.0))]
+    source = SQLiteStore(str(tmp_path / "source.db"))
+    source.open()
+    source.write_batch(records)
+    source.close()
+
+    path = str(tmp_path / ("samples" + extension))
+    assert data_transfer.export_file(str(tmp_path / "source.db"), path) == len(records)
+    target = SQLiteStore(str(tmp_path / "target.db"))
+    target.open()
+    assert data_transfer.import_file(target, path) == len(records)
+    rows = target.connection.execute(
+        "SELECT Host, count(*), avg(Workload) FROM CpuWorkload GROUP BY Host ORDER BY Host"
+    ).fetchall()
+    rollups = target.connection.execute(
+        "SELECT Host, sum(Samples), max(MaxWorkload) FROM CpuWorkloadRollup1h GROUP BY Host ORDER BY Host"
+    ).fetchall()
+    hosts = target.connection.execute("SELECT Host, LastTimestamp FROM Hosts ORDER BY Host").fetchall()
+    target.close()
+    assert rows == [('', 10, 10.0), ('agent1', 10, 20.0), ('agent2', 10, 30.0)]
+    assert rollups == [('', 10, 10.0), ('agent1', 10, 20.0), ('agent2', 10, 30.0)]
+    assert hosts == [('agent1', start + 9), ('agent2', start + 9)]
+
+
+def test_import_durations_do_not_follow_live_samples(tmp_path):
+    start = int(time.time() // 60) * 60 - 600
+    source = SQLiteStore(str(tmp_path / "source.db"))
+    source.open()
+    source.write_batch([{'timestamp': start + second, 'pid': 42, 'name': 'worker', 'usage': 80.0}
+                        for second in range(120)])
+    source.close()
+    path = str(tmp_path / "samples.csv")
+    data_transfer.export_file(str(tmp_path / "source.db"), path)
+
+    # The same process is collected meanwhile, its newest sample is more recent than the imported ones
+    target = SQLiteStore(str(tmp_path / "target.db"))
+    target.open()
+    target.write_batch([{'timestamp': start + 300 + second, 'pid': 42, 'name': 'worker', 'usage': 10.0}
+                        for second in range(10)])
+    data_transfer.import_file(target, path)
+    target.close()
+    connection = analytics.connect(str(tmp_path / "target.db"))
+    try:
+        result, = analytics.WindowAnalytics(connection).statistics(start, start + 120, threshold=50)
+    finally:
+        connection.close()
+    assert result['time_above'] == pytest.approx(119)
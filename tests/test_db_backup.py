@@ -0,0 +1,74 @@
+import time
+
+import columnar_store
+import db_backup
+from columnar_store import ColumnarStore
+from sqlite_store import SQLiteStore
+
+
+def write_minutes(database, start, minutes):
+    store = ColumnarStore(database)
+    store.open()
+    for second in range(start, start + 60 * minutes):
+        store.write_batch([{'timestamp': second, 'pid': pid, 'name': 'worker', 'usage': pid} for pid in range(3)])
+    store.close()
+
+
+def samples(database):
+    return sum(len(columns['usage']) for columns in columnar_store.scan(database))
+
+
+def test_backups_restore_segments(tmp_path):
+    database, restored = str(tmp_path / "metrics.db"), str(tmp_path / "restored.db")
+    start = int(time.time() // 60) * 60 - 600
+    write_minutes(database, start, 2)
+    full = str(tmp_path / "full.zip")
+    db_backup.full_backup(database, full)
+    write_minutes(database, start + 120, 3)
+    incremental = str(tmp_path / "incremental.zip")
+    db_backup.incremental_backup(database, incremental)
+
+    db_backup.restore_backup(full, restored)
+    assert samples(restored) == 2 * 60 * 3
+    db_backup.restore_backup(incremental, restored)
+    assert samples(restored) == samples(database) == 5 * 60 * 3
+
+    store = ColumnarStore(restored)
+    store.open()
+    rollups = store.connection.execute("SELECT count(*), sum(Samples) FROM CpuWorkloadRollup1m").fetchone()
+    store.close()
+    assert rollups == (5 * 3, 5 * 60 * 3)
+
+
+def test_incremental_backups_archive_late_samples(tmp_path):
+    database, restored = str(tmp_path / "metrics.db"), str(tmp_path / "restored.db")
+    now = int(time.time())
+    store = SQLiteStore(database)
+    store.open()
+    store.write_batch([{'timestamp': now, 'pid': 1, 'name': 'worker', 'usage': 10.0, 'metrics': {'Rss': 1}}])
+    full = str(tmp_path / "full.zip")
+    db_backup.full_backup(database, full)
+    # Ticks buffered by an agent during a disconnection commit after the backup with their old timestamps
+    store.write_batch([
+        {'timestamp': now - 7200 + second, 'pid': 2, 'name': 'agent', 'usage': 20.0, 'host': 'agent',
+         'metrics': {'Rss': 2}}
+        for second in range(3)
+    ] + [{'timestamp': now - 7200, 'pid': 2, 'name': 'agent', 'usage': 20.0, 'members': 1, 'host': 'agent'}])
+    store.close()
+    incremental = str(tmp_path / "incremental.zip")
+    db_backup.incremental_backup(database, incremental)
+
+    db_backup.restore_backup(full, restored)
+    db_backup.restore_backup(incremental, restored)
+    queries = (
+        "SELECT count(*) FROM CpuWorkload", "SELECT count(*) FROM ProcessMetrics",
+        "SELECT count(*) FROM FamilyWorkload", "SELECT sum(Samples) FROM CpuWorkloadRollup1m",
+        "SELECT sum(Samples) FROM CpuWorkloadRollup1h",
+    )
+    counts = {}
+    for name in (database, restored):
+        store = SQLiteStore(name)
+        store.open()
+        counts[name] = [store.connection.execute(query).fetchone()[0] for query in queries]
+        store.close()
+    assert counts[restored] == counts[database] == [4, 4, 1, 4, 4]
@@ -0,0 +1,29 @@
+import os
+
+from process_registry import ProcessRegistry, SWEEP_REFRESHES
+
+
+class RecycledProcess:
+    """
+    Handle of a process which exited, its PID now belongs to the current process
+    """
+
+    @staticmethod
+    def is_running():
+        return False
+
+
+def test_unwatched_recycled_pid_is_noticed():
+    registry = ProcessRegistry()
+    registry.refresh()
+    pid = os.getpid()
+    name = registry.name(pid)
+    registry.handles[pid], registry.names[pid] = RecycledProcess(), "stale"
+    exited, added = [], []
+    for _ in range(SWEEP_REFRESHES):
+        refresh_added, refresh_exited = registry.refresh()
+        added.extend(refresh_added)
+        exited.extend(refresh_exited)
+    assert (pid, "stale") in exited
+    assert (pid, name) in added
+    assert registry.name(pid) == name
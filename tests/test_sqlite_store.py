@@ -0,0 +1,55 @@
+import math
+import random
+import sqlite3
+import time
+
+import pytest
+
+from sqlite_store import SQLiteStore, HISTOGRAM_BIN_WIDTH
+
+
+def test_rollup_p95_within_a_bin(tmp_path):
+    store = SQLiteStore(str(tmp_path / "metrics.db"))
+    store.open()
+    start = int(time.time() // 3600) * 3600 - 3600
+    generator = random.Random(1)
+    workloads = [generator.uniform(0, 60) for _ in range(1000)]
+    # Two batches, the bucket is evicted by the second one and reloaded from its rollup row
+    store.write_batch([{'timestamp': start + second, 'pid': 1, 'name': 'worker', 'usage': workload}
+                       for second, workload in enumerate(workloads[:500])])
+    store.rollups[1].clear()
+    store.write_batch([{'timestamp': start + 500 + second, 'pid': 1, 'name': 'worker', 'usage': workload}
+                       for second, workload in enumerate(workloads[500:])])
+    samples, minimum, average, maximum, p95 = store.connection.execute(
+        "SELECT Samples, MinWorkload, AvgWorkload, MaxWorkload, P95Workload FROM CpuWorkloadRollup1h"
+    ).fetchone()
+    store.close()
+    ordered = sorted(workloads)
+    assert samples == 1000
+    assert (minimum, maximum) == (ordered[0], ordered[-1])
+    assert math.isclose(average, sum(workloads) / 1000)
+    assert abs(p95 - ordered[math.ceil(0.95 * 1000) - 1]) <= HISTOGRAM_BIN_WIDTH / 2
+
+
+def test_rollups_restored_after_a_failed_write(tmp_path, monkeypatch):
+    store = SQLiteStore(str(tmp_path / "metrics.db"))
+    store.open()
+    start = int(time.time() // 3600) * 3600 - 3600
+    store.write_batch([{'timestamp': start, 'pid': 1, 'name': 'worker', 'usage': 10.0}])
+
+    def fail(records):
+        raise sqlite3.OperationalError("disk I/O error")
+    monkeypatch.setattr(store, 'insert_samples', fail)
+    with pytest.raises(sqlite3.OperationalError):
+        store.write_batch([{'timestamp': start + 1, 'pid': 1, 'name': 'worker', 'usage': 90.0}])
+    monkeypatch.undo()
+    store.write_batch([{'timestamp': start + 2, 'pid': 1, 'name': 'worker', 'usage': 70.0}])
+    rollups = [store.connection.execute(
+        f"SELECT Samples, AvgWorkload, MaxWorkload FROM {table}"
+    ).fetchone() for table in ("CpuWorkloadRollup1m", "CpuWorkloadRollup1h")]
+    raw = store.connection.execute("SELECT COUNT(*) FROM CpuWorkload").fetchone()[0]
+    last_sampled = dict(store.last_sampled)
+    store.close()
+    assert raw == 2
+    assert rollups == [(2, 40.0, 70.0)] * 2
+    assert last_sampled == {('', 1): start + 2}
@@ -0,0 +1,15 @@
+import threading
+import time
+
+from tick_log import paced
+from tick_scheduler import TickScheduler
+
+
+def test_stop_interrupts_paced_gap():
+    scheduler = TickScheduler()
+    # The second tick was recorded an hour after the first one
+    ticks = paced([(0.0,), (3600.0,)], speed=1.0, wait=scheduler.sleep)
+    start = time.monotonic()
+    threading.Timer(0.1, scheduler.stop).start()
+    assert list(ticks) == [(0.0,)]
+    assert time.monotonic() - start < 5
@@ -0,0 +1,289 @@
+import math
+import mmap
+import os
+import struct
+import time
+
+from cpu_sampler import PROCESS_METRICS
+
+# Tick log format, append-only:
+#   header: magic, format version
+#   frames: kind uint8, payload size uint32, payload
+#   NAME frame: UTF-8 process name, names are numbered in the order of their frames
+#   TICK frame: timestamp float64, row count uint32, column mask uint32, then the columns, all little-endian:
+#               PIDs int32, name numbers uint32, usages float32,
+#               family sizes int32 if the mask has FAMILY_COLUMN (0 for processes),
+#               then one float64 column per metric of the mask, NaN where the process has no value
+# A frame cut short by a crash is ignored by the readers, and overwritten when recording resumes
+TICK_LOG_MAGIC = b"CPUTICK"
+TICK_LOG_VERSION = 1
+TICK_LOG_HEADER = struct.Struct("<7sH")
+TICK_LOG_FRAME = struct.Struct("<BI")
+TICK_LOG_TICK = struct.Struct("<dII")
+TICK_LOG_EXTENSION = ".ticks"
+NAME_FRAME = 1
+TICK_FRAME = 2
+# Bits of the column mask, metrics take the low bits in the order of PROCESS_METRICS
+METRIC_COLUMNS = {metric: 1 << bit for bit, metric in enumerate(PROCESS_METRICS)}
+FAMILY_COLUMN = 1 << 31
+
+
+def tick_columns(buffer, start=0):
+    """
+    :param buffer: buffer holding the payload of a TICK frame, e.g. the map of a tick log
+    :param start: offset of the payload
+    :return: (timestamp, columns), columns is a dict of NumPy arrays viewing the buffer with the keys 'pid', 'name'
+             (numbers of the names), 'usage', 'members' if any family was recorded, and the metrics recorded in the tick
+    """
+    # Imported when the log is read or written, not with the GUI, see TICK_LOG_EXTENSION
+    import numpy as np
+
+    timestamp, count, mask = TICK_LOG_TICK.unpack_from(buffer, start)
+    offset = start + TICK_LOG_TICK.size
+    layout = [('pid', '<i4'), ('name', '<u4'), ('usage', '<f4')]
+    if mask & FAMILY_COLUMN:
+        layout.append(('members', '<i4'))
+    layout.extend((metric, '<f8') for metric, bit in METRIC_COLUMNS.items() if mask & bit)
+    columns = {}
+    for column, dtype in layout:
+        columns[column] = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+        offset += columns[column].nbytes
+    return timestamp, columns
+
+
+class TickEncoder:
+    """
+    Encodes the records of ticks into NAME and TICK frames, the names are numbered as they are first seen
+    Used for tick logs and for the streams of the agents, see aggregator
+    """
+
+    def __init__(self, names=()):
+        """
+        :param names: names numbered by the frames already written, in the order of their numbers
+        """
+        self.name_numbers = {name: number for number, name in enumerate(names)}  # {name: number}
+
+    def encode(self, timestamp, records):
+        """
+        :param timestamp: time of the tick
+        :param records: list of dicts returned by CPUSampler.make_records()
+        :return: bytes of the NAME frames of the new names and of the TICK frame
+        """
+        import numpy as np
+
+        frames = []
+        name_numbers = self.name_numbers
+        for record in records:
+            if record['name'] not in name_numbers:
+                name_numbers[record['name']] = len(name_numbers)
+                encoded = record['name'].encode('utf-8')
+                frames.append(TICK_LOG_FRAME.pack(NAME_FRAME, len(encoded)) + encoded)
+
+        mask = 0
+        for record in records:
+            if 'members' in record:
+                mask |= FAMILY_COLUMN
+            for metric in record.get('metrics', ()):
+                mask |= METRIC_COLUMNS[metric]
+        columns = [
+            np.fromiter((record['pid'] for record in records), '<i4', len(records)),
+            np.fromiter((name_numbers[record['name']] for record in records), '<u4', len(records)),
+            np.fromiter((record['usage'] for record in records), '<f4', len(records)),
+        ]
+        if mask & FAMILY_COLUMN:
+            columns.append(np.fromiter((record.get('members', 0) for record in records), '<i4', len(records)))
+        for metric, bit in METRIC_COLUMNS.items():
+            if mask & bit:
+                columns.append(np.fromiter(
+                    (record.get('metrics', {}).get(metric, np.nan) for record in records), '<f8', len(records)
+                ))
+        payload = TICK_LOG_TICK.pack(timestamp, len(records), mask) + b"".join(column.tobytes() for column in columns)
+        frames.append(TICK_LOG_FRAME.pack(TICK_FRAME, len(payload)) + payload)
+        return b"".join(frames)
+
+
+class TickRecorder:
+    """
+    Appends the records of every tick, as returned by CPUSampler.make_records(), to a tick log
+    Every tick is one frame written with one call and flushed, so a crash loses at most the last tick
+    Recording into an existing log continues it
+    """
+
+    def __init__(self, path):
+        """
+        :param path: tick log, created if it does not exist
+        """
+        self.path = path
+        self.encoder = TickEncoder()
+        end = None
+        if os.path.isfile(path) and os.path.getsize(path):
+            with TickLog(path) as log:
+                self.encoder = TickEncoder(log.names())
+                end = log.end
+        self.file = open(path, 'r+b' if end is not None else 'wb')
+        if end is None:
+            self.file.write(TICK_LOG_HEADER.pack(TICK_LOG_MAGIC, TICK_LOG_VERSION))
+        else:
+            # Drop a frame cut short
+            self.file.truncate(end)
+            self.file.seek(end)
+
+    def write(self, timestamp, records):
+        """
+        :param timestamp: time of the tick
+        :param records: list of dicts returned by CPUSampler.make_records()
+        """
+        self.file.write(self.encoder.encode(timestamp, records))
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class TickLog:
+    """
+    Reads a tick log through a memory map, the columns of a tick are NumPy views of the mapped file
+    The log may be read while it is recorded, the ticks written after opening it are not seen
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < TICK_LOG_HEADER.size:
+            self.file.close()
+            raise ValueError(f"{path} is not a tick log")
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        magic, version = TICK_LOG_HEADER.unpack_from(self.map, 0)
+        if magic != TICK_LOG_MAGIC or version != TICK_LOG_VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a tick log")
+        self.end = TICK_LOG_HEADER.size  # Offset after the last complete frame, known once the log was scanned
+        for _ in self.frames():
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Columns of tick_columns() are still referenced, the map is released along with them
+                pass
+            self.map = None
+        self.file.close()
+
+    def frames(self):
+        """
+        :return: generator of (kind, payload offset, payload size) of the complete frames
+        """
+        mapped, size = self.map, len(self.map)
+        offset = TICK_LOG_HEADER.size
+        while offset + TICK_LOG_FRAME.size <= size:
+            kind, payload_size = TICK_LOG_FRAME.unpack_from(mapped, offset)
+            start = offset + TICK_LOG_FRAME.size
+            if start + payload_size > size:
+                break
+            yield kind, start, payload_size
+            offset = start + payload_size
+            self.end = max(self.end, offset)
+
+    def names(self):
+        """
+        :return: list of the process names, indexed by their numbers
+        """
+        return [bytes(self.map[start:start + size]).decode('utf-8')
+                for kind, start, size in self.frames() if kind == NAME_FRAME]
+
+    def tick_count(self):
+        return sum(1 for kind, _, _ in self.frames() if kind == TICK_FRAME)
+
+    def time_range(self):
+        """
+        :return: (first, last) timestamps of the ticks, None if there are none
+        """
+        timestamps = [TICK_LOG_TICK.unpack_from(self.map, start)[0]
+                      for kind, start, _ in self.frames() if kind == TICK_FRAME]
+        return (timestamps[0], timestamps[-1]) if timestamps else None
+
+    def tick_columns(self, start):
+        """
+        :param start: payload offset of a TICK frame
+        :return: (timestamp, columns), see tick_columns()
+        """
+        return tick_columns(self.map, start)
+
+    def ticks(self):
+        """
+        :return: generator of (timestamp, records) of every tick, the records as CPUSampler.make_records() made them
+        """
+        names = []
+        for kind, start, size in self.frames():
+            if kind == NAME_FRAME:
+                names.append(bytes(self.map[start:start + size]).decode('utf-8'))
+            else:
+                timestamp, columns = self.tick_columns(start)
+                yield timestamp, self.records(timestamp, columns, names)
+
+    @staticmethod
+    def records(timestamp, columns, names):
+        """
+        :return: list of dicts of the records of one tick, see CPUSampler.make_records()
+        """
+        records = [
+            {'pid': pid, 'usage': usage, 'timestamp': timestamp, 'name': names[number]}
+            for pid, number, usage in zip(columns['pid'].tolist(), columns['name'].tolist(), columns['usage'].tolist())
+        ]
+        members = columns.get('members')
+        if members is not None:
+            for record, family_size in zip(records, members.tolist()):
+                if family_size:
+                    record['members'] = family_size
+        recorded = [(metric, columns[metric].tolist(), PROCESS_METRICS[metric][2])
+                    for metric in PROCESS_METRICS if metric in columns]
+        for row, record in enumerate(records if recorded else ()):
+            values = {}
+            for metric, metric_values, is_rate in recorded:
+                value = metric_values[row]
+                # NaN marks a metric the process had no value for
+                if not math.isnan(value):
+                    values[metric] = value if is_rate else int(value)
+            if values:
+                record['metrics'] = values
+        return records
+
+
+def paced(ticks, speed=1.0, max_lag=1.0, wait=None):
+    """
+    Release the ticks of a log at the pace they were recorded, or faster
+    Deadlines are absolute, computed from the timestamps, so the pace does not drift;
+    a consumer late by more than max_lag seconds, e.g. paused, continues from where it is without catching up
+    :param ticks: iterable of (timestamp, ...) tuples, e.g. TickLog.ticks()
+    :param speed: 1.0 for real time, N for N times faster, None or 0 for as fast as possible
+    :param max_lag: seconds
+    :param wait: function(seconds) waiting until the next tick and returning False to end the replay,
+                 e.g. TickScheduler.sleep(), so a stop does not wait for a long gap of the log; time.sleep by default
+    :return: generator of the ticks
+    """
+    start = first = None
+    for tick in ticks:
+        if speed:
+            now = time.monotonic()
+            if start is None:
+                start, first = now, tick[0]
+            deadline = start + (tick[0] - first) / speed
+            if now > deadline + max_lag:
+                start, first = now, tick[0]
+            elif deadline > now:
+                if wait is None:
+                    time.sleep(deadline - now)
+                elif not wait(deadline - now):
+                    return
+        yield tick
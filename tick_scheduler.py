@@ -0,0 +1,192 @@
+import math
+import threading
+import time
+
+# Shortest interval between ticks in seconds
+MIN_INTERVAL = 0.1
+# A tick later than this fraction of the interval is skipped, the schedule continues at the next deadline
+MAX_LATENESS = 0.5
+# Adaptive intervals range from interval / ADAPTIVE_SPEEDUP, at least MIN_INTERVAL, to interval * ADAPTIVE_SLOWDOWN
+ADAPTIVE_SPEEDUP = 10
+ADAPTIVE_SLOWDOWN = 5
+# Change of the CPU usage of a process between two ticks, in percent, switching to the shortest interval
+ADAPTIVE_CHANGE = 5.0
+# Seconds without such a change after which the interval is doubled
+ADAPTIVE_SETTLE = 10.0
+
+
+class TickScheduler:
+    """
+    Fires ticks at absolute deadlines of the monotonic clock, start + n * interval,
+    so the period does not drift with the time spent in the ticks
+    A tick due while the previous one was still running is skipped and counted as missed,
+    the schedule continues at the next deadline instead of shifting
+    Waits are on a condition variable: pause(), resume() and stop() take effect immediately from any thread
+    Optionally the interval adapts to the load, see adapt()
+    """
+
+    def __init__(self, interval=1.0, adaptive=False, clock=time.monotonic):
+        """
+        :param interval: seconds between ticks, at least MIN_INTERVAL
+        :param adaptive: shorten the interval while the load changes and lengthen it while it does not
+        :param clock: monotonic clock in seconds
+        """
+        self.condition = threading.Condition()
+        self.clock = clock
+        self.paused = False
+        self.stopped = False
+        self.deadline = None  # Deadline of the next tick, None before the first tick and after a pause
+        self.missed = 0  # Ticks skipped since the scheduler was created
+        self.quiet = 0.0  # Seconds of ticks without a change of the load, see adapt()
+        self.last_usage = {}  # {pid: usage} of the previous tick, see adapt()
+        self.base_interval = self.interval = interval
+        self.adaptive = adaptive
+        self.configure(interval, adaptive)
+
+    @property
+    def fastest_interval(self):
+        """
+        Shortest interval the ticks can come at, e.g. to size the history of the consumers
+        """
+        return self.min_interval if self.adaptive else self.base_interval
+
+    @property
+    def min_interval(self):
+        return max(MIN_INTERVAL, self.base_interval / ADAPTIVE_SPEEDUP)
+
+    @property
+    def max_interval(self):
+        return self.base_interval * ADAPTIVE_SLOWDOWN
+
+    def configure(self, interval, adaptive=False):
+        """
+        Change the interval, the next tick is due one new interval after the previous one
+        :param interval: seconds between ticks, at least MIN_INTERVAL
+        :param adaptive: see __init__()
+        :raise ValueError: if the interval is too short
+        """
+        if interval < MIN_INTERVAL:
+            raise ValueError(f"interval {interval}s is shorter than {MIN_INTERVAL}s")
+        with self.condition:
+            self.base_interval = interval
+            self.adaptive = adaptive
+            self.quiet = 0.0
+            self.set_interval(interval)
+
+    def set_interval(self, interval):
+        """
+        Must be called with the condition held
+        """
+        if self.deadline is not None:
+            self.deadline += interval - self.interval
+        self.interval = interval
+        self.condition.notify_all()
+
+    def start(self):
+        """
+        Arm the scheduler again after stop(), the first tick is due immediately
+        """
+        with self.condition:
+            self.stopped = False
+            self.deadline = None
+            self.set_interval(self.base_interval)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def pause(self):
+        with self.condition:
+            self.paused = True
+            self.condition.notify_all()
+
+    def resume(self):
+        """
+        The first tick after a pause is due immediately, the schedule restarts from it
+        """
+        with self.condition:
+            self.paused = False
+            self.deadline = None
+            self.condition.notify_all()
+
+    def wait_resumed(self):
+        """
+        Wait while paused
+        :return: False once stopped
+        """
+        with self.condition:
+            while self.paused and not self.stopped:
+                self.condition.wait()
+            return not self.stopped
+
+    def sleep(self, seconds):
+        """
+        Wait for a number of seconds, and while paused, e.g. between the ticks of a replay, see tick_log.paced()
+        :param seconds: seconds to wait
+        :return: False once stopped, at once
+        """
+        with self.condition:
+            end = self.clock() + seconds
+            while not self.stopped:
+                if self.paused:
+                    self.condition.wait()
+                    continue
+                remaining = end - self.clock()
+                if remaining <= 0:
+                    return True
+                self.condition.wait(remaining)
+            return False
+
+    def wait(self):
+        """
+        Wait for the deadline of the next tick, and while paused
+        :return: number of ticks skipped since the previous tick, None once stopped
+        """
+        missed = 0
+        with self.condition:
+            while True:
+                if self.stopped:
+                    return None
+                if self.paused:
+                    self.condition.wait()
+                    continue
+                now = self.clock()
+                if self.deadline is None:
+                    self.deadline = now
+                lateness = now - self.deadline
+                if lateness > MAX_LATENESS * self.interval:
+                    skipped = math.ceil((lateness - MAX_LATENESS * self.interval) / self.interval)
+                    self.deadline += skipped * self.interval
+                    missed += skipped
+                    continue
+                if lateness >= 0:
+                    break
+                self.condition.wait(-lateness)
+            self.deadline += self.interval
+            self.missed += missed
+            return missed
+
+    def adapt(self, cpu_usage):
+        """
+        Adapt the interval to the load, called after every tick, does nothing unless adaptive
+        A change of the load, the CPU usage of a process changing by ADAPTIVE_CHANGE or more since the previous tick,
+        switches to the shortest interval at once; the interval is then doubled after every ADAPTIVE_SETTLE seconds
+        without a change, up to the longest interval
+        :param cpu_usage: dictionary {pid: (usage, timestamp)} of the tick, new processes change from 0
+        """
+        if not self.adaptive:
+            return
+        previous = self.last_usage
+        self.last_usage = {pid: usage for pid, (usage, _) in cpu_usage.items()}
+        change = max((abs(usage - previous.get(pid, 0.0)) for pid, usage in self.last_usage.items()), default=0.0)
+        with self.condition:
+            if change >= ADAPTIVE_CHANGE:
+                self.quiet = 0.0
+                if self.interval != self.min_interval:
+                    self.set_interval(self.min_interval)
+                return
+            self.quiet += self.interval
+            if self.quiet >= ADAPTIVE_SETTLE and self.interval < self.max_interval:
+                self.quiet = 0.0
+                self.set_interval(min(self.interval * 2, self.max_interval))
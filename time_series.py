@@ -0,0 +1,112 @@
+import math
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Fixed-capacity series of (timestamp, value) samples backed by NumPy columns
+    Once the capacity is reached the oldest sample is overwritten
+    Every sample is written twice, at position i and i + capacity,
+    so the chronological window is always one contiguous slice and views never copy
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: maximal number of samples kept
+        """
+        self.capacity = capacity
+        self.timestamps = np.zeros(2 * capacity, dtype=np.float64)
+        self.values = np.zeros(2 * capacity, dtype=np.float32)
+        self.head = 0  # Position of the next write in [0, capacity)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp, value):
+        head = self.head
+        self.timestamps[head] = self.timestamps[head + self.capacity] = timestamp
+        self.values[head] = self.values[head + self.capacity] = value
+        self.head = (head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def view(self):
+        """
+        Read-only chronological view of the buffer, valid until the next append
+        :return: tuple of NumPy arrays (timestamps, values)
+        """
+        end = self.head + self.capacity if self.size == self.capacity else self.head
+        timestamps = self.timestamps[end - self.size:end]
+        values = self.values[end - self.size:end]
+        timestamps.flags.writeable = False
+        values.flags.writeable = False
+        return timestamps, values
+
+    def last_timestamp(self):
+        """
+        :return: timestamp of the newest sample or None if the buffer is empty
+        """
+        return self.timestamps[self.head - 1] if self.size else None
+
+    def clear(self):
+        self.head = 0
+        self.size = 0
+
+
+class TimeSeriesStore:
+    """
+    Bounded per-process history of CPU usage
+    Keeps one ring buffer per PID sized to hold the retention window,
+    buffers of processes that stopped reporting are dropped once their data expires
+    Memory and per-tick cost do not depend on how long the monitor has been running
+    """
+
+    def __init__(self, retention=3600, interval=1):
+        """
+        :param retention: retention window in seconds
+        :param interval: expected interval between ticks in seconds
+        """
+        self.retention = retention
+        self.capacity = max(1, math.ceil(retention / interval))
+        self.buffers = {}  # {pid: RingBuffer}
+
+    def append_tick(self, cpu_usage):
+        """
+        Append one tick of samples
+        :param cpu_usage: dictionary {pid: (usage, timestamp)}
+        """
+        latest = None
+        for pid, (usage, timestamp) in cpu_usage.items():
+            buffer = self.buffers.get(pid)
+            if buffer is None:
+                buffer = self.buffers[pid] = RingBuffer(self.capacity)
+            buffer.append(timestamp, usage)
+            latest = timestamp
+        if latest is not None:
+            self.expire(latest - self.retention)
+
+    def expire(self, oldest):
+        """
+        Drop buffers whose newest sample is older than the given timestamp
+        :param oldest: timestamp at the start of the retention window
+        """
+        expired = [pid for pid, buffer in self.buffers.items() if buffer.last_timestamp() < oldest]
+        for pid in expired:
+            del self.buffers[pid]
+
+    def view(self, pid):
+        """
+        :param pid: process id
+        :return: read-only arrays (timestamps, values) for the process, empty if unknown
+        """
+        buffer = self.buffers.get(pid)
+        if buffer is None:
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float32)
+        return buffer.view()
+
+    def pids(self):
+        return list(self.buffers)
+
+    def clear(self):
+        self.buffers = {}